@@ -16,13 +16,13 @@ from . import preprocess
 from . import utils
 from .tools import get_tool
 from .classes.ann_data import AnnData
-from .readwrite import read, write, read_params
+from .readwrite import read, write, read_params, read_10x_h5
 from .examples import show_exdata, show_examples, get_example
 from . import preprocess
 from .preprocess.simple import subsample
-from .tools.diffmap import diffmap, plot_diffmap
+from .tools.diffmap import diffmap, plot_diffmap, diffmap_project
 from .tools.tsne import tsne, plot_tsne
-from .tools.dpt import dpt, plot_dpt
+from .tools.dpt import dpt, plot_dpt, dpt_roots
 from .tools.pca import pca, plot_pca
 from .tools.diffrank import diffrank, plot_diffrank
 from .tools.sim import sim, plot_sim
@@ -39,20 +39,21 @@ __all__ = [
     'help', # show help for a given tool
     # elementary operations
     'read',
+    'read_10x_h5',
     'write',
     # preprocessing
     'preprocess', 'pp',
     'subsample',
     # visualization
-    'diffmap', 'plot_diffmap',
+    'diffmap', 'plot_diffmap', 'diffmap_project',
     'tsne', 'plot_tsne',
-    'pca', 'plot_pca'
+    'pca', 'plot_pca',
     # subgroup identification
-    'dpt', 'plot_dpt'
+    'dpt', 'plot_dpt', 'dpt_roots',
     # differential expression testing
-    'diffrank', 'plot_diffrank'
+    'diffrank', 'plot_diffrank',
     # simulation
-    'sim', 'plot_sim'
+    'sim', 'plot_sim',
     # plotting
     'show',
     # classes
@@ -1,20 +1,184 @@
 """
 Annotated Data
 """
-from collections import Mapping, Sequence
-from collections import OrderedDict
+from collections import Mapping, MutableMapping, Sequence
+from collections import OrderedDict, namedtuple
+from copy import copy
 from enum import Enum
 import numpy as np
 from numpy import ma
-from numpy.lib.recfunctions import append_fields
 from scipy import sparse as sp
 from scipy.sparse.sputils import IndexMixin
 from ..utils import odict_merge
 
+class BackedArray(object):
+    """
+    Data matrix that stays in an hdf5 file.
+
+    The matrix is either stored as dense dataset `key` or, in CSR format, as
+    the datasets `key + '_sparse_data'` etc. written by readwrite.write.
+    Slicing returns a new BackedArray without reading, to_memory reads only
+    the hyperslabs of the file that are needed for the selected rows and
+    columns.
+    """
+    def __init__(self, filename, key='X', rows=None, cols=None):
+        import h5py
+        self.filename = filename
+        self.key = key
+        with h5py.File(filename, 'r') as f:
+            self.sparse = key not in f
+            if self.sparse:
+                shape_file = tuple(f[key + '_sparse_shape'][()])
+                self.dtype = f[key + '_sparse_data'].dtype
+            else:
+                shape_file = f[key].shape
+                self.dtype = f[key].dtype
+        self.shape_file = shape_file
+        # index arrays into the rows and columns of the file, None means all
+        self.rows = rows
+        self.cols = cols
+        self.shape = tuple(shape_file[i] if idcs is None else idcs.size
+                           for i, idcs in enumerate([rows, cols]))
+        self._indptr = None
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index, slice(None))
+        new = copy(self)
+        new.rows, new.cols = (self._compose(idcs, idx, n) for idcs, idx, n
+                              in zip([self.rows, self.cols], index,
+                                     self.shape_file))
+        new.shape = tuple(self.shape_file[i] if idcs is None else idcs.size
+                          for i, idcs in enumerate([new.rows, new.cols]))
+        return new
+
+    def __setitem__(self, index, value):
+        raise ValueError('X is backed by file {}, call X.to_memory() '
+                         'to modify it'.format(self.filename))
+
+    def __array__(self, dtype=None):
+        X = self.to_memory()
+        if sp.issparse(X):
+            X = X.toarray()
+        return X if dtype is None else X.astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @staticmethod
+    def _compose(idcs, index, n):
+        """
+        Indices into the file of a selection index of the current selection.
+        """
+        if idcs is None:
+            if isinstance(index, slice) and index == slice(None):
+                return None
+            idcs = np.arange(n)
+        index = [index] if isinstance(index, (int, np.integer)) else index
+        return idcs[index]
+
+    @property
+    def indptr(self):
+        """
+        Row pointers of a sparse matrix in the file, loaded once.
+        """
+        if self._indptr is None:
+            import h5py
+            with h5py.File(self.filename, 'r') as f:
+                self._indptr = f[self.key + '_sparse_indptr'][()]
+        return self._indptr
+
+    def to_memory(self):
+        """
+        Read the selected rows and columns into memory.
+
+        Returns
+        -------
+        X : np.ndarray or sp.csr_matrix
+        """
+        import h5py
+        with h5py.File(self.filename, 'r') as f:
+            if self.sparse:
+                return self._read_sparse(f)
+            return self._read_dense(f[self.key])
+
+    def chunks(self, chunk_size=1000):
+        """
+        Iterate over blocks of rows in memory.
+
+        Yields
+        ------
+        X, start, stop : np.ndarray or sp.csr_matrix, int, int
+            The block and its first and last + 1 row.
+        """
+        for start in range(0, self.shape[0], chunk_size):
+            stop = min(start + chunk_size, self.shape[0])
+            yield self[start:stop].to_memory(), start, stop
+
+    def _read_dense(self, dataset):
+        rows, rinv = _hyperslab(self.rows)
+        cols, cinv = _hyperslab(self.cols)
+        # h5py allows a list of indices along a single axis only
+        if isinstance(rows, slice) or isinstance(cols, slice):
+            X = dataset[rows, cols]
+        else:
+            X = dataset[rows][:, cols]
+        if rinv is not None:
+            X = X[rinv]
+        if cinv is not None:
+            X = X[:, cinv]
+        return X
+
+    def _read_sparse(self, f):
+        data = f[self.key + '_sparse_data']
+        indices = f[self.key + '_sparse_indices']
+        indptr = self.indptr
+        if self.rows is None:
+            rows, rinv = np.arange(self.shape_file[0]), None
+        else:
+            rows, rinv = np.unique(self.rows, return_inverse=True)
+        # read each run of consecutive rows as a single hyperslab
+        runs = np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1)
+        slabs = [slice(indptr[run[0]], indptr[run[-1]+1])
+                 for run in runs if run.size > 0]
+        nnz = np.diff(indptr)[rows]
+        X = sp.csr_matrix((np.concatenate([data[s] for s in slabs]
+                                          or [np.zeros(0, data.dtype)]),
+                           np.concatenate([indices[s] for s in slabs]
+                                          or [np.zeros(0, indices.dtype)]),
+                           np.r_[0, np.cumsum(nnz)]),
+                          shape=(rows.size, self.shape_file[1]))
+        if rinv is not None:
+            X = X[rinv]
+        if self.cols is not None:
+            X = X[:, self.cols]
+        return X
+
+def _hyperslab(idcs):
+    """
+    Selection of the hyperslab of the file that contains the indices idcs.
+
+    Returns
+    -------
+    selection : slice or list
+        Slice if idcs are contiguous, otherwise the sorted unique indices.
+    inverse : np.ndarray or None
+        Positions of idcs within the selection, None if idcs is None.
+    """
+    if idcs is None:
+        return slice(None), None
+    if idcs.size == 0:
+        return slice(0, 0), idcs
+    unique, inverse = np.unique(idcs, return_inverse=True)
+    if unique[-1] - unique[0] + 1 == unique.size:
+        return slice(unique[0], unique[-1] + 1), inverse
+    return list(unique), inverse
+
 class StorageType(Enum):
     Array = np.ndarray
     Masked = ma.MaskedArray
     Sparse = sp.spmatrix
+    Backed = BackedArray
 
     @classmethod
     def classes(cls):
@@ -23,105 +187,231 @@ class StorageType(Enum):
 SMP_NAMES = 'smp_names'
 VAR_NAMES = 'var_names'
 
-class BoundRecArr(np.recarray):
+class BoundColumns(object):
     """
-    A np.recarray which can be constructed from a dict.
-    Is bound to AnnData to allow adding fields
+    Columnar store of sample or variable annotation.
+
+    Stores each column as a contiguous array in an ordered dict, together with
+    the column of names `name_col`. Adding a column does not touch the other
+    columns. Indexing with a string returns a column, indexing with an index
+    returns the corresponding rows. Is bound to AnnData.
     """
-    def __new__(cls, source, name_col, parent, n_row=None):
-        if source is None:  # empty array
-            cols = [np.arange(n_row)]
-            dtype = [(name_col, 'int64')]
-        elif isinstance(source, np.recarray):
-            cols = [source[n] for n in source.dtype.names]
-            dtype = source.dtype
+    def __init__(self, source, name_col, parent, n_row=None):
+        self._parent = parent
+        self._name_col = name_col
+        self._name_index = None
+        self._columns = OrderedDict()
+        if source is None:  # only names
+            self._n_row = n_row
+            self._columns[name_col] = np.arange(n_row)
+            return
+        if isinstance(source, BoundColumns):
+            items = list(source.items())
+        elif isinstance(source, np.ndarray) and source.dtype.names is not None:
+            items = [(n, source[n]) for n in source.dtype.names]
+        elif isinstance(source, Mapping):
+            items = list(source.items())
         else:
-            if not isinstance(source, Mapping):
-                raise ValueError(
-                    'meta needs to be a recarray or dictlike, not {}'
-                    .format(type(source)))
-            # meta is dict-like
-            names = list(source.keys())
-            cols = [np.asarray(col) for col in source.values()]
-            if name_col not in source:
-                names.append(name_col)
-                cols.append(np.arange(len(cols[0]) if cols else n_row))
-            dtype = list(zip(names, [str(c.dtype) for c in cols]))
-        try:
-            dtype = np.dtype(dtype)
-        except TypeError:
-            # TODO: fix compat with Python 2
-            # print(dtype, file=sys.stderr)
-            raise
-
-        arr = np.recarray.__new__(cls, (len(cols[0]),), dtype)
-        arr._parent = parent
-        arr._name_col = name_col
-
-        for i, name in enumerate(dtype.names):
-            arr[name] = np.array(cols[i])
-
-        return arr
+            raise ValueError(
+                'meta needs to be a recarray or dictlike, not {}'
+                .format(type(source)))
+        cols = [(k, np.array(v)) for k, v in items]
+        self._n_row = len(cols[0][1]) if cols else n_row
+        if name_col not in dict(cols):
+            cols.append((name_col, np.arange(self._n_row)))
+        for k, v in cols:
+            self._set_column(k, v)
+
+    def _set_column(self, key, value):
+        value = np.asarray(value)
+        if value.ndim != 1 or len(value) != self._n_row:
+            raise ValueError('New column {!r} needs to have {} entries, not {}'
+                             .format(key, self._n_row, len(value)))
+        self._columns[key] = np.ascontiguousarray(value)
+        if key == self._name_col:
+            self._name_index = None
 
     def flipped(self):
         old_name_col = self._name_col
         new_name_col = SMP_NAMES if old_name_col == VAR_NAMES else VAR_NAMES
-
-        flipped = BoundRecArr(self, new_name_col, self._parent, len(self))
-        flipped.dtype.names = tuple(
-            new_name_col if n == old_name_col else n
-            for n in self.dtype.names)
-
-        return flipped
+        source = OrderedDict(
+            (new_name_col if k == old_name_col else k, v)
+            for k, v in self.items())
+        return BoundColumns(source, new_name_col, self._parent)
 
     def copy(self):
-        new = super(BoundRecArr, self).copy()
-        new._name_col = self._name_col
-        new._parent = self._parent
-        return new
+        return BoundColumns(self, self._name_col, self._parent)
 
     @property
     def columns(self):
-        return [c for c in self.dtype.names if not c == self._name_col]
+        return [c for c in self._columns if not c == self._name_col]
+
+    def keys(self):
+        return list(self._columns.keys())
+
+    def values(self):
+        return list(self._columns.values())
+
+    def items(self):
+        return list(self._columns.items())
+
+    @property
+    def name_index(self):
+        """
+        Dict that maps names to positions, built on first access.
+
+        Is invalidated when assigning the names, for duplicate names, it
+        stores the first position. Modifying the names in place requires
+        resetting it via `_name_index = None`.
+        """
+        if self._name_index is None:
+            names = self._columns[self._name_col]
+            self._name_index = dict(zip(names[::-1],
+                                        range(len(names)-1, -1, -1)))
+        return self._name_index
+
+    def __len__(self):
+        return self._n_row
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __getitem__(self, index):
+        if isinstance(index, str):
+            return self._columns[index]
+        # rows
+        source = OrderedDict((k, np.atleast_1d(v[index]))
+                             for k, v in self.items())
+        return BoundColumns(source, self._name_col, self._parent)
 
     def __setitem__(self, keys, values):
         if isinstance(keys, str):
             keys = [keys]
             values = [values]
-        keys = np.array(keys)
-        values = np.array(values)  # sequence of arrays or matrix with n_key *rows*
         if not len(keys) == len(values):
             raise ValueError('You passed {} column keys but {} arrays as columns. '
                              'If you passed a matrix instead of a sequence of arrays, try transposing it.'
                              .format(len(keys), len(values)))
+        for key, value in zip(keys, values):
+            self._set_column(key, value)
+
+    def __delitem__(self, key):
+        if key == self._name_col:
+            raise ValueError('Cannot delete the names {!r}.'.format(key))
+        del self._columns[key]
+
+class BoundMatrices(MutableMapping):
+    """
+    Store of multi-dimensional annotation aligned to the samples or variables.
+
+    Each array has as many rows as there are samples (variables). When
+    subsetting AnnData, the arrays are subset together with X, on first
+    access, see AnnData.__getitem__. Like X, arrays that are sliced with
+    slices are copied then, so that they can be modified.
+    """
+    def __init__(self, parent, n_row, source=None):
+        self._parent = parent
+        self._n_row = n_row
+        self._arrays = OrderedDict()
+        if source is not None:
+            for key, value in source.items():
+                self[key] = value
+
+    def subset(self, parent, index):
+        """
+        Return the store for a subset of rows without slicing the arrays.
+
+        Parameters
+        ----------
+        parent : AnnData
+            The AnnData of the subset.
+        index : slice or np.ndarray
+            Normalized index, see AnnData._normalize_index.
+        """
+        new = BoundMatrices(parent, len(range(self._n_row)[index])
+                            if isinstance(index, slice) else len(index))
+        for key, value in self._arrays.items():
+            if not isinstance(value, _Subset):
+                value = _Subset(value, range(self._n_row))
+            new._arrays[key] = _Subset(value.array,
+                                       _compose_index(value.idx, index))
+        return new
+
+    def __getitem__(self, key):
+        value = self._arrays[key]
+        if isinstance(value, _Subset):
+            idx = value.idx
+            if isinstance(idx, range):
+                idx = slice(idx.start, idx.stop if idx.stop >= 0 else None,
+                            idx.step)
+            array = value.array[idx]
+            if (type(array) == np.ndarray
+                and np.may_share_memory(array, value.array)):
+                array = array.copy()
+            self._arrays[key] = value = array
+        return value
+
+    def __setitem__(self, key, value):
+        if value.shape[0] != self._n_row:
+            raise ValueError('Array {!r} needs to have {} rows, not {}'
+                             .format(key, self._n_row, value.shape[0]))
+        self._arrays[key] = value
+
+    def __delitem__(self, key):
+        del self._arrays[key]
+
+    def __iter__(self):
+        return iter(self._arrays)
 
-        present = np.intersect1d(keys, self.dtype.names)
-        absent = np.setdiff1d(keys, self.dtype.names)
+    def __len__(self):
+        return len(self._arrays)
 
-        if any(present):
-            for k, v in zip(present, values[np.in1d(keys, present)]):
-                super(BoundRecArr, self).__setitem__(k, v)
+_Subset = namedtuple('_Subset', ['array', 'idx'])
 
-        if any(absent):
-            attr = 'smp' if self._name_col == SMP_NAMES else 'var'
-            if values.shape[1] > len(self):
-                raise ValueError('New column has too many entries ({} > {})'
-                                 .format(values.shape[1], len(self)))
-            source = append_fields(self, absent, values[np.in1d(keys, absent)],
-                                   usemask=False, asrecarray=True)
-            new = BoundRecArr(source, self._name_col, self._parent)
-            setattr(self._parent, attr, new)
+def _compose_index(idx, index):
+    """
+    Compose the index of a view into its parent with an index into the view.
+
+    Parameters
+    ----------
+    idx : range or np.ndarray
+        Index of the view into its parent.
+    index : slice or np.ndarray
+        Normalized index into the view, see AnnData._normalize_index.
+
+    Returns
+    -------
+    idx : range or np.ndarray
+        Index into the parent, a range as long as all indices are slices.
+    """
+    if isinstance(index, slice):
+        return idx[index]
+    return np.asarray(idx)[index]
+
+def _subset(X, oidx, vidx):
+    """
+    Subset X with indices returned by _compose_index.
+    """
+    oidx, vidx = (slice(idx.start, idx.stop if idx.stop >= 0 else None,
+                        idx.step) if isinstance(idx, range) else idx
+                  for idx in [oidx, vidx])
+    if isinstance(oidx, np.ndarray) and isinstance(vidx, np.ndarray):
+        return X[oidx][:, vidx]
+    return X[oidx, vidx]
 
 def _check_dimensions(data, smp, var):
     n_smp, n_var = data.shape
     if len(smp) != n_smp:
         raise ValueError('Sample metadata needs to have the same amount of '
                          'rows as data has ({}), but has {} rows'
-                         .format(n_smp, smp.shape[0]))
+                         .format(n_smp, len(smp)))
     if len(var) != n_var:
         raise ValueError('Feature metadata needs to have the same amount of '
                          'rows as data has columns ({}), but has {} rows'
-                         .format(n_var, var.shape[0]))
+                         .format(n_var, len(var)))
 
 class AnnData(IndexMixin):
     def __init__(self, ddata_or_X=None, smp=None, var=None, **add):
@@ -139,10 +429,11 @@ class AnnData(IndexMixin):
 
         Parameters
         ----------
-        ddata_or_X : dict, np.ndarray, np.ma.MaskedArray, sp.spmatrix
+        ddata_or_X : dict, np.ndarray, np.ma.MaskedArray, sp.spmatrix, BackedArray
             The data matrix or a dict containing the data matrix and possibly
-            X : np.ndarray, np.ma.MaskedArray, sp.spmatrix
-                A n_samples x n_variables data matrix.
+            X : np.ndarray, np.ma.MaskedArray, sp.spmatrix, BackedArray
+                A n_samples x n_variables data matrix. A BackedArray stays in
+                an hdf5 file, see readwrite.read with backed=True.
             row_names / smp_names : list, np.ndarray, optional
                 A n_samples array storing names for samples.
             col_names / var_names : list, np.ndarray, optional
@@ -151,20 +442,29 @@ class AnnData(IndexMixin):
                 A dict with row annotation.
             col / var : dict, optional
                 A dict with row annotation.
-        smp : np.recarray, dict
-            A n_samples x ? record array containing sample names (`smp_names`)
-            and other sample annotation in the columns. A passed dict is
-            converted to a record array.
-        var : np.recarray, dict
+        smp : dict, np.recarray
+            A dict with n_samples arrays storing sample names (`smp_names`) and
+            other sample annotation in the columns. It is converted to a
+            BoundColumns store.
+        var : dict, np.recarray
             The same as `smp`, but of shape n_variables x ? for annotation of
             variables.
         **add : dict
-            Unstructured annotation for the whole dataset.
+            Unstructured annotation for the whole dataset. Arrays with keys
+            'X_...' and n_samples rows, such as 'X_pca', and arrays with keys
+            '..._masks' and n_samples columns are stored in smpm instead.
 
         Attributes
         ----------
         X, smp, var from the Parameters.
+        smpm, varm : BoundMatrices
+            Multi-dimensional annotation of samples and variables, such as
+            embeddings. Is subset together with X.
+
+        Subsetting an AnnData returns a view, see __getitem__.
         """
+        # X of the parent of a view, see __getitem__
+        self._X_parent = None
         if isinstance(ddata_or_X, Mapping):
             if any((smp, var, add)):
                 raise ValueError('If ddata_or_X is a dict, it needs to contain all metadata')
@@ -193,12 +493,24 @@ class AnnData(IndexMixin):
 
         self.X = X
 
-        self.smp = BoundRecArr(smp, SMP_NAMES, self, n_smp)
-        self.var = BoundRecArr(var, VAR_NAMES, self, n_var)
+        self.smp = BoundColumns(smp, SMP_NAMES, self, n_smp)
+        self.var = BoundColumns(var, VAR_NAMES, self, n_var)
 
         _check_dimensions(X, self.smp, self.var)
 
-        self.add = add
+        self.smpm = BoundMatrices(self, n_smp)
+        self.varm = BoundMatrices(self, n_var)
+        self.add = {}
+        # keys of arrays that have been stored in smpm and varm, see to_ddata
+        smpm_keys = set(add.pop('smpm_keys', []))
+        varm_keys = set(add.pop('varm_keys', []))
+        for key, value in add.items():
+            if key in varm_keys:
+                self.varm[key] = value
+            elif key in smpm_keys and not self._is_smpm_key(key, value):
+                self.smpm[key] = value
+            else:
+                self[key] = value
 
     def from_ddata(self, ddata):
         smp, var = OrderedDict(), OrderedDict()
@@ -238,13 +550,86 @@ class AnnData(IndexMixin):
              'smp_names': self.smp_names, 'var_names': self.var_names}
         for k, v in self.add.items():
             d[k] = v
+        for k in self.smpm.keys():
+            d[k] = self[k]
+        if len(self.smpm) > 0:
+            d['smpm_keys'] = np.array(list(self.smpm.keys()))
+        for k in self.varm.keys():
+            d[k] = self.varm[k]
+        if len(self.varm) > 0:
+            d['varm_keys'] = np.array(list(self.varm.keys()))
         return d
 
+    @property
+    def X(self):
+        """
+        Data matrix of shape n_samples x n_variables.
+
+        For a view, X is computed from the parent on first access. If it is a
+        slice of the parent's array, it is copied then, so that modifying it
+        does not modify the parent.
+        """
+        if self._X is None:
+            X = _subset(self._X_parent, self._oidx, self._vidx)
+            if (type(X) == np.ndarray
+                and np.may_share_memory(X, self._X_parent)):
+                X = X.copy()
+            self._X = X
+        return self._X
+
+    @X.setter
+    def X(self, value):
+        # assigning X turns a view into an actual AnnData
+        self._X = value
+        self._X_parent = None
+
+    @property
+    def isview(self):
+        """
+        Whether X is derived from the X of a parent AnnData, see __getitem__.
+        """
+        return self._X_parent is not None
+
+    def _init_as_actual(self):
+        """
+        Turn a view into an actual AnnData, X never shares memory with the
+        parent's X.
+        """
+        self.X = self.X
+
+    @property
+    def isbacked(self):
+        """
+        Whether X stays in an hdf5 file, see BackedArray.
+        """
+        # does not compute the X of a view
+        X = self._X_parent if self._X is None else self._X
+        return isinstance(X, BackedArray)
+
+    def chunked_X(self, chunk_size=1000):
+        """
+        Iterate over blocks of rows of X in memory.
+
+        For backed X, only one block is read from the file at a time.
+
+        Yields
+        ------
+        X, start, stop : np.ndarray or sp.spmatrix, int, int
+            The block and its first and last + 1 row.
+        """
+        if self.isbacked:
+            for chunk in self.X.chunks(chunk_size):
+                yield chunk
+            return
+        for start in range(0, self.X.shape[0], chunk_size):
+            stop = min(start + chunk_size, self.X.shape[0])
+            yield self.X[start:stop], start, stop
+
     def smp_keys(self):
-        return [n for n in self.smp.dtype.names if n != SMP_NAMES]
+        return self.smp.columns
 
     def var_keys(self):
-        return [n for n in self.var.dtype.names if n != VAR_NAMES]
+        return self.var.columns
 
     @property
     def smp_names(self):
@@ -264,27 +649,27 @@ class AnnData(IndexMixin):
 
     def __setattr__(self, key, value):
         names_col = dict(smp=SMP_NAMES, var=VAR_NAMES).get(key)
-        if names_col and not isinstance(value, BoundRecArr):  # if smp/var is set, give it the right class
+        if names_col and not isinstance(value, BoundColumns):  # if smp/var is set, give it the right class
             names_orig, dim = (self.smp_names, 0) if names_col == SMP_NAMES else (self.var_names, 1)
-            value_orig, value = value, BoundRecArr(value, names_col, self)
-            if len(value) != self.X.shape[dim]:
+            value_orig, value = value, BoundColumns(value, names_col, self)
+            if len(value) != len(self.smp if dim == 0 else self.var):
                 raise ValueError('New value for {!r} was converted to a reacarray of length {} instead of {}'
                                  .format(key, len(value_orig), len(self)))
-            if (value[names_col] == np.arange(self.X.shape[dim])).all():  # TODO: add to constructor
+            if (value[names_col] == np.arange(len(value))).all():  # TODO: add to constructor
                 value[names_col] = names_orig
         object.__setattr__(self, key, value)
 
     def _normalize_indices(self, packed_index):
         smp, var = super(AnnData, self)._unpack_index(packed_index)
-        smp = self._normalize_index(smp, self.smp_names)
-        var = self._normalize_index(var, self.var_names)
+        smp = self._normalize_index(smp, self.smp)
+        var = self._normalize_index(var, self.var)
         return smp, var
 
-    def _normalize_index(self, index, names):
+    def _normalize_index(self, index, ann):
         def name_idx(i):
             if isinstance(i, str):
-                # `where` returns an 1-tuple (1D array) of found indices
-                i = np.where(names == i)[0][0]
+                # look up in the hash index of names
+                i = ann.name_index.get(i)
                 if i is None:
                     raise IndexError('Index {} not in smp_names/var_names'
                                      .format(index))
@@ -301,8 +686,12 @@ class AnnData(IndexMixin):
             start = name_idx(index)
             stop = start + 1
             step = 1
+        elif isinstance(index, np.ndarray) and index.dtype == bool:
+            return np.flatnonzero(index)
+        elif isinstance(index, np.ndarray) and index.dtype.kind in 'iu':
+            return index.astype('int64')
         elif isinstance(index, (Sequence, np.ndarray)):
-            return np.fromiter(map(name_idx, index), 'int64')
+            return np.fromiter(map(name_idx, index), 'int64', len(index))
         else:
             raise IndexError('Unknown index {!r} of type {}'
                              .format(index, type(index)))
@@ -318,38 +707,93 @@ class AnnData(IndexMixin):
             del self.var.iloc[var, :]
 
     def __getitem__(self, index):
+        """
+        Return an element of add for a string, otherwise a view.
+
+        The view does not copy X. It is sliced from the X of the parent on
+        first access, or from that of the first actual AnnData for views of
+        views. If the indices are slices, the sliced X is copied, so modifying
+        the view's X never modifies the parent. Assigning X or elements of the
+        view via __setitem__ turns the view into an actual AnnData.
+        """
         # return element from add if index is string
         if isinstance(index, str):
+            if index in self.smpm:
+                value = self.smpm[index]
+                # masks are stored with samples as rows
+                return value.T if index.endswith('_masks') else value
             return self.add[index]
         # otherwise unpack index
         smp, var = self._normalize_indices(index)
-        X = self.X[smp, var]
-        smp_ann = self.smp[smp]
-        var_ann = self.var[var]
-        assert smp_ann.shape[0] == X.shape[0], (smp, smp_ann)
-        assert var_ann.shape[0] == X.shape[1], (var, var_ann)
-        adata = AnnData(X, smp_ann, var_ann,  **self.add)
+        if self.isview:
+            X_parent = self._X_parent
+            oidx = _compose_index(self._oidx, smp)
+            vidx = _compose_index(self._vidx, var)
+        else:
+            X_parent = self.X
+            oidx = _compose_index(range(X_parent.shape[0]), smp)
+            vidx = _compose_index(range(X_parent.shape[1]), var)
+        adata = object.__new__(AnnData)
+        adata.storage_type = self.storage_type
+        adata._X_parent = X_parent
+        adata._X = None
+        adata._oidx, adata._vidx = oidx, vidx
+        adata.smp = BoundColumns(self.smp[smp], SMP_NAMES, adata)
+        adata.var = BoundColumns(self.var[var], VAR_NAMES, adata)
+        adata.smpm = self.smpm.subset(adata, smp)
+        adata.varm = self.varm.subset(adata, var)
+        adata.add = dict(self.add)
         return adata
 
     def __setitem__(self, index, val):
         if isinstance(index, str):
-            self.add[index] = val
+            if self._is_smpm_key(index, val):
+                self.add.pop(index, None)
+                self.smpm[index] = val.T if index.endswith('_masks') else val
+            else:
+                self.smpm.pop(index, None)
+                self.add[index] = val
             return
 
         smp, var = self._normalize_indices(index)
+        if self.isview:
+            self._init_as_actual()
         self.X[smp, var] = val
 
+    def _is_smpm_key(self, key, value):
+        """
+        Whether value is aligned to the samples and stored in smpm.
+        """
+        if not hasattr(value, 'shape'):
+            return False
+        n_smp = len(self.smp)
+        if key.startswith('X_'):
+            return len(value.shape) > 0 and value.shape[0] == n_smp
+        if key.endswith('_masks'):
+            return len(value.shape) == 2 and value.shape[1] == n_smp
+        # arrays that have been stored in smpm directly remain there
+        if key in self.smpm:
+            return len(value.shape) > 0 and value.shape[0] == n_smp
+        return False
+
     def __contains__(self, item):
-        return item in self.add
+        return item in self.add or item in self.smpm
 
     def get(self, key, default=None):
-        return self.add.get(key, default)
+        return self[key] if key in self else default
 
     def __len__(self):
-        return self.X.shape[0]
+        return len(self.smp)
 
     def transpose(self):
-        return AnnData(self.X.T, self.var.flipped(), self.smp.flipped(), **self.add)
+        if self.isbacked:
+            raise ValueError('Cannot transpose backed X, call '
+                             'AnnData(adata.X.to_memory(), ...) first.')
+        adata = AnnData(self.X.T, self.var.flipped(), self.smp.flipped(),
+                        **self.add)
+        adata.smpm = BoundMatrices(adata, len(self.var), self.varm)
+        adata.varm = BoundMatrices(adata, len(self.smp), self.smpm)
+        return adata
 
     T = property(transpose)
 
@@ -415,6 +859,21 @@ def test_get_subset_names():
     with raises(IndexError): _ = mat['A':'X', :]
     with raises(IndexError): _ = mat[:, 'a':'X']
 
+def test_name_index():
+    mat = AnnData(
+        np.array([[1, 2, 3], [4, 5, 6]]),
+        dict(smp_names=['A', 'B']),
+        dict(var_names=['a', 'b', 'a']))
+
+    assert mat.var.name_index == {'a': 0, 'b': 1}
+    assert mat[:, ['b', 'a']].X.tolist() == [[2, 1], [5, 4]]
+
+    mat.var_names = ['c', 'b', 'd']
+    assert mat[:, 'd'].X.tolist() == [[3], [6]]
+
+    from pytest import raises
+    with raises(IndexError): _ = mat[:, 'a']
+
 def test_transpose():
     mat = AnnData(
         np.array([[1, 2, 3], [4, 5, 6]]),
@@ -427,16 +886,17 @@ def test_transpose():
     assert mat.smp_names.tolist() == ['A', 'B']
     assert mat.var_names.tolist() == ['a', 'b', 'c']
 
-    assert SMP_NAMES in mt1.smp.dtype.names
-    assert VAR_NAMES in mt1.var.dtype.names
+    assert SMP_NAMES in mt1.smp.keys()
+    assert VAR_NAMES in mt1.var.keys()
     assert mt1.smp_names.tolist() == ['a', 'b', 'c']
     assert mt1.var_names.tolist() == ['A', 'B']
     assert mt1.X.shape == mat.X.T.shape
 
     mt2 = mat.transpose()
     assert np.array_equal(mt1.X, mt2.X)
-    assert np.array_equal(mt1.smp, mt2.smp)
-    assert np.array_equal(mt1.var, mt2.var)
+    for ann1, ann2 in [(mt1.smp, mt2.smp), (mt1.var, mt2.var)]:
+        assert ann1.keys() == ann2.keys()
+        assert all(np.array_equal(ann1[k], ann2[k]) for k in ann1.keys())
 
 def test_get_subset_add():
     mat = AnnData(np.array([[1, 2, 3], [4, 5, 6]]),
@@ -460,14 +920,93 @@ def test_set_add():
     mat = AnnData(np.array([[1, 2, 3], [4, 5, 6]]))
 
     mat.smp = dict(smp_names=[1, 2])
-    assert isinstance(mat.smp, BoundRecArr)
-    assert len(mat.smp.dtype) == 1
+    assert isinstance(mat.smp, BoundColumns)
+    assert len(mat.smp.keys()) == 1
 
     mat.smp = dict(a=[1, 2])  # leave smp_names and a custom column
-    assert isinstance(mat.smp, BoundRecArr)
-    assert len(mat.smp.dtype) == 2
+    assert isinstance(mat.smp, BoundColumns)
+    assert len(mat.smp.keys()) == 2
     assert mat.smp_names.tolist() == [1, 2]
 
     from pytest import raises
     with raises(ValueError):
         mat.smp = dict(a=[1, 2, 3])
+
+def test_view():
+    X = np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+    mat = AnnData(X, dict(Smp=['A', 'B', 'C']))
+
+    view = mat[1:, :2]
+    assert view.isview
+    assert view.X.tolist() == [[4, 5], [7, 8]]
+    assert not np.may_share_memory(view.X, mat.X)
+    assert view[:, 1:].X.tolist() == [[5], [8]]
+    assert view[[1, 0], :].X.tolist() == [[7, 8], [4, 5]]
+    assert view[[1, 0], :].smp['Smp'].tolist() == ['C', 'B']
+
+    view[0, 0] = 0
+    assert not view.isview
+    assert view.X.tolist() == [[0, 5], [7, 8]]
+    assert mat.X[1, 0] == 4
+
+    # in-place operations on the X of a view do not modify the parent
+    view = mat[1:3, :]
+    view.X *= 2
+    assert view.X.tolist() == [[8, 10, 12], [14, 16, 18]]
+    assert mat.X[1:].tolist() == [[4, 5, 6], [7, 8, 9]]
+
+def test_smpm():
+    mat = AnnData(np.array([[1, 2], [3, 4], [5, 6]]),
+                  X_pca=np.array([[1], [2], [3]]), k=1)
+    mat['groups_masks'] = np.array([[True, False, True], [False, True, False]])
+    assert list(mat.smpm.keys()) == ['X_pca', 'groups_masks']
+    assert list(mat.add.keys()) == ['k']
+
+    sub = mat[[2, 0], :]
+    assert sub['X_pca'].tolist() == [[3], [1]]
+    assert sub['groups_masks'].tolist() == [[True, True], [False, False]]
+    assert mat[1:, :][1:, :]['X_pca'].tolist() == [[3]]
+    sub = mat[1:, :]
+    sub['X_pca'][0] = 0
+    assert sub['X_pca'].tolist() == [[0], [3]]
+    assert mat['X_pca'].tolist() == [[1], [2], [3]]
+
+    from pytest import raises
+    with raises(ValueError):
+        mat.smpm['X_tsne'] = np.zeros((2, 2))
+
+    mat.smpm['evecs'] = np.array([[1, 0], [0, 1], [1, 1]])
+    assert mat[[2], :]['evecs'].tolist() == [[1, 1]]
+    mat.varm['loadings'] = np.array([[1, 2, 3], [4, 5, 6]])
+    copy = AnnData(mat.to_ddata())
+    assert list(copy.smpm.keys()) == ['X_pca', 'groups_masks', 'evecs']
+    assert list(copy.varm.keys()) == ['loadings']
+    assert copy.varm['loadings'].tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert list(copy.add.keys()) == ['k']
+
+def test_backed(tmpdir):
+    from ..readwrite import write_dict_to_file, read_file_to_dict
+    X = np.arange(12, dtype=float).reshape(4, 3)
+    for X_file in [X, sp.csr_matrix(X)]:
+        filename = str(tmpdir.join('backed.h5'))
+        write_dict_to_file(filename, {'X': X_file})
+        adata = AnnData(read_file_to_dict(filename, backed=True))
+        assert adata.isbacked
+        assert adata.X.shape == (4, 3)
+        sub = adata[[3, 1], 1:]
+        assert sub.isbacked
+        assert np.array(sub.X).tolist() == X[[3, 1], 1:].tolist()
+        assert np.array(sub[1:, [1, 0]].X).tolist() == [[5, 4]]
+        chunks = [np.array(block).tolist() if isinstance(block, np.ndarray)
+                  else block.toarray().tolist()
+                  for block, _, _ in adata.chunked_X(3)]
+        assert chunks == [X[:3].tolist(), X[3:].tolist()]
+        # a subset is streamed into another file, the backing file itself is
+        # overwritten from memory
+        for target, adata_write, X_write in [('sub.h5', sub, X[[3, 1], 1:]),
+                                             ('backed.h5', adata, X)]:
+            target = str(tmpdir.join(target))
+            write_dict_to_file(target, adata_write.to_ddata())
+            X_read = read_file_to_dict(target)['X']
+            assert type(X_read) == type(X_file)
+            assert sp.csr_matrix(X_read).toarray().tolist() == X_write.tolist()
@@ -3,8 +3,13 @@
 Data Graph
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from threading import Lock
 import numpy as np
 import scipy as sp
+import scipy.sparse.linalg
 from .. import settings as sett
 from .. import plotting as plott
 from .. import utils
@@ -19,6 +24,8 @@ class DataGraph(object):
         """ 
         """
         isadata = isinstance(adata_or_X, AnnData)
+        # adata serves as cache for neighbors and kernel matrices
+        self.adata = adata_or_X if isadata else None
         if isadata:
             adata = adata_or_X
             X = adata_or_X.X
@@ -28,6 +35,7 @@ class DataGraph(object):
         if (params['n_pcs_pre'] == 0
             or X.shape[1] < params['n_pcs_pre']):
             self.X = X
+            self.rep = 'X'
             sett.m(0, '... using X for building graph')
             if 'xroot' in adata:
                 self.set_root(adata['xroot'])
@@ -39,6 +47,7 @@ class DataGraph(object):
                 self.X = adata.X
                 self.set_root(adata['xroot'])
             self.X = adata['X_pca']
+            self.rep = 'X_pca'
             if 'xroot' in adata and adata['xroot'].size == adata['X_pca'].shape[1]:
                 self.set_root(adata['xroot'])
         else:
@@ -49,11 +58,15 @@ class DataGraph(object):
                 self.set_root(adata['xroot'])
             from ..preprocess import pca
             self.X = pca(X, n_comps=params['n_pcs_pre'])
+            self.rep = 'X_pca'
             adata['X_pca'] = self.X
             if (isadata
                 and 'xroot' in adata
                 and adata['xroot'].size == adata['X_pca'].shape[1]):
                 self.set_root(adata['xroot'])
+        # distances, kernels and eigenvectors inherit the dtype of X
+        if isinstance(self.X, np.ndarray):
+            self.X = np.ascontiguousarray(self.X, dtype=sett.dtype)
         self.params = params
         if self.params['sigma'] > 0:
             self.params['method'] = 'global'
@@ -68,7 +81,8 @@ class DataGraph(object):
         sett.mt(0, 'start computing Diffusion Map with method',
                  '"'+self.params['method']+'"')
         self.compute_transition_matrix()
-        self.embed()
+        # the first eigenvector is skipped
+        self.embed(number=self.params.get('n_comps', 9) + 1)
         # write results to dictionary
         ddmap = {}
         # skip the first eigenvalue/eigenvector
@@ -85,8 +99,11 @@ class DataGraph(object):
         self.compute_L_matrix()
         self.embed(self.L, number=num_evals, sort='increase')
         evalsL = self.evals
-        self.compute_Lp_matrix()
-        self.compute_C_matrix()
+        if sp.sparse.issparse(self.L):
+            self.compute_C_lowrank()
+        else:
+            self.compute_Lp_matrix()
+            self.compute_C_matrix()
 
     def spec_layout(self):
         """
@@ -123,43 +140,74 @@ class DataGraph(object):
         Coifman et al. (2005).
         """
         import scipy.sparse
+        # the parameters of the kernel enter the key of cached eigenvectors
+        self.kernel_params = (weighted, neglect_selfloops, alpha)
         # compute distance matrix in squared Euclidian norm
-        if self.X.shape[0] > 5000 and self.params['method'] == 'local' and self.params['knn']:
-            sett.m(0, '... using sparse format')
-            from sklearn.neighbors import NearestNeighbors
-            # don't use metric = sqeuclidian, because this requires choosing algorithm 'brute'
-            sklearn_neighbors = NearestNeighbors(n_neighbors=self.params['k']-1)
-            sklearn_neighbors.fit(self.X)
-            Dsq = sklearn_neighbors.kneighbors_graph(mode='distance')
-            Dsq.data **= 2
+        nn_method = self.params.get('nn_method', 'exact')
+        nn_trees = self.params.get('nn_trees', 10)
+        n = self.X.shape[0]
+        # the dense computation holds K, Ktilde and the boolean neighbor mask
+        # and its transpose, the distance matrix is transformed into K in place
+        dense_memory = self.estimate_dense_memory(2.25)
+        if (self.params['method'] == 'local' and self.params['knn']
+            and (dense_memory > sett.max_memory or nn_method != 'exact')):
+            sett.m(0, '... using sparse format, dense format would require',
+                   '{:.2f} GB'.format(dense_memory))
+            k = self.params['k']
+            # reuse the kernel matrix if it has been computed before
+            kernel_key = utils.fingerprint(self.X, k, nn_method, nn_trees,
+                                           weighted, neglect_selfloops, alpha)
+            if (self.adata is not None
+                and str(self.adata.get('kernel_key')) == kernel_key
+                and 'kernel_sigmas_sq' in self.adata):
+                sett.m(0, '... reusing kernel matrix cached in adata')
+                self.K = self.adata['kernel_K']
+                self.sigmas_sq = self.adata['kernel_sigmas_sq']
+                self.q = self.adata['kernel_q']
+                self.alpha = alpha
+                self.compute_Ktilde_matrix()
+                return
+            # for many points and data of low intrinsic dimension, exact
+            # search in trees is faster than exact search in tiles
+            indices, distances_sq = utils.comp_neighbors_cached(
+                self.adata, self.X, k-1, metric='sqeuclidean',
+                method='kdtree' if nn_method == 'exact' else nn_method,
+                n_trees=nn_trees)
+            if nn_method != 'exact':
+                self.nn_recall = utils.estimate_neighbors_recall(self.X, indices)
+                sett.m(0, '... estimated recall of approximate nearest neighbors',
+                       '{:.3f}'.format(self.nn_recall))
+            Dsq = sp.sparse.csr_matrix((distances_sq.astype(sett.dtype).ravel(),
+                                        indices.flatten(),
+                                        np.arange(0, n*(k-1)+1, k-1)),
+                                       shape=(n, n))
         else:
-            sklearn_neighbors = None
+            sett.m(0, '... using dense format, estimated peak memory',
+                   '{:.2f} GB'.format(dense_memory))
+            if dense_memory > sett.max_memory:
+                sett.m(0, '--> exceeds sett.max_memory = {} GB, consider '
+                       'setting knn = True'.format(sett.max_memory))
+            indices = None
             Dsq = utils.comp_distance(self.X, metric='sqeuclidean')
-        self.Dsq = Dsq
         if self.params['method'] == 'local':
             # choose sigma (width of a Gaussian kernel) according to the
             # distance of the kth nearest neighbor of each point, including the
             # point itself in the count
             k = self.params['k']
-            if sklearn_neighbors is None:
-                # deterimine the distance of the k nearest neighbors
-                indices = np.zeros((Dsq.shape[0], k), dtype=np.int_)
-                distances_sq = np.zeros((Dsq.shape[0], k), dtype=np.float_)
-                for irow, row in enumerate(Dsq):
-                    # the last item is already in its sorted position as
-                    # argpartition puts the (k-1)th element - starting to count from
-                    # zero - in its sorted position
-                    idcs = np.argpartition(row, k-1)[:k]
-                    indices[irow] = idcs
-                    argsort = np.argsort(row[idcs])
-                    distances_sq[irow] = row[idcs][argsort]
-                    indices[irow] = indices[irow][argsort]
-                # exclude the point itself
-                distances_sq = distances_sq[:, 1:]
-                indices = indices[:, 1:]
-            else:
-                distances_sq, indices = sklearn_neighbors.kneighbors()
-                distances_sq **= 2
+            if indices is None:
+                # determine the k nearest neighbors, excluding the point
+                # itself, from the rows of Dsq
+                n = Dsq.shape[0]
+                indices = np.zeros((n, k-1), dtype=np.int_)
+                distances_sq = np.zeros((n, k-1), dtype=Dsq.dtype)
+                for rows in self._dense_blocks():
+                    D = Dsq[rows]
+                    irows = np.arange(D.shape[0])
+                    # the diagonal is restored below
+                    D[irows, irows + rows.start] = np.inf
+                    indices[rows] = np.argpartition(D, k-2, axis=1)[:, :k-1]
+                    distances_sq[rows] = D[irows[:, np.newaxis], indices[rows]]
+                    D[irows, irows + rows.start] = 0
 
             # choose sigma, the heuristic here often makes not much 
             # of a difference, but is used to reproduce the figures
@@ -179,44 +227,55 @@ class DataGraph(object):
             sigmas = self.params['sigma'] * np.ones(self.X.shape[0])
             sigmas_sq = sigmas**2
 
+        # the kernel widths and the densities q are needed to extend the
+        # kernel to new data points, see project
+        self.sigmas_sq = sigmas_sq
+        self.alpha = alpha
+
         # compute the symmetric weight matrix
-        if not sp.sparse.issparse(self.Dsq):
-            Num = 2 * np.multiply.outer(sigmas, sigmas)
-            Den = np.add.outer(sigmas_sq, sigmas_sq)
-            W = np.sqrt(Num/Den) * np.exp(-Dsq/Den)
+        if not sp.sparse.issparse(Dsq):
+            # transform Dsq into W in place, in blocks of rows to bound the
+            # memory of the temporary arrays
+            W = Dsq
+            for rows in self._dense_blocks():
+                Num = 2 * np.multiply.outer(sigmas[rows], sigmas)
+                Den = np.add.outer(sigmas_sq[rows], sigmas_sq)
+                W[rows] = np.sqrt(Num/Den) * np.exp(-W[rows]/Den)
+            del Dsq
             # make the weight matrix sparse
             if not self.params['knn']:
                 self.Mask = W > 1e-14
-                W[self.Mask == False] = 0
+                W[~self.Mask] = 0
             else:
                 # restrict number of neighbors to ~k
                 # build a symmetric mask
-                Mask = np.zeros(Dsq.shape, dtype=bool)
-                for i, row in enumerate(indices):
-                    Mask[i, row] = True
-                    for j in row:
-                        if i not in set(indices[j]):
-                            W[j, i] = W[i, j]
-                            Mask[j, i] = True
+                Mask = np.zeros(W.shape, dtype=bool)
+                Mask[np.arange(W.shape[0])[:, np.newaxis], indices] = True
+                Mask |= Mask.T
                 # set all entries that are not nearest neighbors to zero
-                W[Mask == False] = 0
+                W[~Mask] = 0
                 self.Mask = Mask
             if not weighted:
-                W = Mask.astype(float)
+                W[:] = self.Mask
         else:
-            W = Dsq
-            for i in range(len(Dsq.indptr[:-1])):
-                row = Dsq.indices[Dsq.indptr[i]: Dsq.indptr[i+1]]
-                num = 2 * sigmas[i] * sigmas[row]
-                den = sigmas_sq[i] + sigmas_sq[row]
-                W.data[Dsq.indptr[i]: Dsq.indptr[i+1]] = np.sqrt(num/den) * np.exp(-Dsq.data[Dsq.indptr[i]: Dsq.indptr[i+1]] / den)
-            W = W.tolil()
-            for i, row in enumerate(indices):
-                for j in row:
-                    if i not in set(indices[j]):
-                        W[j, i] = W[i, j]
-            W = W.tocsr()
-                        
+            # row and column indices of the non-zero entries
+            rows = np.repeat(np.arange(Dsq.shape[0]), np.diff(Dsq.indptr))
+            cols = Dsq.indices
+            num = 2 * sigmas[rows] * sigmas[cols]
+            den = sigmas_sq[rows] + sigmas_sq[cols]
+            W = Dsq.copy()
+            W.data = (np.sqrt(num/den) * np.exp(-Dsq.data / den)).astype(
+                sett.dtype, copy=False)
+            # symmetrize: add the transposed entries W[j, i] = W[i, j] for all
+            # neighbors j of i that do not have i as a neighbor, the entries
+            # present in both directions remain untouched
+            Mask = W.copy()
+            Mask.data = np.ones_like(Mask.data)
+            W_T = W.T.tocsr()
+            W_T_only = W_T - W_T.multiply(Mask)
+            W_T_only.eliminate_zeros()
+            W = (W + W_T_only).tocsr()
+            W.sort_indices()
         sett.mt(0, 'computed W (weight matrix) with "knn" =', self.params['knn'])
 
         # neglect self-loops
@@ -238,41 +297,58 @@ class DataGraph(object):
         if alpha == 0:
             # nothing happens here, simply use the isotropic similarity matrix
             self.K = W
+            self.q = np.ones(W.shape[0])
         else:
             # q[i] is an estimate for the sampling density at point x_i
             # it's also the degree of the underlying graph
             if not sp.sparse.issparse(W):
-                q = np.sum(W, axis=0)
+                q = np.sum(W, axis=0, dtype=np.float64)
                 # raise to power alpha
                 if alpha != 1: 
                     q = q**alpha
-                Den = np.outer(q, q)
-                self.K = W / Den
-            else:
-                q = np.array(np.sum(W, axis=0)).flatten()
+                # normalize in place
+                for rows in self._dense_blocks():
+                    W[rows] /= np.outer(q[rows], q)
                 self.K = W
-                for i in range(len(W.indptr[:-1])):
-                    row = W.indices[W.indptr[i]: W.indptr[i+1]]
-                    num = q[i] * q[row]
-                    W.data[W.indptr[i]: W.indptr[i+1]] = W.data[W.indptr[i]: W.indptr[i+1]] / num
+            else:
+                q = np.array(W.sum(axis=0, dtype=np.float64)).flatten()
+                if alpha != 1:
+                    q = q**alpha
+                rows = np.repeat(np.arange(W.shape[0]), np.diff(W.indptr))
+                self.K = W.copy()
+                self.K.data /= q[rows] * q[W.indices]
+            self.q = q
         sett.mt(0,'computed K (anisotropic kernel)')
         if False:
             pl.matshow(self.K)
             pl.title('$ K$')
             pl.colorbar()
 
+        if sp.sparse.issparse(self.K) and self.adata is not None:
+            self.adata['kernel_key'] = kernel_key
+            self.adata['kernel_K'] = self.K
+            self.adata['kernel_sigmas_sq'] = self.sigmas_sq
+            self.adata['kernel_q'] = self.q
+        self.compute_Ktilde_matrix()
+
+    def compute_Ktilde_matrix(self):
+        """
+        Compute the density-normalized kernel Ktilde from K.
+
+        Also computes the density z and its square root sqrtz.
+        """
         if not sp.sparse.issparse(self.K):
-            # now compute the row normalization to build the transition matrix T
-            # and the adjoint Ktilde: both have the same spectrum
-            self.z = np.sum(self.K, axis=0)
-            # the following is the transition matrix
-            self.T = self.K / self.z[:, np.newaxis]
+            # now compute the row normalization: the transition matrix T and
+            # the adjoint Ktilde have the same spectrum
+            self.z = np.sum(self.K, axis=0, dtype=np.float64)
             # now we need the square root of the density
             self.sqrtz = np.array(np.sqrt(self.z))
             # now compute the density-normalized Kernel
             # it's still symmetric
-            szszT = np.outer(self.sqrtz, self.sqrtz)
-            self.Ktilde = self.K / szszT
+            self.Ktilde = np.empty_like(self.K)
+            for rows in self._dense_blocks():
+                self.Ktilde[rows] = (self.K[rows]
+                                     / np.outer(self.sqrtz[rows], self.sqrtz))
             sett.mt(0,'computed Ktilde (normalized anistropic kernel)')
             if False:
                 pl.matshow(self.Ktilde)
@@ -280,24 +356,118 @@ class DataGraph(object):
                 pl.colorbar()
                 pl.show()
         else:
-            self.z = np.array(np.sum(self.K, axis=0)).flatten()
+            self.z = np.array(self.K.sum(axis=0, dtype=np.float64)).flatten()
             # now we need the square root of the density
             self.sqrtz = np.array(np.sqrt(self.z))
             # now compute the density-normalized Kernel
             # it's still symmetric
-            self.Ktilde = self.K
-            for i in range(len(self.K.indptr[:-1])):
-                row = self.K.indices[self.K.indptr[i]: self.K.indptr[i+1]]
-                num = self.sqrtz[i] * self.sqrtz[row]
-                self.Ktilde.data[self.K.indptr[i]: self.K.indptr[i+1]] = self.K.data[self.K.indptr[i]: self.K.indptr[i+1]] / num
+            rows = np.repeat(np.arange(self.K.shape[0]), np.diff(self.K.indptr))
+            self.Ktilde = self.K.copy()
+            self.Ktilde.data /= self.sqrtz[rows] * self.sqrtz[self.K.indices]
+            sett.mt(0,'computed Ktilde (normalized anistropic kernel)')
+        self.compute_components()
+
+    def compute_components(self):
+        """
+        Compute the connected components of the graph.
+
+        Writes class members
+        --------------------
+        n_components : int
+            Number of connected components.
+        components : np.ndarray
+            Integer array of size n, which stores the label of the component
+            of each data point. Components are ordered by decreasing size.
+        """
+        import scipy.sparse.csgraph
+        if (not sp.sparse.issparse(self.K)
+            and all(np.all(self.K[rows] != 0) for rows in self._dense_blocks())):
+            # a dense kernel without zeros is a complete graph
+            self.components = np.zeros(self.K.shape[0], dtype=np.int_)
+            self.n_components = 1
+            return
+        n_components, labels = sp.sparse.csgraph.connected_components(
+            self._sparse_K(pattern=True), directed=False)
+        # order components by decreasing size
+        sizes = np.bincount(labels)
+        order = np.argsort(-sizes, kind='mergesort')
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(n_components)
+        self.components = ranks[labels]
+        self.n_components = n_components
+        if n_components > 1:
+            sett.m(0, '... graph has', n_components, 'connected components of '
+                   'sizes', sizes[order])
+
+    def _sparse_K(self, pattern=False):
+        """
+        K in CSR format, dense K is converted in blocks of rows.
+
+        If pattern is True, dense K is converted to the boolean pattern of its
+        non-zero entries, which suffices to determine connectivity.
+        """
+        if sp.sparse.issparse(self.K):
+            return self.K
+        return sp.sparse.vstack([sp.sparse.csr_matrix(self.K[rows] != 0
+                                                      if pattern else
+                                                      self.K[rows])
+                                 for rows in self._dense_blocks()],
+                                format='csr')
+
+    def _components_idcs(self):
+        """
+        Indices of the data points of each connected component.
+        """
+        if self.n_components == 1:
+            return [np.arange(self.components.size)]
+        order = np.argsort(self.components, kind='mergesort')
+        sizes = np.bincount(self.components)
+        return np.split(order, np.cumsum(sizes)[:-1])
+
+    @property
+    def T(self):
+        """
+        Transition matrix, computed from K on demand.
+        """
+        if sp.sparse.issparse(self.K):
+            return sp.sparse.diags((1/self.z).astype(self.K.dtype)).dot(self.K)
+        return np.divide(self.K, self.z[:, np.newaxis], dtype=self.K.dtype)
+
+    def estimate_dense_memory(self, n_buffers):
+        """
+        Memory in GB of n_buffers dense n x n matrices of dtype sett.dtype.
+        """
+        itemsize = np.dtype(sett.dtype).itemsize
+        return n_buffers * itemsize * self.X.shape[0]**2 / 1e9
+
+    def _dense_blocks(self, n_rows=None):
+        """
+        Slices of blocks of rows of dense n_rows x n matrices.
+
+        Temporary arrays of the size of a block take at most a hundredth of
+        sett.max_memory. If n_rows is None, n_rows = n.
+        """
+        n = self.X.shape[0]
+        n_rows = n if n_rows is None else n_rows
+        itemsize = np.dtype(sett.dtype).itemsize
+        block_size = max(1, int(sett.max_memory * 1e9 / 100 / (itemsize * n)))
+        for start in range(0, n_rows, block_size):
+            yield slice(start, start + block_size)
 
     def compute_L_matrix(self):
         """
         Graph Laplacian for K.
+
+        Is sparse if K is sparse.
         """
-        self.L = np.diag(self.z) - self.K
+        z = self.z.astype(self.K.dtype)
+        if sp.sparse.issparse(self.K):
+            self.L = (sp.sparse.diags(z) - self.K).tocsr()
+        else:
+            self.L = np.diag(z) - self.K
 
-    def embed(self, matrix=None, number=10, sym=True, sort='decrease'):
+    def embed(self, matrix=None, number=10, sym=True, sort='decrease',
+              solver=None, warm_start=True, tol=None, maxiter=None):
         """ 
         Compute eigen decomposition of matrix.
 
@@ -312,6 +482,27 @@ class DataGraph(object):
             Instead of computing the eigendecomposition of the assymetric 
             transition matrix, computed the eigendecomposition of the symmetric
             Ktilde matrix.
+        sort : {'decrease', 'increase'}
+            Compute the eigenvalues of largest magnitude and sort them in
+            decreasing order, or compute the smallest eigenvalues and sort them
+            in increasing order.
+        solver : {'arpack', 'lobpcg', 'randomized', 'dense'} or None
+            Eigensolver, defaults to params['eigen_solver'] or 'arpack'.
+            'arpack' is the implicitly restarted Lanczos method of
+            sp.sparse.linalg.eigsh, in shift-invert mode for sort ==
+            'increase'. 'lobpcg' is the locally optimal block preconditioned
+            conjugate gradient method, which computes the largest algebraic
+            eigenvalues for sort == 'decrease'. 'randomized' is the randomized
+            block Krylov method of Musco & Musco (2015). 'dense' computes all
+            eigenvalues and is used if number == 0.
+        warm_start : bool
+            Start the iterative solvers from the eigenvectors that have been
+            computed for the same matrix before, which are cached in adata.
+        tol : float or None
+            Tolerance for the residuals of the iterative solvers, defaults to
+            the default of the solver.
+        maxiter : int or None
+            Maximal number of iterations of the iterative solvers.
 
         Writes class members
         --------------------
@@ -325,38 +516,147 @@ class DataGraph(object):
              that is, the projection on the diffusion components.
              these are simply the components of the right eigenvectors
              and can directly be used for plotting.
+        embed_info : dict
+             Telemetry of the solver: the solver, whether it was warm started,
+             the number of iterations (None if unknown), the number of
+             matrix-vector products or linear solves and the maximal residual
+             of the eigenpairs relative to the norm of matrix.
         """
         np.set_printoptions(precision=3)
         self.rbasisBool = True
-        if matrix is None:
+        is_Ktilde = matrix is None
+        if is_Ktilde:
+            if getattr(self, 'n_components', 1) > 1:
+                self._embed_components(number, sym, sort, solver, tol, maxiter)
+                return
             matrix = self.Ktilde
-        # compute the spectrum
+        if solver is None:
+            solver = self.params.get('eigen_solver', 'arpack')
+        if solver not in {'arpack', 'lobpcg', 'randomized', 'dense'}:
+            raise ValueError('solver needs to be one of "arpack", "lobpcg", '
+                             '"randomized" or "dense"')
         if number == 0:
-            evals, evecs = sp.linalg.eigh(matrix)
+            solver = 'dense'
         else:
             number = min(matrix.shape[0]-1, number)
-            # ncv = max(2 * number + 1, int(np.sqrt(matrix.shape[0])))
-            ncv = None
-            which = 'LM' if sort == 'decrease' else 'SM'
-            evals, evecs = sp.sparse.linalg.eigsh(matrix, k=number, which=which,
-                                                  ncv=ncv)
+        # eigenvectors computed before for the same matrix
+        X0 = None
+        cache_key = None
+        if warm_start and solver != 'dense' and self.adata is not None:
+            cache_key = self._embed_key(matrix, sort)
+        if (cache_key is not None
+            and str(self.adata.get('embed_key')) == cache_key):
+            X0 = self.adata['embed_evecs']
+        # compute the spectrum
+        operator = _CountingOperator(matrix)
+        n_iters = None
+        shift = None
+        if solver == 'dense':
+            A = matrix.toarray() if sp.sparse.issparse(matrix) else matrix
+            evals, evecs = sp.linalg.eigh(A)
+            if number > 0:
+                if sort == 'decrease':
+                    idcs = np.argsort(-np.abs(evals))[:number]
+                else:
+                    idcs = np.arange(number)
+                evals, evecs = evals[idcs], evecs[:, idcs]
+        elif solver == 'arpack':
+            # a combination of the previous eigenvectors as starting vector,
+            # perturbed to not start in an invariant subspace
+            v0 = None
+            if X0 is not None:
+                rng = np.random.RandomState(0)
+                v0 = X0.sum(axis=1) + 1e-3 * rng.randn(X0.shape[0]) / np.sqrt(X0.shape[0])
+            arpack_params = {'tol': 0 if tol is None else tol,
+                             'maxiter': maxiter, 'v0': v0}
+            if sort == 'decrease':
+                evals, evecs = sp.sparse.linalg.eigsh(operator, k=number,
+                                                      which='LM',
+                                                      **arpack_params)
+            else:
+                # the smallest eigenvalues converge slowly with which='SM',
+                # use shift-invert mode instead, the matrix (typically a
+                # Laplacian) is positive semi-definite, so shift to slightly
+                # negative values to avoid singular factorizations
+                sigma = -1e-6 * np.max(np.abs(matrix.diagonal()))
+                operator = _CountingOperator(_shift_invert(matrix, sigma))
+                evals, evecs = sp.sparse.linalg.eigsh(matrix, k=number,
+                                                      sigma=sigma, which='LM',
+                                                      OPinv=operator,
+                                                      **arpack_params)
+        elif solver == 'lobpcg':
+            rng = np.random.RandomState(0)
+            X = rng.randn(matrix.shape[0], number).astype(matrix.dtype)
+            if X0 is not None:
+                ncols = min(number, X0.shape[1])
+                X[:, :ncols] = X0[:, :ncols]
+            precond = None
+            if sort == 'increase':
+                # Jacobi preconditioner
+                diag = np.array(matrix.diagonal(), dtype=float)
+                diag[diag == 0] = 1
+                precond = sp.sparse.diags(1/diag)
+            evals, evecs, resnorms = sp.sparse.linalg.lobpcg(
+                operator, X, M=precond, tol=tol,
+                maxiter=200 if maxiter is None else maxiter,
+                largest=sort == 'decrease', retResidualNormsHistory=True)
+            n_iters = len(resnorms)
+        else:
+            # for the smallest eigenvalues, compute the largest eigenvalues
+            # of shift * I - matrix, where shift bounds the spectrum
+            # this converges slowly if the smallest eigenvalues are close to
+            # each other relative to the shift
+            if sort == 'increase':
+                shift = self._max_abs_row_sum(matrix)
+            evals, evecs, n_iters = _eigsh_randomized(
+                operator, number, X0=X0, shift=shift,
+                tol=1e-8 if tol is None else tol,
+                maxiter=50 if maxiter is None else maxiter)
+        # all solvers return eigenvalues in increasing order, keep eigenvalues
+        # in float64 as M depends on 1 - evals
+        order = np.argsort(evals)
+        evals = evals[order].astype(np.float64)
+        evecs = evecs[:, order].astype(sett.dtype, copy=False)
+        # residuals relative to a bound for the norm of matrix
+        norm = self._max_abs_row_sum(matrix) if shift is None else shift
+        residuals = (np.linalg.norm(matrix.dot(evecs) - evecs * evals, axis=0)
+                     / norm)
+        self.embed_info = {'solver': solver,
+                           'warm_start': X0 is not None,
+                           'n_iters': n_iters,
+                           'n_matvecs': operator.n_matvecs,
+                           'max_residual': np.max(residuals)}
+        sett.m(0, '... solver', solver,
+               '(warm start)' if X0 is not None else '',
+               'used', n_iters if n_iters is not None else 'an unknown number of',
+               'iterations and', operator.n_matvecs,
+               'matrix-vector products, maximal residual',
+               '{:.1e}'.format(self.embed_info['max_residual']))
+        if cache_key is not None:
+            self.adata['embed_key'] = cache_key
+            self.adata['embed_evecs'] = evecs
         if sort == 'decrease':
             evals = evals[::-1]
             evecs = evecs[:, ::-1]
         sett.mt(0, 'computed eigenvalues:')
         sett.m(0, evals)
-        sett.m(1, 'computed', number, 'eigenvalues. if you want more increase the'
+        sett.m(1, 'computed', evals.size, 'eigenvalues. if you want more increase the'
                'parameter "number" or set it to zero, to compute all eigenvalues')
         # assign attributes
         self.evals = evals
+        if is_Ktilde:
+            self.evals_components = evals[np.newaxis, :]
+            self.components_number = np.array([evals.size])
         if sym:
             self.rbasis = self.lbasis = evecs
         else:
             # The eigenvectors of T are stored in self.rbasis and self.lbasis 
             # and are simple trafos of the eigenvectors of Ktilde.
             # rbasis and lbasis are right and left eigenvectors, respectively
-            self.rbasis = np.array(evecs / self.sqrtz[:,np.newaxis])
-            self.lbasis = np.array(evecs * self.sqrtz[:,np.newaxis])
+            self.rbasis = np.array(evecs / self.sqrtz[:,np.newaxis],
+                                   dtype=sett.dtype)
+            self.lbasis = np.array(evecs * self.sqrtz[:,np.newaxis],
+                                   dtype=sett.dtype)
             # normalize in L2 norm
             # note that, in contrast to that, a probability distribution
             # on the graph is normalized in L1 norm
@@ -365,6 +665,312 @@ class DataGraph(object):
 #             self.rbasis /= np.linalg.norm(self.rbasis,axis=0,ord=2)
 #             self.lbasis /= np.linalg.norm(self.lbasis,axis=0,ord=2)
 
+    def _embed_key(self, matrix, sort):
+        """
+        Fingerprint of the data and parameters that determine matrix.
+
+        Hashing X and the parameters is cheaper than hashing a dense matrix.
+        Returns None if matrix is neither Ktilde nor L, as its origin is
+        unknown.
+        """
+        if matrix is getattr(self, 'Ktilde', None):
+            name = 'Ktilde'
+        elif matrix is getattr(self, 'L', None):
+            name = 'L'
+        else:
+            return None
+        return utils.fingerprint(self.X, *[self.params.get(key) for key in
+                                          ['k', 'knn', 'sigma', 'nn_method',
+                                           'nn_trees']],
+                                 getattr(self, 'kernel_params', None), name,
+                                 sort)
+
+    def _max_abs_row_sum(self, matrix):
+        """
+        Maximal absolute row sum of matrix, which bounds its spectrum.
+
+        For dense matrix, computed in blocks of rows.
+        """
+        if sp.sparse.issparse(matrix):
+            return np.max(abs(matrix).sum(axis=1))
+        return max(np.max(np.sum(np.abs(matrix[rows]), axis=1))
+                   for rows in self._dense_blocks(matrix.shape[0]))
+
+    def _embed_components(self, number, sym, sort, solver, tol, maxiter):
+        """
+        Eigendecomposition of Ktilde for each connected component, see embed.
+
+        Ktilde is block diagonal with one block per connected component. The
+        blocks are diagonalized independently and in parallel, small blocks
+        with a dense solver. Row i of rbasis and lbasis stores the eigenvectors
+        of the component of i. Components with fewer eigenvectors are padded
+        with zeros, as are their eigenvalues.
+
+        Writes class members
+        --------------------
+        evals_components : np.ndarray
+            Array of shape n_components x number, the eigenvalues of each
+            component. evals stores the eigenvalues of the largest component.
+        components_number : np.ndarray
+            The number of eigenvalues of each component.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        Ktilde = self.Ktilde
+        if sp.sparse.issparse(Ktilde):
+            Ktilde = sp.sparse.csr_matrix(Ktilde)
+
+        def embed_component(idcs):
+            graph = copy(self)
+            # no warm starts from the cache
+            graph.adata = None
+            graph.n_components = 1
+            if sp.sparse.issparse(Ktilde):
+                graph.Ktilde = Ktilde[idcs][:, idcs]
+            else:
+                graph.Ktilde = Ktilde[np.ix_(idcs, idcs)]
+            graph.sqrtz = self.sqrtz[idcs]
+            small = idcs.size <= max(2 * number + 1, 100)
+            graph.embed(number=number, sym=sym, sort=sort,
+                        solver='dense' if small else solver, warm_start=False,
+                        tol=tol, maxiter=maxiter)
+            return graph
+
+        sett.m(0, '... computing eigenvectors of', self.n_components,
+               'connected components')
+        components_idcs = self._components_idcs()
+        with ThreadPoolExecutor(max_workers=sett.n_jobs) as pool:
+            graphs = list(pool.map(embed_component, components_idcs))
+        width = max(graph.evals.size for graph in graphs)
+        n = self.components.size
+        self.evals_components = np.zeros((self.n_components, width))
+        self.components_number = np.zeros(self.n_components, dtype=int)
+        self.rbasis = np.zeros((n, width), dtype=sett.dtype)
+        self.lbasis = (self.rbasis if sym
+                       else np.zeros((n, width), dtype=sett.dtype))
+        for icomp, (idcs, graph) in enumerate(zip(components_idcs, graphs)):
+            number_comp = graph.evals.size
+            self.evals_components[icomp, :number_comp] = graph.evals
+            self.components_number[icomp] = number_comp
+            self.rbasis[idcs, :number_comp] = graph.rbasis
+            if not sym:
+                self.lbasis[idcs, :number_comp] = graph.lbasis
+        self.evals = self.evals_components[0]
+        self.embed_info = {'solver': solver,
+                           'warm_start': False,
+                           'n_iters': None,
+                           'n_matvecs': sum(graph.embed_info['n_matvecs']
+                                            for graph in graphs),
+                           'max_residual': max(graph.embed_info['max_residual']
+                                               for graph in graphs)}
+
+    def _M_coeffs(self):
+        """
+        Coefficients of the eigenvectors in M for each connected component.
+
+        See compute_M_matrix, the coefficient of the first eigenvector of each
+        component is 1.
+        """
+        evals = self.evals_components
+        coeffs = np.ones_like(evals)
+        coeffs[:, 1:] = evals[:, 1:]/(1-evals[:, 1:])
+        return coeffs
+
+    def _M_lowrank_rows(self, Y, labels):
+        """
+        Rows of the low-rank representation of M, see compute_M_lowrank.
+
+        Parameters
+        ----------
+        Y : np.ndarray
+            Coordinates of data points in the eigenbasis, like rbasis.
+        labels : np.ndarray
+            Connected components of the data points.
+        """
+        Mlow = Y * self._M_coeffs()[labels]
+        for icomp, idcs in enumerate(self._components_idcs()):
+            number = self.components_number[icomp]
+            lbasis = self.lbasis[idcs, :number]
+            rows = labels == icomp
+            Mlow[rows, :number] = Mlow[rows, :number].dot(
+                np.linalg.cholesky(lbasis.T.dot(lbasis)))
+        return Mlow
+
+    def project(self, X_new):
+        """
+        Nystroem extension of the eigenvectors to new data points.
+
+        The kernel between the new data points and the data points of the
+        graph is computed in the same way as the kernel of the graph, using the
+        stored kernel widths sigmas_sq, densities q and z: for knn == True,
+        each new data point is connected to its k - 1 nearest neighbors. The
+        eigenvectors v with eigenvalue lambda of Ktilde are then extended via
+            v(x) = sum_j Ktilde(x, x_j) v_j / lambda.
+        New data points do not change the graph and the densities of the data
+        points of the graph. A new data point that coincides with a data point
+        of the graph is not counted among its own neighbors, as in
+        compute_transition_matrix. For knn == False, this reproduces the
+        coordinates of the data points of the graph.
+
+        Requires compute_transition_matrix and embed with sym == True, and
+        sort == 'decrease', or load_embedding.
+
+        Parameters
+        ----------
+        X_new : np.ndarray
+            Array of shape n_new x X.shape[1] in the same representation as X.
+
+        Returns
+        -------
+        Y_new : np.ndarray
+            Array of shape n_new x evals.size, the coordinates of the new data
+            points in the eigenbasis rbasis, including the first eigenvector.
+            For several connected components, each new data point is assigned
+            to a single component, these are stored in components_new.
+        """
+        X_new = np.asarray(X_new, dtype=self.X.dtype)
+        if X_new.ndim == 1:
+            X_new = X_new[np.newaxis, :]
+        n_new = X_new.shape[0]
+        k = self.params['k']
+        if self.params['knn']:
+            from sklearn.neighbors import NearestNeighbors
+            sklearn_neighbors = NearestNeighbors(n_neighbors=k)
+            sklearn_neighbors.fit(self.X)
+            distances, indices = sklearn_neighbors.kneighbors(X_new)
+            # skip the first neighbor if it coincides with the new data point,
+            # the last one otherwise
+            coincides = np.all(self.X[indices[:, 0]] == X_new, axis=1)
+            cols = coincides[:, np.newaxis] + np.arange(k-1)
+            distances = distances[np.arange(n_new)[:, np.newaxis], cols]
+            indices = indices[np.arange(n_new)[:, np.newaxis], cols]
+            distances_sq = distances**2
+        else:
+            # all data points of the graph are neighbors
+            distances_sq = np.vstack([utils._sqdist(X_new[rows], self.X)
+                                      for rows in self._dense_blocks(n_new)])
+            indices = np.arange(self.X.shape[0])
+            coincides = np.all(self.X[np.argmin(distances_sq, axis=1)]
+                               == X_new, axis=1)
+        # kernel widths as in compute_transition_matrix
+        if self.params['method'] == 'local':
+            if self.params['knn']:
+                sigmas_sq = np.median(distances_sq, axis=1)
+            else:
+                # the distance of the (k-1)th neighbor other than the new
+                # data point itself
+                kth = np.partition(distances_sq, [k-2, k-1], axis=1)
+                sigmas_sq = kth[np.arange(n_new), k-2 + coincides]/4
+        else:
+            sigmas_sq = self.params['sigma']**2 * np.ones(n_new)
+        sigmas_sq_ref = self.sigmas_sq[indices]
+        den = sigmas_sq[:, np.newaxis] + sigmas_sq_ref
+        W = (np.sqrt(2 * np.sqrt(sigmas_sq[:, np.newaxis] * sigmas_sq_ref) / den)
+             * np.exp(-distances_sq / den))
+        if not self.params['knn']:
+            W[W <= 1e-14] = 0
+        # assign each new data point to the connected component to which it
+        # has the highest total weight and disconnect it from the others
+        labels = np.broadcast_to(self.components[indices], W.shape)
+        if self.n_components > 1:
+            weights = sp.sparse.coo_matrix(
+                (W.ravel(), (np.repeat(np.arange(n_new), W.shape[1]),
+                             labels.ravel())),
+                shape=(n_new, self.n_components)).toarray()
+            self.components_new = np.argmax(weights, axis=1)
+            W[labels != self.components_new[:, np.newaxis]] = 0
+        else:
+            self.components_new = np.zeros(n_new, dtype=int)
+        # density normalization as in compute_transition_matrix
+        if self.alpha == 0:
+            q = np.ones(n_new)
+        else:
+            q = np.sum(W, axis=1)**self.alpha
+        K = W / (q[:, np.newaxis] * self.q[indices])
+        z = np.sum(K, axis=1)
+        Ktilde = K / (np.sqrt(z)[:, np.newaxis] * self.sqrtz[indices])
+        if self.params['knn']:
+            Ktilde = sp.sparse.csr_matrix((Ktilde.flatten(), indices.flatten(),
+                                           np.arange(0, n_new*(k-1)+1, k-1)),
+                                          shape=(n_new, self.X.shape[0]))
+        # the eigenvalues of the component of each new data point, padded
+        # eigenvalues are zero
+        evals = self.evals_components[self.components_new]
+        Y_new = np.divide(Ktilde.dot(self.rbasis), evals,
+                          out=np.zeros(evals.shape), where=evals != 0)
+        return Y_new
+
+    def project_pseudotime(self, Y_new):
+        """
+        DPT pseudotime of new data points.
+
+        Computes the DPT distance to the root of the connected component of
+        each new data point from the low-rank representation of M (see
+        compute_M_lowrank), normalized as in set_pseudotime.
+
+        Parameters
+        ----------
+        Y_new : np.ndarray
+            Coordinates of the new data points as returned by project.
+
+        Returns
+        -------
+        pseudotime : np.ndarray
+            Array of size n_new.
+        """
+        self.set_iroots()
+        Mlow = self._M_lowrank_rows(self.rbasis, self.components)
+        Mlow_new = self._M_lowrank_rows(Y_new, self.components_new)
+        pseudotime = np.zeros(Y_new.shape[0])
+        for icomp, idcs in enumerate(self._components_idcs()):
+            Mroot = Mlow[self.iroots[icomp]]
+            Droot = np.linalg.norm(Mlow[idcs] - Mroot, axis=1)
+            rows = self.components_new == icomp
+            pseudotime[rows] = (np.linalg.norm(Mlow_new[rows] - Mroot, axis=1)
+                                / np.max(Droot))
+        return pseudotime
+
+    def store_embedding(self, adata):
+        """
+        Store the quantities needed by project as annotation.
+
+        Arrays aligned to the samples are stored in adata.smpm, so that they
+        are subset together with X.
+        """
+        adata['diffmap_rep'] = self.rep
+        adata['diffmap_k'] = self.params['k']
+        adata['diffmap_knn'] = self.params['knn']
+        adata['diffmap_sigma'] = self.params['sigma']
+        adata['diffmap_evals'] = self.evals_components
+        adata['diffmap_components_number'] = self.components_number
+        adata['diffmap_alpha'] = self.alpha
+        for key, value in [('diffmap_evecs', self.rbasis),
+                           ('diffmap_components', self.components),
+                           ('diffmap_sigmas_sq', self.sigmas_sq),
+                           ('diffmap_q', self.q),
+                           ('diffmap_sqrtz', self.sqrtz)]:
+            adata.add.pop(key, None)
+            adata.smpm[key] = value
+
+    def load_embedding(self, adata):
+        """
+        Load the quantities stored by store_embedding.
+        """
+        if 'diffmap_evecs' not in adata:
+            raise ValueError('Run diffmap or dpt on adata first.')
+        self.evals_components = np.atleast_2d(adata['diffmap_evals'])
+        self.evals = self.evals_components[0]
+        self.rbasis = self.lbasis = adata['diffmap_evecs']
+        self.n_components = self.evals_components.shape[0]
+        self.components = adata.get('diffmap_components',
+                                    np.zeros(self.rbasis.shape[0], dtype=int))
+        self.components_number = adata.get('diffmap_components_number',
+                                           np.array([self.evals.size]))
+        self.sigmas_sq = adata['diffmap_sigmas_sq']
+        self.q = adata['diffmap_q']
+        self.sqrtz = adata['diffmap_sqrtz']
+        self.z = self.sqrtz**2
+        self.alpha = adata['diffmap_alpha']
+
     def compute_M_matrix(self):
         """ 
         The M matrix is the matrix that results from summing over all powers of
@@ -372,11 +978,15 @@ class DataGraph(object):
 
         See Haghverdi et al. (2016).
         """
-        # the projected inverse therefore is
-        self.M = sum([self.evals[i]/(1-self.evals[i])
-                      * np.outer(self.rbasis[:, i], self.lbasis[:, i])
-                      for i in range(1, self.evals.size)])
-        self.M += np.outer(self.rbasis[:, 0], self.lbasis[:, 0])
+        # the projected inverse therefore is, written as a single matrix
+        # product to avoid storing one n x n matrix per eigenvalue
+        coeffs = self._M_coeffs()[self.components]
+        self.M = (self.rbasis * coeffs).dot(self.lbasis.T)
+        if self.n_components > 1:
+            # M is block diagonal, with one block per connected component
+            for rows in self._dense_blocks():
+                self.M[rows][self.components[rows, np.newaxis]
+                             != self.components] = 0
         sett.mt(0,'computed M matrix')
         if False:
             pl.matshow(self.Ktilde)
@@ -386,6 +996,44 @@ class DataGraph(object):
             pl.title('M')
             pl.colorbar()
 
+    def compute_M_lowrank(self):
+        """
+        Low-rank representation of the M matrix.
+
+        As M = rbasis diag(c) lbasis^T with c the coefficients in
+        compute_M_matrix, the distance between rows i and j of M is
+            |M[i] - M[j]|^2 = (u_i - u_j)^T lbasis^T lbasis (u_i - u_j)
+        where u_i = c * rbasis[i]. With the Cholesky factor L of lbasis^T
+        lbasis, this is the Euclidian distance between the rows of
+            Mlow = rbasis diag(c) L,
+        an array of shape n x number of eigenvalues. This requires O(n k)
+        instead of O(n^2) memory. Rows of the DPT distance matrix are computed
+        on demand by the distance oracle Dchosen.
+
+        For several connected components, this is done for each component
+        separately.
+        """
+        self.Mlow = self._M_lowrank_rows(self.rbasis, self.components)
+        self.Dchosen = LowRankDistances(self.Mlow)
+        sett.mt(0, 'computed low-rank representation of M matrix')
+
+    def compute_C_lowrank(self):
+        """
+        Low-rank representation of the commute distance matrix C.
+
+        The pseudoinverse of the Laplacian in compute_Lp_matrix is a sum over
+        the eigenvectors r_i of L with eigenvalues lambda_i > 0. Therefore
+            C[i, j] = vol(G) sum_k (r_k[i] - r_k[j])^2 / lambda_k
+        is the squared Euclidian distance between the rows of
+            Clow = sqrt(vol(G)) rbasis[:, 1:] / sqrt(evals[1:]),
+        which requires O(n k) instead of O(n^2) memory.
+        """
+        volG = np.sum(self.z)
+        self.Clow = (np.sqrt(volG) * self.rbasis[:, 1:]
+                     / np.sqrt(self.evals[1:]))
+        sett.mt(0, 'computed low-rank representation of commute distance matrix')
+        self.Dchosen = LowRankDistances(self.Clow, squared=True)
+
     def compute_Lp_matrix(self):
         """
         See Fouss et al. (2006) and von Luxburg et al. (2007).
@@ -393,9 +1041,7 @@ class DataGraph(object):
         See Proposition 6 in von Luxburg (2007) and the inline equations
         right in the text above.
         """
-        self.Lp = sum([1/self.evals[i]
-                      * np.outer(self.rbasis[:,i], self.lbasis[:,i])
-                      for i in range(1, self.evals.size)])
+        self.Lp = (self.rbasis[:, 1:] / self.evals[1:]).dot(self.lbasis[:, 1:].T)
         sett.mt(0,'computed pseudoinverse of Laplacian')
 
     def compute_Ddiff_matrix(self):
@@ -418,7 +1064,7 @@ class DataGraph(object):
         self.Ddiff = sp.spatial.distance.pdist(self.M)
         self.Ddiff = sp.spatial.distance.squareform(self.Ddiff)
         sett.mt(0, 'computed Ddiff distance matrix')
-        self.Dchosen = self.Ddiff
+        self.Dchosen = DenseDistances(self.Ddiff)
 
     def compute_C_matrix(self):
         """
@@ -427,20 +1073,68 @@ class DataGraph(object):
         This is the commute-time matrix. It's a squared-euclidian distance
         matrix in \mathbb{R}^n.
         """
-        self.C = np.repeat(np.diag(self.Lp)[:, np.newaxis],
-                           self.Lp.shape[0], axis=1)
-        self.C += np.repeat(np.diag(self.Lp)[np.newaxis, :], 
-                            self.Lp.shape[0], axis=0)
+        diagLp = np.diag(self.Lp)
+        self.C = diagLp[:, np.newaxis] + diagLp[np.newaxis, :]
         self.C -= 2*self.Lp
-        # the following is much slower
-        # self.C = np.zeros(self.Lp.shape)
-        # for i in range(self.Lp.shape[0]):
-        #     for j in range(self.Lp.shape[1]):
-        #         self.C[i, j] = self.Lp[i, i] + self.Lp[j, j] - 2*self.Lp[i, j]
         volG = np.sum(self.z)
         self.C *= volG
         sett.mt(0,'computed commute distance matrix')
-        self.Dchosen =  self.C
+        self.Dchosen = DenseDistances(self.C)
+
+    def compute_C_sketch(self, n_comps=50, random_state=0):
+        """
+        Commute distances from a random projection sketch.
+
+        The commute distance is C[i, j] = vol(G) R[i, j], where R[i, j] = (e_i -
+        e_j)^T L^+ (e_i - e_j) is the effective resistance. Following Spielman &
+        Srivastava (2011), R[i, j] is approximated by |Z[i] - Z[j]|^2 with Z =
+        L^+ B^T W^(1/2) Q^T, where B is the edge-vertex incidence matrix, W the
+        diagonal matrix of edge weights and Q a random matrix with n_comps rows
+        and entries +-1/sqrt(n_comps). Computing Z requires n_comps solves of
+        sparse linear systems in L, which are done with the conjugate gradient
+        method. The relative error of the distances decreases as
+        1/sqrt(n_comps).
+
+        In contrast to compute_C_matrix, this does not truncate the spectrum of
+        L and does not require O(n^2) memory.
+
+        Parameters
+        ----------
+        n_comps : int, optional (default: 50)
+            Number of random projections.
+        random_state : int, optional (default: 0)
+            Seed for the random projections.
+        """
+        import scipy.sparse.linalg
+        n = self.z.size
+        K = self._sparse_K()
+        L = (sp.sparse.diags(self.z) - K).tocsr()
+        edges = sp.sparse.triu(K, k=1).tocoo()
+        m = edges.nnz
+        # B^T W^(1/2) Q^T
+        B = sp.sparse.csr_matrix((np.r_[np.ones(m), -np.ones(m)],
+                                  (np.r_[np.arange(m), np.arange(m)],
+                                   np.r_[edges.row, edges.col])),
+                                 shape=(m, n))
+        rng = np.random.RandomState(random_state)
+        Q = rng.choice([-1., 1.], size=(m, n_comps)) / np.sqrt(n_comps)
+        Y = B.T.dot(np.sqrt(edges.data)[:, np.newaxis] * Q)
+        # all columns of Y sum to zero, hence the singular systems are
+        # consistent, use a Jacobi preconditioner, isolated nodes have a zero
+        # diagonal and zero right-hand sides
+        d = L.diagonal()
+        d[d == 0] = 1
+        precond = sp.sparse.diags(1/d)
+        Z = np.zeros((n, n_comps))
+        for icomp in range(n_comps):
+            Z[:, icomp], info = sp.sparse.linalg.cg(L, Y[:, icomp], M=precond)
+            if info > 0:
+                sett.m(0, '... conjugate gradient did not converge for projection',
+                       icomp)
+        volG = np.sum(self.z)
+        self.Csketch = np.sqrt(volG) * Z
+        sett.mt(0,'computed sketch of commute distances')
+        self.Dchosen = LowRankDistances(self.Csketch, squared=True)
 
     def compute_MFP_matrix(self):
         """
@@ -452,21 +1146,95 @@ class DataGraph(object):
         corresponds to the standard notation for transition matrices (left index
         initial state, right index final state, i.e. a right-stochastic 
         matrix, with each row summing to one).
+
+        The sum over j in
+            Mfp[i, k] = sum_j (Lp[i, j] - Lp[i, k] - Lp[k, j] + Lp[k, k]) z[j]
+        is evaluated in closed form using Lp z and vol(G) = sum_j z[j].
         """
-        self.MFP = np.zeros(self.Lp.shape)
-        for i in range(self.Lp.shape[0]):
-            for k in range(self.Lp.shape[1]):
-                for j in range(self.Lp.shape[1]):
-                    self.MFP[i, k] += (self.Lp[i, j] - self.Lp[i, k] 
-                                       - self.Lp[k, j] + self.Lp[k, k]) * self.z[j]
+        Lpz = self.Lp.dot(self.z)
+        volG = np.sum(self.z)
+        self.MFP = Lpz[:, np.newaxis] - Lpz[np.newaxis, :]
+        self.MFP -= volG * self.Lp
+        self.MFP += volG * np.diag(self.Lp)[np.newaxis, :]
         sett.mt(0,'computed mean first passage time matrix')
-        self.Dchosen = self.MFP
+        self.Dchosen = DenseDistances(self.MFP)
 
     def set_pseudotime(self):
         """
         Return pseudotime with respect to root point.
+
+        For several connected components, the pseudotime within each component
+        is computed with respect to its root, see component_roots, and
+        normalized separately.
+        """
+        self.pseudotime = self.compute_pseudotimes(self.iroot)
+
+    def set_iroots(self):
+        """
+        Determine a root for each connected component, see component_roots.
+        """
+        self.iroots = self.component_roots([self.iroot])[0]
+
+    def component_roots(self, iroots):
         """
-        self.pseudotime = self.Dchosen[self.iroot]/np.max(self.Dchosen[self.iroot])
+        Roots of each connected component for one or several root points.
+
+        The root of the component that contains a root point is the root point
+        itself, the root of any other component is its data point closest to
+        the root point in X.
+
+        Parameters
+        ----------
+        iroots : np.ndarray
+            Index array of root points.
+
+        Returns
+        -------
+        iroots_components : np.ndarray
+            Array of shape len(iroots) x n_components.
+        """
+        iroots = np.asarray(iroots, dtype=int)
+        iroots_components = np.zeros((iroots.size, self.n_components),
+                                     dtype=int)
+        for rows in self._dense_blocks(iroots.size):
+            dsq = utils._sqdist(self.X[iroots[rows]], self.X)
+            for icomp, idcs in enumerate(self._components_idcs()):
+                iroots_components[rows, icomp] = idcs[np.argmin(dsq[:, idcs],
+                                                                axis=1)]
+        iroots_components[np.arange(iroots.size),
+                          self.components[iroots]] = iroots
+        return iroots_components
+
+    def compute_pseudotimes(self, iroots):
+        """
+        Pseudotimes with respect to one or several root points.
+
+        The distances of all root points are computed in a single pass over
+        Dchosen. For several connected components, the pseudotime within each
+        component is computed with respect to its root, see component_roots.
+
+        Parameters
+        ----------
+        iroots : int or np.ndarray
+            Index or index array of root points.
+
+        Returns
+        -------
+        pseudotimes : np.ndarray
+            Array of shape n for a single root, len(iroots) x n otherwise.
+        """
+        if self.n_components == 1:
+            D = self.Dchosen[iroots]
+            return D/np.max(D, axis=-1, keepdims=True)
+        iroots_components = self.component_roots(np.atleast_1d(iroots))
+        n_roots, n = iroots_components.shape[0], self.Dchosen.shape[0]
+        D = self.Dchosen[iroots_components.ravel()].reshape(
+            n_roots, self.n_components, n)
+        pseudotimes = np.zeros((n_roots, n))
+        for icomp, idcs in enumerate(self._components_idcs()):
+            Dcomp = D[:, icomp, idcs]
+            pseudotimes[:, idcs] = Dcomp / np.max(Dcomp, axis=1, keepdims=True)
+        return pseudotimes[0] if np.ndim(iroots) == 0 else pseudotimes
 
     def set_root(self, xroot):
         """ 
@@ -485,21 +1253,39 @@ class DataGraph(object):
             raise ValueError('The root vector you provided does not have the '
                              'correct dimension. Make sure you provide the dimension-'
                              'reduced version, if you provided X_pca.')
-        # this is the squared distance
-        dsqroot = 1e10
-        self.iroot = 0
-        for i in range(self.X.shape[0]):
-            diff = self.X[i, :]-xroot
-            dsq = diff.dot(diff)
-            if  dsq < dsqroot:
-                dsqroot = dsq
-                self.iroot = i
-                if np.sqrt(dsqroot) < 1e-10:
-                    sett.m(2,'root found at machine prec')
-                    break
+        self.iroot = int(self.find_roots(xroot)[0])
         sett.m(0, '... set iroot', self.iroot)
         return self.iroot
 
+    def find_roots(self, xroots):
+        """
+        Indices of the observations closest to one or several root vectors.
+
+        For many root vectors and data of low dimension, the closest
+        observations are looked up in a KD-tree, otherwise the distances of
+        blocks of root vectors to all observations are computed at once.
+
+        Parameters
+        ----------
+        xroots : np.ndarray
+            Vector of size X.shape[1] or array of shape n_roots x X.shape[1].
+
+        Returns
+        -------
+        iroots : np.ndarray
+            Index array of size n_roots.
+        """
+        xroots = np.atleast_2d(np.asarray(xroots, dtype=float))
+        if xroots.shape[1] != self.X.shape[1]:
+            raise ValueError('The root vectors need to have dimension {}.'
+                             .format(self.X.shape[1]))
+        if xroots.shape[0] > 1 and self.X.shape[1] <= 20:
+            from scipy.spatial import cKDTree
+            return cKDTree(self.X).query(xroots)[1]
+        return np.concatenate([np.argmin(utils._sqdist(xroots[rows], self.X),
+                                         axis=1)
+                               for rows in self._dense_blocks(xroots.shape[0])])
+
     def _test_embed(self):
         """
         Checks and tests for embed.
@@ -514,3 +1300,434 @@ class DataGraph(object):
             # direct computation of spectrum of T
             w,vl,vr = sp.linalg.eig(self.T,left=True)
             sett.mi('spectrum of transition matrix (should be same as of Ktilde)')
+
+class _CountingOperator(sp.sparse.linalg.LinearOperator):
+    """
+    Linear operator that counts the matrix-vector products with A.
+    """
+
+    def __init__(self, A):
+        self.A = A
+        self.n_matvecs = 0
+        super().__init__(A.dtype, A.shape)
+
+    def _matvec(self, x):
+        self.n_matvecs += 1
+        return self.A.dot(x)
+
+    def _matmat(self, X):
+        self.n_matvecs += X.shape[1]
+        return self.A.dot(X)
+
+
+def _shift_invert(A, sigma):
+    """
+    Linear operator that applies (A - sigma I)^-1 using an LU factorization.
+    """
+    n = A.shape[0]
+    if sp.sparse.issparse(A):
+        lu = sp.sparse.linalg.splu(sp.sparse.csc_matrix(A - sigma * sp.sparse.identity(n)))
+        solve = lu.solve
+    else:
+        lu_piv = sp.linalg.lu_factor(A - sigma * np.eye(n))
+        solve = lambda x: sp.linalg.lu_solve(lu_piv, x)
+    return sp.sparse.linalg.LinearOperator(A.shape, matvec=solve,
+                                           matmat=solve, dtype=float)
+
+
+def _eigsh_randomized(A, k, n_oversamples=10, X0=None, shift=None, tol=1e-8,
+                      maxiter=50, random_state=0):
+    """
+    Eigenvalues of largest magnitude of a symmetric matrix.
+
+    Randomized block Krylov method of Musco & Musco, NIPS (2015). The Krylov
+    space of a random block of k + n_oversamples vectors is extended by one
+    block per iteration, the eigenpairs are estimated by a Rayleigh-Ritz
+    projection onto the Krylov space. The basis of the Krylov space and its
+    image under A take at most sett.max_memory. If they are full, the method
+    restarts from the Ritz vectors of the k + n_oversamples eigenvalues of
+    largest magnitude.
+
+    Parameters
+    ----------
+    A : np.ndarray, sp.sparse.spmatrix or sp.sparse.linalg.LinearOperator
+        Symmetric matrix.
+    k : int
+        Number of eigenpairs.
+    n_oversamples : int, optional (default: 10)
+        Number of additional vectors in each block.
+    X0 : np.ndarray or None, optional (default: None)
+        Vectors that are used as first columns of the starting block, for
+        example, previously computed eigenvectors.
+    shift : float or None, optional (default: None)
+        If not None, compute the largest eigenvalues of shift * I - A, which
+        are the smallest eigenvalues of A if shift bounds the spectrum of A.
+    tol : float, optional (default: 1e-8)
+        Stop if the residuals of all k eigenpairs relative to the largest
+        eigenvalue are below tol.
+    maxiter : int, optional (default: 50)
+        Maximal number of blocks.
+    random_state : int, optional (default: 0)
+        Seed for the starting block.
+
+    Returns
+    -------
+    evals : np.ndarray
+        Eigenvalues of A.
+    evecs : np.ndarray
+        Eigenvectors of A (stored in columns).
+    n_iters : int
+        Number of blocks by which the Krylov space has been extended.
+    """
+    n = A.shape[0]
+    if shift is None:
+        matmat = A.dot
+    else:
+        matmat = lambda X: shift * X - A.dot(X)
+    block_size = min(n, k + n_oversamples)
+    rng = np.random.RandomState(random_state)
+    Q = rng.randn(n, block_size)
+    if X0 is not None:
+        ncols = min(block_size, X0.shape[1])
+        Q[:, :ncols] = X0[:, :ncols]
+    Q, _ = np.linalg.qr(Q)
+    # orthonormal basis V of the Krylov space and A V, preallocated within
+    # the memory budget, but with room for at least two blocks
+    max_cols = max(int(sett.max_memory * 1e9 / (2 * 8 * n)), 2 * block_size)
+    max_cols = min(n, block_size * (maxiter + 1), max_cols)
+    V_all = np.empty((n, max_cols), order='F')
+    AV_all = np.empty((n, max_cols), order='F')
+    V_all[:, :block_size] = Q
+    AV_all[:, :block_size] = matmat(Q)
+    m = block_size
+    # projection of A onto the Krylov space, updated blockwise
+    H = Q.T.dot(AV_all[:, :m])
+    for n_iters in range(1, maxiter + 1):
+        V, AV = V_all[:, :m], AV_all[:, :m]
+        # Rayleigh-Ritz projection onto the Krylov space
+        evals_all, S_all = np.linalg.eigh((H + H.T) / 2)
+        order = np.argsort(-np.abs(evals_all))
+        evals, S = evals_all[order[:k]], S_all[:, order[:k]]
+        evecs = V.dot(S)
+        residuals = (np.linalg.norm(AV.dot(S) - evecs * evals, axis=0)
+                     / np.max(np.abs(evals)))
+        if np.max(residuals) < tol or n_iters == maxiter:
+            break
+        if m + block_size > max_cols:
+            if max_cols == n:
+                # the Krylov space cannot be extended further
+                break
+            # thick restart from the leading Ritz vectors, on which the
+            # projection of A is diagonal
+            S = S_all[:, order[:block_size]]
+            V_all[:, :block_size] = V.dot(S)
+            AV_all[:, :block_size] = AV.dot(S)
+            H = np.diag(evals_all[order[:block_size]])
+            m = block_size
+            V, AV = V_all[:, :m], AV_all[:, :m]
+        # extend by the next block, orthogonalize twice for stability
+        Q = AV[:, -block_size:]
+        for _ in range(2):
+            Q = Q - V.dot(V.T.dot(Q))
+        Q, _ = np.linalg.qr(Q)
+        AQ = matmat(Q)
+        VtAQ = V.T.dot(AQ)
+        H = np.block([[H, VtAQ], [VtAQ.T, Q.T.dot(AQ)]])
+        V_all[:, m:m+block_size] = Q
+        AV_all[:, m:m+block_size] = AQ
+        m += block_size
+    if shift is not None:
+        evals = shift - evals
+    return evals, evecs, n_iters
+
+
+class DistanceOracle(object):
+    """
+    Distance matrix that serves rows on demand.
+
+    Indexing works as for the dense matrix D, but only for rows:
+        oracle[i], oracle[rows], oracle[i, cols]
+    return D[i], D[rows] and D[i, cols], respectively. Restricting the oracle
+    to a subset of points behaves like restricting D to D[np.ix_(idcs,
+    idcs)], without copying or computing the restricted matrix.
+
+    Subclasses implement _compute_rows, which returns full rows of D. Computed
+    rows are cached if cache_size > 0. Restricted oracles share the cache.
+    """
+
+    def __init__(self, n, cache_size=0):
+        self.n = n
+        self.idcs = None
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def shape(self):
+        m = self.n if self.idcs is None else self.idcs.size
+        return (m, m)
+
+    def restrict(self, idcs):
+        """
+        Restrict to the points idcs, given as positions within this oracle.
+        """
+        restricted = copy(self)
+        restricted.idcs = (np.asarray(idcs) if self.idcs is None
+                           else self.idcs[idcs])
+        return restricted
+
+    def __getitem__(self, index):
+        row, cols = index if isinstance(index, tuple) else (index, slice(None))
+        rows = np.atleast_1d(row)
+        D = self._rows(rows if self.idcs is None else self.idcs[rows])
+        if self.idcs is not None:
+            D = D[:, self.idcs]
+        D = D[:, cols]
+        return D[0] if np.ndim(row) == 0 else D
+
+    def argmax(self, block_size=1000):
+        """
+        Indices of the maximal distance as tuple (i, j).
+        """
+        idcs = np.arange(self.n) if self.idcs is None else self.idcs
+        dmax, imax = -np.inf, (0, 0)
+        for start in range(0, idcs.size, block_size):
+            D = self._compute_rows(idcs[start:start+block_size])[:, idcs]
+            i, j = np.unravel_index(np.argmax(D), D.shape)
+            if D[i, j] > dmax:
+                dmax, imax = D[i, j], (start + i, j)
+        return imax
+
+    def _rows(self, rows):
+        if self.cache_size == 0:
+            return self._compute_rows(rows)
+        with self._lock:
+            cached = {row: self._cache[row] for row in rows if row in self._cache}
+        missing = np.array([row for row in rows if row not in cached], dtype=int)
+        if missing.size > 0:
+            computed = self._compute_rows(missing)
+            with self._lock:
+                for row, D in zip(missing, computed):
+                    cached[row] = self._cache[row] = D
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return np.array([cached[row] for row in rows])
+
+    def _compute_rows(self, rows):
+        raise NotImplementedError
+
+class DenseDistances(DistanceOracle):
+    """
+    Distance oracle for a dense distance matrix D.
+    """
+
+    def __init__(self, D):
+        super(DenseDistances, self).__init__(D.shape[0])
+        self.D = D
+
+    def _compute_rows(self, rows):
+        return self.D[rows]
+
+class LowRankDistances(DistanceOracle):
+    """
+    Distance oracle for the Euclidian distances between the rows of Y.
+
+    Y has shape n x k and rows are computed in O(n k) time and memory. If
+    squared is True, squared Euclidian distances are returned.
+    """
+
+    def __init__(self, Y, cache_size=100, squared=False):
+        super(LowRankDistances, self).__init__(Y.shape[0], cache_size)
+        self.Y = Y
+        self.squared = squared
+
+    def argmax(self, block_size=1000):
+        # fast search in squared distances, the exact distance for each block
+        # does not matter
+        idcs = np.arange(self.n) if self.idcs is None else self.idcs
+        Y = self.Y[idcs]
+        dmax, imax = -np.inf, (0, 0)
+        for start in range(0, idcs.size, block_size):
+            Dsq = -2 * Y[start:start+block_size].dot(Y.T)
+            Dsq += np.einsum('ij,ij->i', Y, Y)[np.newaxis, :]
+            Dsq += np.einsum('ij,ij->i', Y[start:start+block_size],
+                             Y[start:start+block_size])[:, np.newaxis]
+            i, j = np.unravel_index(np.argmax(Dsq), Dsq.shape)
+            if Dsq[i, j] > dmax:
+                dmax, imax = Dsq[i, j], (start + i, j)
+        return imax
+
+    def _compute_rows(self, rows):
+        D = np.zeros((len(rows), self.n), dtype=self.Y.dtype)
+        for i, row in enumerate(rows):
+            diff = self.Y - self.Y[row]
+            D[i] = np.einsum('ij,ij->i', diff, diff)
+        return D if self.squared else np.sqrt(D)
+
+
+def _small_graph(data, k=6, knn=True, **params):
+    """
+    DataGraph with a kNN kernel, for testing.
+
+    data is an AnnData, a data matrix or the number of random points in three
+    dimensions.
+    """
+    if isinstance(data, int):
+        data = np.random.RandomState(0).randn(data, 3)
+    adata = data if isinstance(data, AnnData) else AnnData(data)
+    params.update({'n_pcs_pre': 0, 'k': k, 'knn': knn, 'sigma': 0})
+    return DataGraph(adata, params)
+
+@contextmanager
+def _max_memory(max_memory=1e-9):
+    """
+    Set sett.max_memory temporarily, by default so low that kernels are
+    computed in sparse format.
+    """
+    max_memory_before = sett.max_memory
+    sett.max_memory = max_memory
+    try:
+        yield
+    finally:
+        sett.max_memory = max_memory_before
+
+def test_sparse_kernel():
+    dense = _small_graph(80)
+    dense.compute_transition_matrix()
+    with _max_memory():
+        sparse = _small_graph(80)
+        sparse.compute_transition_matrix()
+    assert not sp.sparse.issparse(dense.K) and sp.sparse.issparse(sparse.K)
+    # the symmetrized kNN kernels agree
+    assert np.allclose(sparse.K.toarray(), dense.K)
+    assert np.allclose(sparse.Ktilde.toarray(), dense.Ktilde)
+
+def test_M_lowrank():
+    import scipy.spatial
+    dgraph = _small_graph(60)
+    dgraph.compute_transition_matrix()
+    dgraph.embed(number=8, sym=False)
+    dgraph.compute_M_matrix()
+    D = sp.spatial.distance.squareform(sp.spatial.distance.pdist(dgraph.M))
+    dgraph.compute_M_lowrank()
+    # the pseudotimes of all roots are the normalized rows of the DPT distance
+    # matrix
+    pseudotimes = dgraph.compute_pseudotimes(np.arange(60))
+    assert np.allclose(pseudotimes, D / D.max(axis=1)[:, np.newaxis],
+                       atol=1e-6)
+
+def test_commute_distances():
+    n = 40
+    dgraph = _small_graph(n)
+    dgraph.compute_transition_matrix()
+    dgraph.compute_L_matrix()
+    dgraph.embed(dgraph.L, number=0, sort='increase')
+    dgraph.compute_Lp_matrix()
+    # the closed form of the mean first passage times agrees with the sum
+    Lp, z = dgraph.Lp, dgraph.z
+    MFP = np.einsum('ijk,j->ik', Lp[:, :, np.newaxis] - Lp[:, np.newaxis, :]
+                    - Lp.T[np.newaxis, :, :] + np.diag(Lp), z)
+    dgraph.compute_MFP_matrix()
+    assert np.allclose(dgraph.MFP, MFP)
+    # the sketch approximates the commute distances
+    dgraph.compute_C_matrix()
+    C = dgraph.C
+    dgraph.compute_C_sketch(n_comps=1000)
+    Csketch = dgraph.Dchosen[np.arange(n)]
+    offdiag = ~np.eye(n, dtype=bool)
+    assert np.median(np.abs(Csketch - C)[offdiag] / C[offdiag]) < 0.1
+
+def test_sparse_laplacian():
+    dgraph = _small_graph(100, nn_method='rpforest')
+    dgraph.compute_transition_matrix()
+    dgraph.compute_L_matrix()
+    assert sp.sparse.issparse(dgraph.L)
+    evals = np.linalg.eigvalsh(dgraph.L.toarray())[:5]
+    # smallest eigenvalues in shift-invert mode
+    dgraph.embed(dgraph.L, number=5, sort='increase')
+    assert np.allclose(dgraph.evals, evals, atol=1e-8)
+    assert np.allclose(dgraph.L.dot(dgraph.rbasis),
+                       dgraph.rbasis * dgraph.evals, atol=1e-6)
+
+def test_roots():
+    rng = np.random.RandomState(0)
+    # two connected components
+    X = np.r_[rng.randn(40, 2), rng.randn(30, 2) + 100]
+    dgraph = _small_graph(X, k=5)
+    xroots = X[[3, 50, 12]] + 0.01
+    assert dgraph.find_roots(xroots).tolist() == [3, 50, 12]
+    assert dgraph.find_roots(xroots[0]).tolist() == [3]
+    dgraph.compute_transition_matrix()
+    assert dgraph.n_components == 2
+    dgraph.embed(number=6, sym=False)
+    dgraph.compute_M_lowrank()
+    # the root of the other component is its point closest to the root
+    iroots = dgraph.component_roots([3, 50])
+    closest = np.argmin(((X - X[3])**2).sum(axis=1)[40:]) + 40
+    assert iroots[0].tolist() == [3, closest]
+    # pseudotimes for several roots are those of the single roots
+    pseudotimes = dgraph.compute_pseudotimes(np.array([3, 50, 12]))
+    for i, iroot in enumerate([3, 50, 12]):
+        assert np.allclose(pseudotimes[i], dgraph.compute_pseudotimes(iroot))
+        assert pseudotimes[i, iroot] == 0
+
+def test_eigsh_randomized():
+    rng = np.random.RandomState(0)
+    n, k = 200, 5
+    # symmetric positive definite matrix with a decaying spectrum
+    Q, _ = np.linalg.qr(rng.randn(n, n))
+    A = (Q * (1 / (1 + np.arange(n)))).dot(Q.T)
+    evals_arpack = np.sort(sp.sparse.linalg.eigsh(A, k=k, which='LM')[0])
+    evals, evecs, _ = _eigsh_randomized(A, k)
+    assert np.allclose(np.sort(evals), evals_arpack)
+    # restart the Krylov space if only two blocks fit into the budget
+    with _max_memory(2 * (k + 10) * 2 * 8 * n / 1e9):
+        evals, evecs, _ = _eigsh_randomized(A, k, maxiter=200)
+    assert np.allclose(np.sort(evals), evals_arpack)
+    assert np.allclose(np.abs(evecs.T.dot(evecs)), np.eye(k), atol=1e-6)
+    # all solvers of embed agree with arpack
+    dgraph = _small_graph(n)
+    for solver in ['arpack', 'lobpcg', 'randomized', 'dense']:
+        dgraph.embed(A, number=k, solver=solver, warm_start=False, tol=1e-8)
+        assert np.allclose(np.sort(dgraph.evals), evals_arpack, atol=1e-6)
+
+def test_distance_oracle():
+    rng = np.random.RandomState(0)
+    Y = rng.randn(50, 3)
+    D = np.sqrt(((Y[:, np.newaxis] - Y[np.newaxis]) ** 2).sum(axis=2))
+    idcs = rng.choice(50, 20, replace=False)
+    D_sub = D[np.ix_(idcs, idcs)]
+    for oracle in [DenseDistances(D), LowRankDistances(Y, cache_size=10)]:
+        assert np.allclose(oracle[3], D[3])
+        assert np.allclose(oracle[[1, 2], 5], D[[1, 2], 5])
+        restricted = oracle.restrict(idcs)
+        assert restricted.shape == (20, 20)
+        assert np.allclose(restricted[[0, 4]], D_sub[[0, 4]])
+        assert np.allclose(restricted[2, 7], D_sub[2, 7])
+        i, j = restricted.argmax(block_size=7)
+        assert np.isclose(D_sub[i, j], D_sub.max())
+
+def test_components():
+    rng = np.random.RandomState(0)
+    # two clusters that are far apart, the second is larger
+    X = np.r_[rng.randn(40, 2), rng.randn(60, 2) + 100]
+    components = np.r_[np.ones(40), np.zeros(60)]
+    for knn, sparse in [(True, False), (True, True), (False, False)]:
+        with _max_memory(1e-9 if sparse else sett.max_memory):
+            dgraph = _small_graph(X, k=5, knn=knn)
+            dgraph.compute_transition_matrix()
+        assert sp.sparse.issparse(dgraph.K) == sparse
+        assert dgraph.n_components == 2
+        assert np.all(dgraph.components == components)
+    # a dense kernel without zeros is connected
+    dgraph = _small_graph(rng.randn(50, 2), k=5, knn=False)
+    dgraph.compute_transition_matrix()
+    assert dgraph.n_components == 1
+
+def test_embed_warm_start():
+    adata = AnnData(np.random.RandomState(0).randn(100, 3))
+    for k, warm_start in [(5, False), (5, True), (6, False)]:
+        dgraph = _small_graph(adata, k=k)
+        dgraph.compute_transition_matrix()
+        dgraph.embed(number=5)
+        assert dgraph.embed_info['warm_start'] == warm_start
@@ -186,8 +186,8 @@ def scatter(adata,
                     c = adata.smp[smp]
                 sett.m(0, '... coloring according to', smp)
             # coloring according to gene expression
-            elif smp in adata.var_names:
-                c = adata.X[:, np.where(smp==adata.var_names)[0][0]]
+            elif smp in adata.var.name_index:
+                c = adata.X[:, adata.var.name_index[smp]]
                 continuous = True
                 sett.m(0, '... coloring according to expression of gene', smp)
             else:
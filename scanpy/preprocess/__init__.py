@@ -5,6 +5,7 @@ Preprocess Data
 
 from .simple import *
 from .recipes import *
+from .plan import Plan
 
 __all__ = [
     # from simple
@@ -17,7 +18,9 @@ __all__ = [
     'zscore',
     # from recipes
     'subsample',
-    'weinreb16'
+    'weinreb16',
+    # from plan
+    'Plan'
 ]
 
 def overview():
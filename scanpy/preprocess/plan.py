@@ -0,0 +1,450 @@
+# Author: F. Alex Wolf (http://falexwolf.de)
+"""
+Preprocessing plans
+
+Record preprocessing steps and run them fused over chunks of rows of X.
+"""
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+from .. import settings as sett
+from .simple import log as _log, _scale_rows, _scale_cols, _excluded_genes
+
+class Plan():
+    """
+    Lazy sequence of preprocessing steps, run over chunks of rows of X.
+
+    The steps are recorded by calling the methods of the plan, which return the
+    plan itself, and are run by calling run. Each pass over X reads one chunk
+    at a time and applies all recorded steps to it. Steps that only transform
+    a chunk (log, row_norm with max_fraction=1) do not need a pass of their
+    own. The statistics of the gene filters and of zscore are gathered in a
+    single streaming pass, and pca is fitted by an incremental PCA on the
+    transformed chunks, so that neither X nor intermediate results are copied
+    as a whole.
+
+    Parameters
+    ----------
+    chunk_size : int or None, optional (default: None)
+        Number of rows per chunk. If None, choose it so that a dense chunk
+        takes about 1/100 of sett.max_memory.
+    inplace : bool, optional (default: False)
+        If True and X is a writeable dense np.ndarray of floats and no gene
+        filter is applied, write the result into X instead of allocating a new
+        matrix.
+
+    Example
+    -------
+    >>> plan = Plan().row_norm(max_fraction=0.05, mult_with_mean=True)
+    >>> adata = plan.gene_filter_cv(0.01, 2).pca(50, zscore=True).run(adata)
+    """
+
+    def __init__(self, chunk_size=None, inplace=False):
+        self.chunk_size = chunk_size
+        self.inplace = inplace
+        self._steps = []
+        self._pca = None
+
+    def _add(self, step):
+        if self._pca is not None:
+            raise ValueError('pca has to be the last step of a plan')
+        self._steps.append(step)
+        return self
+
+    def log(self):
+        """
+        Apply logarithm to count data, see simple.log.
+        """
+        return self._add(_Log())
+
+    def row_norm(self, max_fraction=1, mult_with_mean=False):
+        """
+        Normalize so that every cell has the same total read count, see
+        simple.row_norm.
+        """
+        return self._add(_RowNorm(max_fraction, mult_with_mean))
+
+    def gene_filter_cv(self, Ecutoff, cvFilter):
+        """
+        Filter genes by coefficient of variance and mean, see
+        simple.gene_filter_cv.
+        """
+        return self._add(_GeneFilter('cv', Ecutoff, cvFilter))
+
+    def gene_filter_fano(self, Ecutoff, Vcutoff):
+        """
+        Filter genes by fano factor and mean, see simple.gene_filter_fano.
+        """
+        return self._add(_GeneFilter('fano', Ecutoff, Vcutoff))
+
+    def zscore(self):
+        """
+        Z-score standardize each column of X, see simple.zscore.
+        """
+        return self._add(_ZScore())
+
+    def pca(self, n_comps=50, zscore=False):
+        """
+        Compute an incremental PCA of the result and write it to X_pca.
+
+        Parameters
+        ----------
+        n_comps : int, optional (default: 50)
+            Number of PCs to compute.
+        zscore : bool, optional (default: False)
+            Compute the PCA from the z-scored result, without z-scoring X
+            itself, as done in recipes.weinreb16.
+        """
+        if self._pca is not None:
+            raise ValueError('pca has to be the last step of a plan')
+        self._pca = _PCA(n_comps, zscore)
+        return self
+
+    def run(self, adata):
+        """
+        Run the plan on adata.
+
+        Parameters
+        ----------
+        adata : AnnData
+            Annotated data matrix, X may be backed.
+
+        Returns
+        -------
+        adata : AnnData
+            Annotated data matrix with the transformed X, restricted to the
+            genes that passed the gene filters.
+
+        Writes the following to adata.
+            X_pca : np.ndarray
+                If pca has been called, the data projected on n_comps PCs.
+        """
+        chunk_size = self.chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, int(sett.max_memory * 1e9 / 100
+                                    / (8 * adata.X.shape[1])))
+        steps = self._steps + ([self._pca] if self._pca is not None else [])
+        stats = None
+        for i, step in enumerate(steps):
+            if step.needs_stats:
+                if stats is None:
+                    stats = _GeneStats()
+                    self._pass(adata, chunk_size, steps[:i], stats.update)
+                step.fit_stats(stats)
+            if step.needs_pass:
+                self._pass(adata, chunk_size, steps[:i], step.fit)
+                step.finish_fit()
+            stats = step.update_stats(stats)
+        return self._finish(adata, chunk_size)
+
+    def _pass(self, adata, chunk_size, steps, fit):
+        sett.mt(0, 'plan: pass over X with chunk_size =', chunk_size)
+        for X, start, stop in adata.chunked_X(chunk_size):
+            for step in steps:
+                X = step.transform(X)
+            fit(X)
+
+    def _finish(self, adata, chunk_size):
+        n_var = adata.X.shape[1]
+        columns = np.arange(n_var)
+        for step in self._steps:
+            if step.columns is not None:
+                columns = columns[step.columns]
+        X = adata.X
+        inplace = (self.inplace and len(columns) == n_var
+                   and type(X) == np.ndarray and X.flags.writeable
+                   and np.issubdtype(X.dtype, np.floating))
+        n_smp = X.shape[0]
+        # the result is written into preallocated arrays, for sparse results
+        # into the arrays of a CSR matrix, which grow with the chunks
+        X_new, Y = None, None
+        if self._pca is not None:
+            Y = np.empty((n_smp, self._pca.n_comps), dtype=sett.dtype)
+        sett.mt(0, 'plan: pass over X with chunk_size =', chunk_size)
+        for X, start, stop in adata.chunked_X(chunk_size):
+            for step in self._steps:
+                X = step.transform(X)
+            if inplace:
+                adata.X[start:stop] = X
+            elif self._steps:
+                if X_new is None:
+                    X_new = (_CSRBuilder(n_smp, len(columns), X.dtype)
+                             if sp.sparse.issparse(X) else
+                             np.empty((n_smp, len(columns)), dtype=X.dtype))
+                X_new[start:stop] = X
+            if Y is not None:
+                Y[start:stop] = self._pca.project(X)
+        if len(columns) < n_var:
+            adata = adata[:, columns]
+        if X_new is not None:
+            adata.X = (X_new.tocsr() if isinstance(X_new, _CSRBuilder)
+                       else X_new)
+        if Y is not None:
+            adata['X_pca'] = Y
+            sett.m(0, 'X_pca has shape n_samples x n_comps =',
+                   adata['X_pca'].shape[0], 'x', adata['X_pca'].shape[1])
+        sett.mt(0, 'finished plan')
+        return adata
+
+#--------------------------------------------------------------------------------
+# Helper Classes
+#--------------------------------------------------------------------------------
+
+class _Step():
+    """
+    A step transforms chunks and may be fitted in a pass over X before.
+
+    needs_stats : bool
+        Whether fit_stats requires the gene statistics of the input.
+    needs_pass : bool
+        Whether fit has to be called for each transformed chunk of the input.
+    columns : np.ndarray or None
+        Indices of the genes kept by the step.
+    """
+    needs_stats = False
+    needs_pass = False
+    columns = None
+
+    def fit_stats(self, stats):
+        pass
+
+    def fit(self, X):
+        pass
+
+    def finish_fit(self):
+        pass
+
+    def transform(self, X):
+        return X
+
+    def update_stats(self, stats):
+        """
+        Gene statistics of the output, if they can be derived from stats.
+        """
+        return None
+
+class _Log(_Step):
+
+    def transform(self, X):
+        return _log(X)
+
+class _RowNorm(_Step):
+
+    def __init__(self, max_fraction, mult_with_mean):
+        if max_fraction < 0 or max_fraction > 1:
+            raise ValueError('choose max_fraction between 0 and 1')
+        self.max_fraction = max_fraction
+        self.mult_with_mean = mult_with_mean
+        self.needs_pass = max_fraction < 1 or mult_with_mean
+        self.included = None
+        self.factor = 1
+        self._excluded = None
+        self._sum = 0
+        self._n = 0
+
+    def fit(self, X):
+        total_counts = _row_sums(X)
+        self._sum += total_counts.sum()
+        self._n += X.shape[0]
+        if self.max_fraction < 1:
+            excluded = _excluded_genes(X, self.max_fraction * total_counts)
+            self._excluded = (excluded if self._excluded is None
+                              else self._excluded | excluded)
+
+    def finish_fit(self):
+        if self.mult_with_mean:
+            self.factor = self._sum / self._n
+        if self.max_fraction < 1:
+            self.included = ~self._excluded
+
+    def transform(self, X):
+        if self.included is None:
+            total_counts = _row_sums(X)
+        else:
+            total_counts = _row_sums(X[:, self.included]) + 1e-6
+        return _scale_rows(X, self.factor / total_counts)
+
+class _GeneFilter(_Step):
+    needs_stats = True
+
+    def __init__(self, kind, Ecutoff, cutoff):
+        self.kind = kind
+        self.Ecutoff = Ecutoff
+        self.cutoff = cutoff
+
+    def fit_stats(self, stats):
+        mean, var = stats.mean, stats.var
+        if self.kind == 'cv':
+            var_filter = np.sqrt(var) / (mean + .0001) > self.cutoff
+        else:
+            var_filter = var / (mean + .0001) > self.cutoff
+        self.columns = np.flatnonzero((mean > self.Ecutoff) & var_filter)
+        sett.m(0, 'plan: keeping', len(self.columns), 'of', len(mean), 'genes')
+
+    def transform(self, X):
+        return X[:, self.columns]
+
+    def update_stats(self, stats):
+        return stats.subset(self.columns)
+
+class _ZScore(_Step):
+    needs_stats = True
+
+    def fit_stats(self, stats):
+        self.mean = stats.mean
+        self.scale = 1 / (np.sqrt(stats.var) + .0001)
+
+    def transform(self, X):
+        # as simple.zscore, do not densify sparse X by centering
+        if sp.sparse.issparse(X):
+            return _scale_cols(X, self.scale)
+        X = np.subtract(X, self.mean, dtype=sett.dtype)
+        X *= self.scale
+        return X
+
+class _PCA(_Step):
+    needs_pass = True
+
+    def __init__(self, n_comps, zscore):
+        self.n_comps = n_comps
+        self.needs_stats = zscore
+        self.mean = 0
+        self.scale = 1
+        self.ipca = None
+        self._pending = None
+
+    def fit_stats(self, stats):
+        self.mean = stats.mean
+        self.scale = 1 / (np.sqrt(stats.var) + .0001)
+
+    def _prepare(self, X):
+        X = X.toarray() if sp.sparse.issparse(X) else X
+        X = np.subtract(X, self.mean, dtype=sett.dtype)
+        X *= self.scale
+        return X
+
+    def fit(self, X):
+        if self.ipca is None:
+            from sklearn.decomposition import IncrementalPCA
+            if X.shape[1] <= self.n_comps:
+                self.n_comps = X.shape[1] - 1
+                sett.m(0, 'reducing number of computed PCs to',
+                       self.n_comps, 'as dim of data is only', X.shape[1])
+            self.ipca = IncrementalPCA(n_components=self.n_comps)
+        X = self._prepare(X)
+        # each batch of partial_fit needs at least n_comps rows, keep one
+        # batch pending, merge chunks into it while it is short and merge a
+        # short chunk into it, so that the last batch is not short either
+        if self._pending is None:
+            self._pending = X
+        elif (self._pending.shape[0] < self.n_comps
+              or X.shape[0] < self.n_comps):
+            self._pending = np.vstack([self._pending, X])
+        else:
+            self.ipca.partial_fit(self._pending)
+            self._pending = X
+
+    def finish_fit(self):
+        self.ipca.partial_fit(self._pending)
+        self._pending = None
+
+    def project(self, X):
+        return self.ipca.transform(self._prepare(X))
+
+class _CSRBuilder():
+    """
+    Assemble a CSR matrix of known shape from consecutive chunks of rows.
+    """
+
+    def __init__(self, n_rows, n_cols, dtype):
+        self.shape = (n_rows, n_cols)
+        self.indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        self.data = np.empty(0, dtype=dtype)
+        self.indices = np.empty(0, dtype=np.int32)
+        self.nnz = 0
+
+    def __setitem__(self, rows, X):
+        X = X.tocsr()
+        start, stop = rows.start, rows.stop
+        nnz = self.nnz + X.nnz
+        if nnz > self.data.size:
+            # grow geometrically to amortize the copies
+            size = max(nnz, int(1.5 * self.data.size))
+            self.data = np.resize(self.data, size)
+            self.indices = np.resize(self.indices, size)
+        self.data[self.nnz:nnz] = X.data
+        self.indices[self.nnz:nnz] = X.indices
+        self.indptr[start+1:stop+1] = self.nnz + X.indptr[1:]
+        self.nnz = nnz
+
+    def tocsr(self):
+        return sp.sparse.csr_matrix((self.data[:self.nnz],
+                                     self.indices[:self.nnz], self.indptr),
+                                    shape=self.shape)
+
+class _GeneStats():
+    """
+    Means and variances of the columns of X, accumulated over chunks in float64.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.sum = 0
+        self.sum_sq = 0
+
+    def update(self, X):
+        self.n += X.shape[0]
+        self.sum = self.sum + np.asarray(X.sum(axis=0, dtype=np.float64)).ravel()
+        X_sq = X.multiply(X) if sp.sparse.issparse(X) else np.square(X)
+        self.sum_sq = (self.sum_sq
+                       + np.asarray(X_sq.sum(axis=0, dtype=np.float64)).ravel())
+
+    @property
+    def mean(self):
+        return self.sum / self.n
+
+    @property
+    def var(self):
+        return np.maximum(self.sum_sq / self.n - self.mean**2, 0)
+
+    def subset(self, columns):
+        stats = _GeneStats()
+        stats.n = self.n
+        stats.sum = self.sum[columns]
+        stats.sum_sq = self.sum_sq[columns]
+        return stats
+
+#--------------------------------------------------------------------------------
+# Helper Functions
+#--------------------------------------------------------------------------------
+
+def _row_sums(X):
+    return np.asarray(X.sum(axis=1)).ravel()
+
+def test_plan():
+    from ..classes.ann_data import AnnData
+    from .simple import row_norm, gene_filter_cv, zscore
+    rng = np.random.RandomState(0)
+    # counts with a low-rank structure, 53 rows leave a short last chunk
+    X = rng.poisson(np.exp(rng.randn(53, 5).dot(rng.randn(5, 40)) / 2))
+    X = X.astype(float)
+    for X_in in [X, sp.sparse.csr_matrix(X)]:
+        X_eager = _log(row_norm(X_in, max_fraction=0.5, mult_with_mean=True))
+        # the mean cutoff removes about half of the genes
+        Ecutoff = np.median(np.asarray(X_eager.mean(axis=0)).ravel())
+        genes = gene_filter_cv(X_eager, Ecutoff, 0.1)
+        assert 0 < genes.size < X.shape[1]
+        X_eager = zscore(X_eager[:, genes])
+        plan = Plan(chunk_size=10)
+        plan.row_norm(max_fraction=0.5, mult_with_mean=True).log()
+        plan.gene_filter_cv(Ecutoff, 0.1).zscore().pca(5)
+        adata = plan.run(AnnData(X_in))
+        assert sp.sparse.issparse(adata.X) == sp.sparse.issparse(X_in)
+        if sp.sparse.issparse(X_in):
+            adata.X, X_eager = adata.X.toarray(), X_eager.toarray()
+        assert np.allclose(adata.X, X_eager)
+        # the incremental PCA captures about as much variance as the exact PCA
+        s = np.linalg.svd(X_eager - X_eager.mean(axis=0), compute_uv=False)
+        assert adata['X_pca'].shape == (53, 5)
+        assert np.sum(adata['X_pca']**2) > 0.99 * np.sum(s[:5]**2)
@@ -5,12 +5,17 @@ Preprocessing recipes from the literature
 
 from .. import settings as sett
 from .simple import *
+from .plan import Plan
 
 def weinreb16(adata, mean_threshold=0.01, cv_threshold=2, 
-              n_pcs=50, svd_solver='randomized', random_state=0):
+              n_pcs=50, svd_solver='randomized', random_state=0,
+              chunk_size=None):
     """
     Normalization and filtering as of Weinreb et al. (2016).
 
+    Runs on dense and on CSR/CSC X. For sparse X, no step densifies the
+    matrix, the z-scoring is completed by the implicit centering in pca.
+
     Parameters
     ----------
     adata : AnnData
@@ -21,6 +26,9 @@ def weinreb16(adata, mean_threshold=0.01, cv_threshold=2,
         due to Halko (2009).
     random_state : int, optional (default: 0)
         Change to use different intial states for the optimization.
+    chunk_size : int or None, optional (default: None)
+        If not None, run all steps fused over chunks of chunk_size rows, see
+        Plan, and compute an incremental PCA instead of using svd_solver.
 
     Reference
     ---------
@@ -28,6 +36,11 @@ def weinreb16(adata, mean_threshold=0.01, cv_threshold=2,
     """
     sett.m(0, 'preprocess: weinreb16, X has shape n_samples x n_variables =',
            adata.X.shape[0], 'x', adata.X.shape[1])
+    if chunk_size is not None:
+        plan = Plan(chunk_size=chunk_size)
+        plan.row_norm(max_fraction=0.05, mult_with_mean=True)
+        plan.gene_filter_cv(mean_threshold, cv_threshold)
+        return plan.pca(n_comps=n_pcs, zscore=True).run(adata)
     # row normalize
     adata.X = row_norm(adata.X, max_fraction=0.05, mult_with_mean=True)
     # filter out genes with mean expression < 0.1 and 
@@ -4,8 +4,11 @@ Preprocessing functions that take X as an argument
 -> "simple" preprocessing functions
 """
 
-from ..classes.ann_data import AnnData
+from ..classes.ann_data import AnnData, BoundMatrices
+from .. import settings as sett
 import numpy as np
+import scipy as sp
+import scipy.sparse.linalg
 
 def filter_cells(X, min_reads):
     """
@@ -13,20 +16,20 @@ def filter_cells(X, min_reads):
     
     Paramaters
     ----------
-    X : np.ndarray
+    X : np.ndarray or sp.sparse.spmatrix
         Data matrix. Rows correspond to cells and columns to genes.
     min_reads : int
         Minimum number of reads required for a cell to survive filtering.
     	
     Returns
     -------
-    X : np.ndarray
+    X : np.ndarray or sp.sparse.spmatrix
         Filtered data matrix.
     cell_filter : np.ndarray
         Boolean mask that reports filtering. True means that the cell is 
         kept. False means the cell is removed.
     """	
-    total_counts = np.sum(X, axis=1)
+    total_counts = np.asarray(X.sum(axis=1)).ravel()
     cell_filter = total_counts >= min_reads
     return X[cell_filter], cell_filter
 
@@ -34,8 +37,9 @@ def gene_filter_cv(X, Ecutoff, cvFilter):
     """
     Filter genes by coefficient of variance and mean.
     """
-    mean_filter = np.mean(X, axis=0) > Ecutoff
-    var_filter = np.std(X, axis=0) / (np.mean(X,axis=0) + .0001) > cvFilter
+    mean, var = _mean_var(X)
+    mean_filter = mean > Ecutoff
+    var_filter = np.sqrt(var) / (mean + .0001) > cvFilter
     gene_filter = np.nonzero(np.all([mean_filter, var_filter], axis=0))[0]
     return gene_filter
 
@@ -43,8 +47,9 @@ def gene_filter_fano(X, Ecutoff, Vcutoff):
     """
     Filter genes by fano factor and mean.
     """
-    mean_filter = np.mean(X,axis=0) > Ecutoff
-    var_filter = np.var(X,axis=0) / (np.mean(X,axis=0)+.0001) > Vcutoff
+    mean, var = _mean_var(X)
+    mean_filter = mean > Ecutoff
+    var_filter = var / (mean + .0001) > Vcutoff
     gene_filter = np.nonzero(np.all([mean_filter,var_filter],axis=0))[0]
     return gene_filter
 
@@ -52,11 +57,19 @@ def log(X):
     """ 
     Apply logarithm to count data.
 
-    Shifted by one to map 0 to 0.
+    Shifted by one to map 0 to 0, for sparse X, only the stored entries are
+    transformed. The result has dtype sett.dtype.
     """
     if isinstance(X, AnnData):
-        return AnnData(log(X.X), X.smp, X.var, **X.add)
-    X = np.log(X + 1)
+        adata = AnnData(log(X.X), X.smp, X.var, **X.add)
+        adata.smpm = BoundMatrices(adata, len(X.smp), X.smpm)
+        adata.varm = BoundMatrices(adata, len(X.var), X.varm)
+        return adata
+    if sp.sparse.issparse(X):
+        X = X.astype(sett.dtype)
+        np.log1p(X.data, out=X.data)
+        return X
+    X = np.log1p(X, dtype=sett.dtype)
     return X
 
 def pca(X, n_comps=50, zero_center=True, svd_solver='randomized', random_state=0):
@@ -71,12 +84,15 @@ def pca(X, n_comps=50, zero_center=True, svd_solver='randomized', random_state=0
         Number of PCs to compute.
     zero_center : bool, optional (default: True)
         If True, compute standard PCA from Covariance matrix. If False, omit
-        zero-centering variables, which allows to handle sparse input efficiently.
-        For sparse intput, automatically defaults to False.
+        zero-centering variables. For sparse input, the centering is applied
+        implicitly in the matrix-vector products of the SVD, so that X is not
+        densified.
     svd_solver : str, optional (default: 'randomized')
         SVD solver to use. Either “arpack” for the ARPACK wrapper in SciPy
         (scipy.sparse.linalg.svds), or “randomized” for the randomized algorithm
         due to Halko (2009).
+    random_state : int, optional (default: 0)
+        Seed for the randomized solver and the starting vector of ARPACK.
 
     Returns
     -------
@@ -93,10 +109,15 @@ def pca(X, n_comps=50, zero_center=True, svd_solver='randomized', random_state=0
         sett.mt(0, 'compute PCA with n_comps =', n_comps)
         from scipy.sparse import issparse
         if zero_center and not issparse(X):
-            Y = PCA(n_components=n_comps, svd_solver=svd_solver).fit_transform(X)
+            Y = PCA(n_components=n_comps, svd_solver=svd_solver,
+                    random_state=random_state).fit_transform(X)
+        elif zero_center:
+            sett.m(0, '... zero-centering sparse X implicitly')
+            Y = _pca_sparse_centered(X, n_comps, svd_solver, random_state)
         else:
             sett.m(0, '... without zero-centering')
             Y = TruncatedSVD(n_components=n_comps).fit_transform(X)
+        Y = Y.astype(sett.dtype, copy=False)
         sett.mt(0, 'finished')
         sett.m(1, '--> to speed this up, set option exact=False')
     except ImportError:
@@ -120,8 +141,9 @@ def row_norm(X, max_fraction=1, mult_with_mean=False):
     
     Parameters
     ----------
-    X : np.ndarray
-        Expression matrix. Rows correspond to cells and columns to genes.
+    X : np.ndarray or sp.sparse.spmatrix
+        Expression matrix. Rows correspond to cells and columns to genes. For
+        CSR and CSC matrices, the stored entries of a copy are scaled.
     max_fraction : float, optional
         Only use genes that make up less than max_fraction of the total
         reads in every cell.
@@ -130,26 +152,23 @@ def row_norm(X, max_fraction=1, mult_with_mean=False):
         
     Returns
     -------
-    Xnormalized : np.ndarray
+    Xnormalized : np.ndarray or sp.sparse.spmatrix
         Normalized version of the original expression matrix. 
     """
     from .. import settings as sett
     if max_fraction < 0 or max_fraction > 1:
         raise ValueError('choose max_fraction between 0 and 1')
-    total_counts = np.sum(X,axis=1)
+    total_counts = np.asarray(X.sum(axis=1)).ravel()
     if max_fraction == 1:
-        X_norm = X / total_counts[:,np.newaxis]
-        return X_norm
+        return _scale_rows(X, 1/total_counts)
     # restrict computation of counts to genes that make up less than
     # constrain_theshold of the total reads
-    tc_tiled = np.tile(total_counts[:, np.newaxis],(1, X.shape[1]))
-    included = np.all(X <= tc_tiled * max_fraction, axis=0)    
-    tc_include = np.sum(X[:,included], axis=1)
-    tc_tiled = np.tile(tc_include[:, np.newaxis],(1, X.shape[1])) + 1e-6
-    X_norm =  X / tc_tiled 
+    included = ~_excluded_genes(X, max_fraction * total_counts)
+    tc_include = np.asarray(X[:, included].sum(axis=1)).ravel() + 1e-6
+    factors = 1/tc_include
     if mult_with_mean:
-        X_norm *= np.mean(total_counts)
-    return X_norm
+        factors *= np.mean(total_counts)
+    return _scale_rows(X, factors)
 
 def subsample(adata, subsample, seed=0):
     """ 
@@ -171,13 +190,8 @@ def subsample(adata, subsample, seed=0):
     """
     from .. import utils
     _, smp_indices = utils.subsample(adata.X,subsample,seed)
+    # embeddings and masks in adata.smpm are subsampled together with X
     adata = adata[smp_indices, ]
-    for key in ['X_pca']:
-        if key in adata:
-            adata[key] = adata[key][smp_indices]
-    for k in adata.smp_keys():
-        if k + '_masks' in adata:
-            adata[k + '_masks'] = adata[k + '_masks'][:, smp_indices]
     adata['subsample'] = True
     return adata
 
@@ -185,24 +199,144 @@ def zscore(X):
     """
     Z-score standardize each column of X.
     
+    For CSR and CSC matrices, the stored entries of a copy are divided by the
+    standard deviations, but the means are not subtracted, as this would
+    densify X. pca with zero_center=True subtracts them implicitly, so that
+    pca(zscore(X)) is the same for dense and sparse X.
+
     Parameters
     ----------
-    X : np.ndarray
+    X : np.ndarray or sp.sparse.spmatrix
         Data matrix. Rows correspond to cells and columns to genes.
         
     Returns
     -------
-    XZ : np.ndarray 
+    XZ : np.ndarray or sp.sparse.spmatrix
         Z-score standardized version of the data matrix.
     """
-    means = np.tile(np.mean(X,axis=0)[None,:],(X.shape[0],1))
-    stds = np.tile(np.std(X,axis=0)[None,:],(X.shape[0],1))
-    return (X - means) / (stds + .0001)
+    mean, var = _mean_var(X)
+    if sp.sparse.issparse(X):
+        return _scale_cols(X, 1/(np.sqrt(var) + .0001))
+    XZ = np.subtract(X, mean, dtype=sett.dtype)
+    XZ /= np.sqrt(var) + .0001
+    return XZ
 
 #--------------------------------------------------------------------------------
 # Helper Functions
 #--------------------------------------------------------------------------------
 
+def _mean_var(X):
+    """
+    Means and variances of the columns of X, computed by sparse reductions
+    for sparse X and accumulated in float64.
+    """
+    if not sp.sparse.issparse(X):
+        return (np.mean(X, axis=0, dtype=np.float64),
+                np.var(X, axis=0, dtype=np.float64))
+    mean = np.asarray(X.mean(axis=0, dtype=np.float64)).ravel()
+    Xsq = X.copy()
+    Xsq.data **= 2
+    mean_sq = np.asarray(Xsq.mean(axis=0, dtype=np.float64)).ravel()
+    return mean, np.maximum(mean_sq - mean**2, 0)
+
+def _excluded_genes(X, thresholds):
+    """
+    Boolean mask of the genes that exceed the threshold of their row in any row.
+    """
+    if not sp.sparse.issparse(X):
+        return np.any(X > thresholds[:, np.newaxis], axis=0)
+    # zeros never exceed the threshold, only check stored entries
+    X = X.tocoo()
+    excluded = np.zeros(X.shape[1], dtype=bool)
+    excluded[X.col[X.data > thresholds[X.row]]] = True
+    return excluded
+
+def _scale_rows(X, factors):
+    """
+    Multiply the rows of X with factors, for CSR and CSC matrices only the
+    stored entries of a copy. The result has dtype sett.dtype.
+    """
+    if not sp.sparse.issparse(X):
+        return np.multiply(X, factors[:, np.newaxis], dtype=sett.dtype)
+    X = _float_copy(X)
+    if X.format == 'csr':
+        X.data *= np.repeat(factors, np.diff(X.indptr))
+    else:
+        X.data *= factors[X.indices]
+    return X
+
+def _scale_cols(X, factors):
+    """
+    Multiply the columns of X with factors, see _scale_rows.
+    """
+    if not sp.sparse.issparse(X):
+        return np.multiply(X, factors, dtype=sett.dtype)
+    X = _float_copy(X)
+    if X.format == 'csr':
+        X.data *= factors[X.indices]
+    else:
+        X.data *= np.repeat(factors, np.diff(X.indptr))
+    return X
+
+def _float_copy(X):
+    """
+    Copy of sparse X in CSR or CSC format with dtype sett.dtype.
+
+    Converting the format or the dtype already copies X, it is not copied
+    another time.
+    """
+    if X.format not in {'csr', 'csc'}:
+        X = X.tocsr()
+        copied = True
+    else:
+        copied = False
+    if X.dtype != sett.dtype:
+        return X.astype(sett.dtype)
+    return X if copied else X.copy()
+
+def _pca_sparse_centered(X, n_comps, svd_solver='randomized', random_state=0):
+    """
+    PCA of sparse X with zero-centered columns, without densifying X.
+
+    The SVD of X - 1 mean^T is computed by ARPACK or by the randomized
+    algorithm of Halko et al. (2009), which only require products of X and
+    X^T with vectors.
+    """
+    if svd_solver not in {'arpack', 'randomized'}:
+        raise ValueError('svd_solver needs to be "arpack" or "randomized" '
+                         'for sparse X')
+    X = X.astype(sett.dtype, copy=False)
+    mean = np.asarray(X.mean(axis=0, dtype=np.float64)).ravel()
+    mean = mean.astype(sett.dtype)
+
+    # products with vectors and with matrices of stacked vectors
+    def matvec(V):
+        return X.dot(V) - mean.dot(V)
+
+    def rmatvec(U):
+        return X.T.dot(U) - np.multiply.outer(mean, U.sum(axis=0))
+
+    rng = np.random.RandomState(random_state)
+    if svd_solver == 'randomized':
+        # range finder with power iterations, as in
+        # sklearn.utils.extmath.randomized_svd, with centered products
+        Q = rng.randn(X.shape[1], min(n_comps + 10, min(X.shape)))
+        Q = matvec(Q)
+        for i in range(4):
+            Q, _ = np.linalg.qr(Q)
+            Q, _ = np.linalg.qr(rmatvec(Q))
+            Q = matvec(Q)
+        Q, _ = np.linalg.qr(Q)
+        U, s, Vt = np.linalg.svd(rmatvec(Q).T, full_matrices=False)
+        U = Q.dot(U[:, :n_comps])
+        return U * s[:n_comps]
+    Xc = sp.sparse.linalg.LinearOperator(X.shape, matvec=matvec,
+                                         rmatvec=rmatvec, dtype=sett.dtype)
+    v0 = rng.uniform(-1, 1, min(X.shape))
+    U, s, Vt = sp.sparse.linalg.svds(Xc, k=n_comps, v0=v0)
+    order = np.argsort(-s)
+    return U[:, order] * s[order]
+
 def _pca_fallback(data, n_comps=2):
     # mean center the data
     data -= data.mean(axis=0)
@@ -223,3 +357,32 @@ def _pca_fallback(data, n_comps=2):
     # project data points on eigenvectors
     return np.dot(evecs.T, data.T).T
 
+
+def test_sparse():
+    rng = np.random.RandomState(0)
+    # sparse counts with a low-rank structure
+    X = rng.poisson(np.exp(rng.randn(60, 2).dot(rng.randn(2, 30)) - 1))
+    X_sparse = sp.sparse.csr_matrix(X)
+    min_reads = np.median(X.sum(axis=1))
+    assert np.all(filter_cells(X_sparse, min_reads)[1]
+                  == filter_cells(X, min_reads)[1])
+    assert np.all(gene_filter_cv(X_sparse, 0.1, 0.5)
+                  == gene_filter_cv(X, 0.1, 0.5))
+    assert np.allclose(log(X_sparse).toarray(), log(X))
+    for format in ['csr', 'csc']:
+        Xs = X_sparse.asformat(format)
+        Xs_norm = row_norm(Xs, max_fraction=0.3, mult_with_mean=True)
+        assert Xs_norm.format == format
+        assert np.allclose(Xs_norm.toarray(),
+                           row_norm(X, max_fraction=0.3, mult_with_mean=True))
+        # the input is not modified
+        assert np.all(Xs.toarray() == X)
+    # sparse zscore only scales, pca centers implicitly
+    XZ = zscore(X)
+    XZ_sparse = zscore(X_sparse)
+    assert np.allclose(XZ_sparse.toarray() - XZ_sparse.toarray().mean(axis=0),
+                       XZ)
+    s = np.linalg.svd(XZ, compute_uv=False)[:2]
+    for svd_solver in ['arpack', 'randomized']:
+        Y = pca(XZ_sparse, n_comps=2, svd_solver=svd_solver)
+        assert np.allclose(np.linalg.norm(Y, axis=0), s, rtol=1e-2)
@@ -10,7 +10,8 @@ import numpy as np
 
 from . import settings as sett
 
-avail_exts = ['csv', 'xlsx', 'txt', 'h5', 'soft.gz', 'txt.gz', 'mtx', 'tab', 'data']
+avail_exts = ['csv', 'xlsx', 'txt', 'h5', 'soft.gz', 'txt.gz', 'mtx', 'mtx.gz',
+              'tab', 'data']
 """ Available file formats for reading data. """
 
 #--------------------------------------------------------------------------------
@@ -48,7 +49,7 @@ def write(filename_or_key, dict_or_adata):
     write_dict_to_file(filename, dictionary, ext=sett.extd)
 
 def read(filename_or_key, sheet='', ext='', delim=None, first_column_names=None,
-         as_strings=False, backup_url='', return_dict=False):
+         as_strings=False, backup_url='', return_dict=False, backed=False):
     """
     Read file or dictionary and return data dictionary.
 
@@ -77,6 +78,11 @@ def read(filename_or_key, sheet='', ext='', delim=None, first_column_names=None,
         Retrieve the file from a URL if not present on disk.
     return_dict : bool, optional (default: False)
         Return dictionary instead of AnnData object.
+    backed : bool, optional (default: False)
+        Do not load the data matrix X into memory, but keep it in the hdf5
+        file, see classes.ann_data.BackedArray. Slicing the returned AnnData only reads
+        the selected rows and columns. Files of other formats are read once
+        and converted to hdf5 first.
 
     Returns
     -------
@@ -94,7 +100,7 @@ def read(filename_or_key, sheet='', ext='', delim=None, first_column_names=None,
     from .classes.ann_data import AnnData
     if is_filename(filename_or_key):
         d = read_file(filename_or_key, sheet, ext, delim, first_column_names,
-                      as_strings, backup_url)
+                      as_strings, backup_url, backed)
         if return_dict:
             return d
         else:
@@ -111,7 +117,7 @@ def read(filename_or_key, sheet='', ext='', delim=None, first_column_names=None,
                          'use a filename on one of the available extensions\n' +
                          str(avail_exts) +
                          '\nor provide the parameter "ext" to sc.read.')
-    d = read_file_to_dict(filename, ext=sett.extd)
+    d = read_file_to_dict(filename, ext=sett.extd, backed=backed)
     if return_dict:
         return d
     else:
@@ -192,7 +198,7 @@ def get_params_from_list(params_list):
 #--------------------------------------------------------------------------------
 
 def read_file(filename, sheet='', ext='', delim=None, first_column_names=None,
-              as_strings=False, backup_url=''):
+              as_strings=False, backup_url='', backed=False):
     """
     Read file and return data dictionary.
 
@@ -218,6 +224,8 @@ def read_file(filename, sheet='', ext='', delim=None, first_column_names=None,
         Read names instead of numbers.
     backup_url : str
         URL for download of file in case it's not present.
+    backed : bool, optional (default: False)
+        Keep the data matrix X in the hdf5 file, see read.
 
     Returns
     -------
@@ -244,7 +252,7 @@ def read_file(filename, sheet='', ext='', delim=None, first_column_names=None,
     # read hdf5 files
     if ext == 'h5':
         if sheet == '':
-            return read_file_to_dict(filename, ext=sett.extd)
+            return read_file_to_dict(filename, ext=sett.extd, backed=backed)
         else:
             sett.m(0, 'reading sheet', sheet, 'from file', filename)
             return _read_hdf5_single(filename, sheet)
@@ -265,7 +273,7 @@ def read_file(filename, sheet='', ext='', delim=None, first_column_names=None,
                 ddata = read_file_to_dict(filename, ext=ext)
             else:
                 ddata = _read_excel(filename, sheet)
-        elif ext == 'mtx':
+        elif ext in ['mtx', 'mtx.gz']:
             ddata = _read_mtx(filename)
         elif ext == 'csv':
             ddata = read_txt(filename, delim=',',
@@ -286,20 +294,197 @@ def read_file(filename, sheet='', ext='', delim=None, first_column_names=None,
             raise ValueError('Unkown extension', ext)
         # write as fast for faster reading when calling the next time
         write_dict_to_file(filename_fast, ddata, sett.extd)
+        if backed:
+            ddata = read_file_to_dict(filename_fast, sett.extd, backed=True)
     else:
-        ddata = read_file_to_dict(filename_fast, sett.extd)
+        ddata = read_file_to_dict(filename_fast, sett.extd, backed=backed)
     return ddata
 
-def _read_mtx(filename):
+def _read_mtx(filename, chunk_size=1000000):
     """
-    Read mtx file.
+    Read Matrix Market file into CSR, also if gzip-compressed.
+
+    Entries are parsed in chunks of chunk_size lines into arrays of size nnz.
+    If they are sorted by the rows of the result, as in the column-major
+    files of 10x Genomics after transposition, they are placed in the CSR
+    arrays directly. Otherwise, they are sorted once in the end.
+
+    Names are read from the files barcodes.tsv and genes.tsv or features.tsv
+    in the directory of filename, also if gzip-compressed, see
+    _read_mtx_names.
     """
-    from scipy.io import mmread
-    X = mmread(filename)
-    from scipy.sparse.csr import csr_matrix
-    X = csr_matrix(X)
-    sett.m(0, '... did not find row_names or col_names')
-    return {'X': X}
+    import gzip
+    from itertools import islice
+    from scipy.sparse import csr_matrix
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as f:
+        banner = f.readline().decode().lower().split()
+        if (len(banner) < 5 or banner[2] != 'coordinate'
+            or banner[3] not in {'real', 'integer', 'pattern'}
+            or banner[4] != 'general'):
+            # dense, symmetric and complex matrices are rare, let scipy do it
+            from scipy.io import mmread
+            X = csr_matrix(mmread(filename), dtype=sett.dtype)
+            return _mtx_to_ddata(filename, X)
+        line = f.readline()
+        while line.startswith(b'%') or not line.strip():
+            line = f.readline()
+        n_rows, n_cols, nnz = [int(x) for x in line.split()]
+        ddata = _read_mtx_names(filename, n_rows, n_cols)
+        transpose = ddata.pop('transpose')
+        n_major, n_minor = (n_cols, n_rows) if transpose else (n_rows, n_cols)
+        n_fields = 2 if banner[3] == 'pattern' else 3
+        data = np.ones(nnz, dtype=sett.dtype)
+        indices = np.empty(nnz, dtype=np.int32)
+        counts = np.zeros(n_major, dtype=np.int64)
+        majors = None
+        pos = 0
+        last = 0
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
+            entries = np.array(b''.join(lines).split(), dtype=np.float64)
+            # chunks of blank lines at the end of the file
+            if entries.size == 0:
+                continue
+            entries = entries.reshape(-1, n_fields)
+            if pos + entries.shape[0] > nnz:
+                raise ValueError('{} stores more than {} entries'
+                                 .format(filename, nnz))
+            major = entries[:, 1 if transpose else 0].astype(np.int64) - 1
+            minor = entries[:, 0 if transpose else 1].astype(np.int64) - 1
+            if majors is None and (major[0] < last or np.any(np.diff(major) < 0)):
+                # the entries so far are sorted, recover their rows
+                majors = np.empty(nnz, dtype=np.int32)
+                majors[:pos] = np.repeat(np.arange(n_major), counts)
+            stop = pos + entries.shape[0]
+            indices[pos:stop] = minor
+            if n_fields == 3:
+                data[pos:stop] = entries[:, 2]
+            if majors is not None:
+                majors[pos:stop] = major
+            counts += np.bincount(major, minlength=n_major)
+            last = major[-1]
+            pos = stop
+    if pos != nnz:
+        raise ValueError('{} stores {} instead of {} entries'
+                         .format(filename, pos, nnz))
+    if majors is not None:
+        sett.m(0, '... sorting entries by row')
+        order = np.argsort(majors, kind='mergesort')
+        del majors
+        indices, data = indices[order], data[order]
+    indptr = np.r_[0, np.cumsum(counts)]
+    ddata['X'] = csr_matrix((data, indices, indptr), shape=(n_major, n_minor))
+    sett.mt(0, 'read', nnz, 'entries of', n_major, 'x', n_minor, 'matrix')
+    return ddata
+
+def _mtx_to_ddata(filename, X):
+    ddata = _read_mtx_names(filename, X.shape[0], X.shape[1])
+    ddata['X'] = X.T.tocsr() if ddata.pop('transpose') else X
+    return ddata
+
+def _read_mtx_names(filename, n_rows, n_cols):
+    """
+    Read names of a Matrix Market file from the 10x Genomics sidecar files.
+
+    Returns
+    -------
+    ddata : dict containing
+        transpose : bool
+            Whether the rows of the file correspond to genes, so that the
+            matrix needs to be transposed to store barcodes in rows.
+        row_names : np.ndarray, optional
+            The barcodes.
+        col_names : np.ndarray, optional
+            The gene names, the second column of genes.tsv or features.tsv.
+        col : dict, optional
+            Stores the gene ids, the first column, as 'gene_ids'.
+    """
+    import gzip
+    dirname = os.path.dirname(filename)
+
+    def read_columns(basenames):
+        for basename in basenames:
+            for suffix in ['', '.gz']:
+                path = os.path.join(dirname, basename + suffix)
+                if os.path.exists(path):
+                    opener = gzip.open if suffix else open
+                    with opener(path, 'rt') as f:
+                        return [line.rstrip('\r\n').split('\t')
+                                for line in f if line.strip()]
+        return None
+
+    barcodes = read_columns(['barcodes.tsv'])
+    genes = read_columns(['genes.tsv', 'features.tsv'])
+    ddata = {'transpose': False}
+    if genes is not None and len(genes) == n_rows:
+        ddata['transpose'] = True
+        n_rows, n_cols = n_cols, n_rows
+    if barcodes is not None and len(barcodes) == n_rows:
+        ddata['row_names'] = np.array([row[0] for row in barcodes], dtype=str)
+    if genes is not None and len(genes) == n_cols:
+        ddata['col_names'] = np.array([row[1] if len(row) > 1 else row[0]
+                                       for row in genes], dtype=str)
+        ddata['col'] = {'gene_ids': np.array([row[0] for row in genes],
+                                             dtype=str)}
+    if 'row_names' not in ddata or 'col_names' not in ddata:
+        sett.m(0, '... did not find row_names or col_names')
+    return ddata
+
+def read_10x_h5(filename, genome=None):
+    """
+    Read a 10x Genomics hdf5 file into an AnnData with CSR X.
+
+    The file stores a genes x barcodes matrix in CSC format, which is the
+    barcodes x genes matrix in CSR format. The index arrays are therefore
+    read as they are, without densifying or converting the matrix.
+
+    Parameters
+    ----------
+    filename : str, Path
+        Filename of the hdf5 file.
+    genome : str or None, optional (default: None)
+        Group of the genome to read. If None, read the group 'matrix' of
+        newer files or, for older files, the only group.
+
+    Returns
+    -------
+    adata : AnnData
+        Annotated data matrix, whose sample names are the barcodes and whose
+        variable names are the gene names. The annotation 'gene_ids' stores
+        the gene ids.
+    """
+    from scipy.sparse import csr_matrix
+    from .classes.ann_data import AnnData
+    filename = str(filename)  # allow passing pathlib.Path objects
+    with h5py.File(filename, 'r') as f:
+        if genome is None:
+            if 'matrix' in f:
+                genome = 'matrix'
+            elif len(f.keys()) == 1:
+                genome = list(f.keys())[0]
+            else:
+                raise ValueError('choose genome from ' + str(list(f.keys())))
+        group = f[genome]
+        n_genes, n_barcodes = group['shape'][()]
+        X = csr_matrix((group['data'][()].astype(sett.dtype, copy=False),
+                        group['indices'][()], group['indptr'][()]),
+                       shape=(n_barcodes, n_genes))
+        if 'features' in group:
+            gene_names = group['features/name'][()]
+            gene_ids = group['features/id'][()]
+        else:
+            gene_names = group['gene_names'][()]
+            gene_ids = group['genes'][()]
+        barcodes = group['barcodes'][()]
+    sett.m(0, 'read', X.nnz, 'entries of', n_barcodes, 'x', n_genes,
+           'matrix from', filename)
+    return AnnData({'X': X,
+                    'row_names': barcodes.astype(str),
+                    'col_names': gene_names.astype(str),
+                    'col': {'gene_ids': gene_ids.astype(str)}})
 
 def read_txt(filename, delim=None, first_column_names=None, as_strings=False):
     """
@@ -336,7 +521,16 @@ def read_txt(filename, delim=None, first_column_names=None, as_strings=False):
 
 def read_txt_as_floats(filename, delim=None, first_column_names=None):
     """
-    Return data as list of lists of strings and the header as string.
+    Read a text file that stores a matrix of floats and its names.
+
+    The header, the column names and whether the first column stores row names
+    are detected from the first lines. The remaining lines are split into byte
+    ranges of about 4 MB, each of which is read and parsed once by a pool of
+    sett.n_jobs processes. The parsed ranges are copied into the result as
+    they arrive, which is allocated from the number of rows in the first range
+    and grown if needed. Files with a single range are parsed in the calling
+    process. Apart from the result, at most two ranges per process are held
+    in memory.
 
     Parameters
     ----------
@@ -346,38 +540,46 @@ def read_txt_as_floats(filename, delim=None, first_column_names=None):
         Separator that separates data within text file. If None, will split at
         arbitrary number of white spaces, which is different from enforcing
         splitting at single white space ' '.
+    first_column_names : bool, optional
+        Assume the first column stores row names.
 
     Returns
     -------
-    data : list
-         List of lists of strings.
-    header : str
-         String storing the comment lines (those that start with '#').
+    ddata : dict containing
+        X : np.ndarray
+            Data array of dtype sett.dtype.
+        row_names : np.ndarray
+            Array storing the names of rows.
+        col_names : np.ndarray
+            Array storing the names of columns.
     """
     filename = str(filename)  # allow passing pathlib.Path objects
     header = ''
-    data = []
-    length = -1
-    f = open(filename)
     col_names = []
-    row_names = []
-    # read header and column names
-    for line in f:
-        if line.startswith('#'):
-            header += line
-        else:
-            line_list = line.split(delim)
-            if not is_float(line_list[0]):
+    # read header and column names, determine where the data starts
+    with open(filename, 'rb') as f:
+        while True:
+            offset = f.tell()
+            line = f.readline().decode()
+            if not line:
+                raise ValueError('did not find data in file ' + filename)
+            if line.startswith('#'):
+                header += line
+                continue
+            if not line.strip():
+                continue
+            line_list = line.rstrip('\r\n').split(delim)
+            if not col_names and not is_float(line_list[0]):
                 col_names = line_list
                 sett.m(0, '--> assuming first line in file stores column names')
-            else:
-                if not is_float(line_list[0]) or first_column_names:
-                    first_column_names = True
-                    row_names.append(line_list[0])
-                    data.append(line_list[1:])
-                else:
-                    data.append(line_list)
+                continue
+            if not is_float(line_list[0]) and not first_column_names:
+                sett.m(0, '--> assuming first column in file stores row names')
+                first_column_names = True
+            n_cols = len(line_list) - (1 if first_column_names else 0)
             break
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
     if not col_names:
         # try reading col_names from the last comment line
         if len(header) > 0:
@@ -386,53 +588,119 @@ def read_txt_as_floats(filename, delim=None, first_column_names=None):
         # just numbers as col_names
         else:
             sett.m(0,'--> did not find column names in file')
-            col_names = np.arange(len(data[0])).astype(str)
+            col_names = np.arange(n_cols).astype(str)
     col_names = np.array(col_names, dtype=str)
-    # check if first column contains row names or not
-    if first_column_names is None:
-        first_column_names = False
-    for line in f:
-        line_list = line.split(delim)
-        if not is_float(line_list[0]) or first_column_names:
-            sett.m(0, '--> assuming first column in file stores row names')
-            first_column_names = True
-            row_names.append(line_list[0])
-            data.append(line_list[1:])
-        else:
-            data.append(line_list)
-        break
-    # parse the file
-    for line in f:
-        line_list = line.split(delim)
-        if first_column_names:
-            row_names.append(line_list[0])
-            data.append(line_list[1:])
+    # split the data into byte ranges that start at the beginning of a line,
+    # ranges of 4 MB keep the memory of the parsed strings small
+    n_ranges = max(1, int(np.ceil((size - offset) / _txt_range_size)))
+    bounds = [offset]
+    with open(filename, 'rb') as f:
+        for irange in range(1, n_ranges):
+            f.seek(max(offset + irange * (size - offset) // n_ranges - 1,
+                       bounds[-1]))
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    args = [(filename, start, stop, delim, first_column_names, n_cols,
+             sett.dtype) for start, stop in ranges]
+    pool = None
+    if sett.n_jobs > 1 and len(ranges) > 1:
+        from multiprocessing import Pool
+        n_processes = min(sett.n_jobs, len(ranges))
+        pool = Pool(n_processes)
+    try:
+        if pool is not None:
+            parsed = _imap_bounded(pool, _parse_txt_range, args,
+                                   2 * n_processes)
         else:
-            data.append(line_list)
-    sett.mt(0, 'read data into list of lists')
-    # transfrom to array, this takes a long time and a lot of memory
-    # but it's actually the same thing as np.genfromtext does
-    # - we don't use the latter as it would involve another slicing step
-    #   in the end, to separate row_names from float data, slicing takes
-    #   a lot of memory and cpu time
-    data = np.array(data, dtype=np.float64)
-    sett.mt(0, 'constructed array from list of list')
+            parsed = map(_parse_txt_range, args)
+        data = None
+        row_start, row_names = 0, []
+        for (start, stop), (X, names) in zip(ranges, parsed):
+            row_stop = row_start + X.shape[0]
+            if data is None:
+                # estimate the number of rows from the first range
+                n_rows = int(1.1 * X.shape[0] * (size - offset)
+                             / (stop - start))
+                data = np.empty((max(n_rows, row_stop), n_cols),
+                                dtype=sett.dtype)
+            elif row_stop > data.shape[0]:
+                data.resize((max(row_stop, 3 * data.shape[0] // 2), n_cols),
+                            refcheck=False)
+            data[row_start:row_stop] = X
+            row_start = row_stop
+            row_names += names
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    data.resize((row_start, n_cols), refcheck=False)
+    sett.mt(0, 'read data into array of shape', data.shape,
+            'using', len(ranges), 'byte ranges')
     # transform row_names
     if not row_names:
         row_names = np.arange(len(data)).astype(str)
         sett.m(0,'--> did not find row names in file')
     else:
-        row_names = np.array(row_names)
-        for iname, name in enumerate(row_names):
-            row_names[iname] = name.strip('"')
+        row_names = np.array(row_names, dtype=str)
     # adapt col_names if necessary
     if col_names.size > data.shape[1]:
         col_names = col_names[1:]
-    for iname, name in enumerate(col_names):
-        col_names[iname] = name.strip('"')
+    col_names = np.char.strip(col_names, '"')
     ddata = {'X': data, 'row_names': row_names, 'col_names': col_names}
     return ddata
 
+_txt_range_size = 2**22
+""" Size in bytes of the ranges parsed by read_txt_as_floats. """
+
+def _imap_bounded(pool, func, iterable, n_tasks):
+    """
+    Like pool.imap, but submit at most n_tasks tasks ahead of the result that
+    is consumed, so that at most n_tasks results wait in memory.
+    """
+    from collections import deque
+    tasks = deque()
+    for args in iterable:
+        if len(tasks) == n_tasks:
+            yield tasks.popleft().get()
+        tasks.append(pool.apply_async(func, (args,)))
+    while tasks:
+        yield tasks.popleft().get()
+
+def _parse_txt_range(args):
+    """
+    Parse the lines in a byte range of a file.
+
+    Returns
+    -------
+    X : np.ndarray
+        The parsed rows, their number is X.shape[0].
+    row_names : list
+        The row names if first_column_names is True, stripped of quotes.
+    """
+    filename, start, stop, delim, first_column_names, n_cols, dtype = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(stop - start).decode().splitlines()
+    values, row_names = [], []
+    for line in lines:
+        if not line.strip():
+            continue
+        line_list = line.split(delim)
+        if first_column_names:
+            row_names.append(line_list[0].strip('"'))
+            line_list = line_list[1:]
+        if len(line_list) != n_cols:
+            raise ValueError('expected {} values in line "{}"'
+                             .format(n_cols, line[:50]))
+        values += line_list
+    n_rows = len(values) // n_cols if n_cols > 0 else len(row_names)
+    return np.array(values, dtype=dtype).reshape(n_rows, n_cols), row_names
+
 def read_txt_as_strings(filename, delim):
     """
     Interpret list of lists as strings
@@ -627,7 +895,7 @@ def _read_softgz(filename):
                               V[1])
     # Convert the Python list of lists to a Numpy array and transpose to match
     # the Scanpy convention of storing samples in rows and variables in colums.
-    X = np.array(X).T
+    X = np.array(X, dtype=sett.dtype).T
     row_names = sample_names
     col_names = gene_names
     ddata = {'X': X, 'row_names': row_names, 'col_names': col_names,
@@ -654,7 +922,7 @@ def postprocess_reading(key, value):
     else:
         return key, value
 
-def read_file_to_dict(filename, ext='h5'):
+def read_file_to_dict(filename, ext='h5', backed=False):
     """
     Read file and return dict with keys.
 
@@ -668,6 +936,9 @@ def read_file_to_dict(filename, ext='h5'):
         Filename of data file.
     ext : {'h5', 'xlsx'}, optional
         Choose file format. Excel is much slower.
+    backed : bool, optional (default: False)
+        For hdf5 files, do not read the data matrix X but store a BackedArray
+        that refers to it.
 
     Returns
     -------
@@ -679,6 +950,8 @@ def read_file_to_dict(filename, ext='h5'):
     if ext == 'h5':
         with h5py.File(filename, 'r') as f:
             for key in f.keys():
+                if backed and (key == 'X' or key.startswith('X_sparse_')):
+                    continue
                 # the '()' means 'read everything' (by contrast, ':' only works
                 # if not reading a scalar type)
                 value = f[key][()]
@@ -695,8 +968,11 @@ def read_file_to_dict(filename, ext='h5'):
         xl = pd.ExcelFile(filename)
         for sheet in xl.sheet_names:
             d[sheet] = xl.parse(sheet).values
-    if 'X_sparse_data' in d:
-        d = load_sparse_csr(d)
+    for key in [k for k in d.keys() if k.endswith('_sparse_data')]:
+        d = load_sparse_csr(d, key=key[:-len('_sparse_data')])
+    if backed and ext == 'h5':
+        from .classes.ann_data import BackedArray
+        d['X'] = BackedArray(filename, 'X')
     return d
 
 def prepare_writing(key, value, ext):
@@ -743,10 +1019,21 @@ def write_dict_to_file(filename, d, ext='h5'):
         os.makedirs(directory)
     if ext == 'h5' or ext == 'npz':
         d_write = {}
+        # backed arrays that are copied to the file block by block
+        d_backed = {}
         from scipy.sparse import issparse
+        from .classes.ann_data import BackedArray
         for key, value in d.items():
-            if key == 'X' and issparse(value):
-                for k, v in save_sparse_csr(value).items():
+            if isinstance(value, BackedArray):
+                # overwriting the file that backs value requires reading it
+                if (ext == 'h5'
+                    and not (os.path.exists(filename)
+                             and os.path.samefile(filename, value.filename))):
+                    d_backed[key] = value
+                    continue
+                value = value.to_memory()
+            if issparse(value):
+                for k, v in save_sparse_csr(value, key=key).items():
                     d_write[k] = v
             else:
                 key, value = prepare_writing(key, value, ext)
@@ -759,6 +1046,8 @@ def write_dict_to_file(filename, d, ext='h5'):
                 except Exception as e:
                     sett.m(0, 'Error creating dataset for key =', key)
                     raise e
+            for key, value in d_backed.items():
+                write_backed_to_file(f, key, value)
     elif ext == 'npz':
         np.savez(filename, **d_write)
     elif ext == 'csv' or ext == 'txt':
@@ -785,28 +1074,72 @@ def write_dict_to_file(filename, d, ext='h5'):
             for key, value in d.items():
                 pd.DataFrame(value).to_excel(writer,key)
 
+def write_backed_to_file(f, key, X):
+    """
+    Copy a backed data matrix into an open hdf5 file, block by block.
+
+    A block of rows takes about a hundredth of sett.max_memory. Sparse
+    matrices are written in the format of save_sparse_csr.
+
+    Parameters
+    ----------
+    f : h5py.File
+        File opened for writing.
+    key : str
+        Key of the matrix.
+    X : classes.ann_data.BackedArray
+        Data matrix, possibly restricted to a subset of rows and columns.
+    """
+    chunk_size = max(1, int(sett.max_memory * 1e9 / 100
+                            / (X.dtype.itemsize * max(X.shape[1], 1))))
+    if not X.sparse:
+        dataset = f.create_dataset(key, shape=X.shape, dtype=X.dtype)
+        for block, start, stop in X.chunks(chunk_size):
+            dataset[start:stop] = block
+        return
+    # the number of stored entries of a subset of columns is not known
+    # before reading, grow the datasets
+    data = f.create_dataset(key + '_sparse_data', shape=(0,), maxshape=(None,),
+                            dtype=X.dtype)
+    indices = f.create_dataset(key + '_sparse_indices', shape=(0,),
+                               maxshape=(None,), dtype=np.int32)
+    indptr = f.create_dataset(key + '_sparse_indptr', shape=(X.shape[0] + 1,),
+                              dtype=np.int64)
+    indptr[0] = 0
+    nnz = 0
+    for block, start, stop in X.chunks(chunk_size):
+        indptr[start + 1:stop + 1] = nnz + block.indptr[1:]
+        if block.nnz == 0:
+            continue
+        data.resize((nnz + block.nnz,))
+        indices.resize((nnz + block.nnz,))
+        data[nnz:nnz + block.nnz] = block.data
+        indices[nnz:nnz + block.nnz] = block.indices
+        nnz += block.nnz
+    f.create_dataset(key + '_sparse_shape', data=np.array(X.shape))
+
 #--------------------------------------------------------------------------------
 # Type conversion
 #--------------------------------------------------------------------------------
 
-def save_sparse_csr(X):
+def save_sparse_csr(X, key='X'):
     from scipy.sparse.csr import csr_matrix
     X = csr_matrix(X)
-    return {'X_sparse_data': X.data,
-            'X_sparse_indices': X.indices,
-            'X_sparse_indptr': X.indptr,
-            'X_sparse_shape': X.shape}
+    return {key + '_sparse_data': X.data,
+            key + '_sparse_indices': X.indices,
+            key + '_sparse_indptr': X.indptr,
+            key + '_sparse_shape': X.shape}
 
-def load_sparse_csr(d):
+def load_sparse_csr(d, key='X'):
     from scipy.sparse.csr import csr_matrix
-    d['X'] = csr_matrix((d['X_sparse_data'],
-                         d['X_sparse_indices'],
-                         d['X_sparse_indptr']),
-                         shape=d['X_sparse_shape'])
-    del d['X_sparse_data']
-    del d['X_sparse_indices']
-    del d['X_sparse_indptr']
-    del d['X_sparse_shape']
+    d[key] = csr_matrix((d[key + '_sparse_data'],
+                         d[key + '_sparse_indices'],
+                         d[key + '_sparse_indptr']),
+                        shape=d[key + '_sparse_shape'])
+    del d[key + '_sparse_data']
+    del d[key + '_sparse_indices']
+    del d[key + '_sparse_indptr']
+    del d[key + '_sparse_shape']
     return d
 
 def is_float(string):
@@ -872,7 +1205,7 @@ def ddata_from_df(df):
     Write pandas.dataframe to ddata dictionary.
     """
     ddata = {
-        'X': df.values[:,1:].astype(float),
+        'X': df.values[:,1:].astype(sett.dtype),
         'row_names': df.iloc[:,0].values.astype(str),
         'col_names': np.array(df.columns[1:], dtype=str)
         }
@@ -934,3 +1267,87 @@ def is_filename(filename_or_key,return_ext=False):
         return False
 
 
+def test_read_mtx_10x(tmpdir):
+    import gzip
+    from scipy.sparse import random as sparse_random
+    rng = np.random.RandomState(0)
+    n_genes, n_barcodes = 30, 20
+    # genes x barcodes as in the files of 10x Genomics
+    M = sparse_random(n_genes, n_barcodes, density=0.2, format='csc',
+                      random_state=rng)
+    M.data = np.ceil(10 * M.data)
+    M.sort_indices()
+    X = M.T.toarray()
+    genes = [('ENSG' + str(i), 'gene' + str(i)) for i in range(n_genes)]
+    barcodes = ['barcode' + str(i) for i in range(n_barcodes)]
+    coo = M.tocoo()
+    # entries sorted by barcode, as written by 10x Genomics, and shuffled
+    by_barcode = np.argsort(coo.col, kind='mergesort')
+    for order, ext in [(by_barcode, ''), (rng.permutation(M.nnz), '.gz')]:
+        directory = tmpdir.mkdir('mtx' + ext)
+        opener = gzip.open if ext else open
+        with opener(str(directory.join('matrix.mtx' + ext)), 'wt') as f:
+            f.write('%%MatrixMarket matrix coordinate integer general\n')
+            f.write('% comment\n')
+            f.write('{} {} {}\n'.format(n_genes, n_barcodes, M.nnz))
+            for i, j, v in zip(coo.row[order], coo.col[order], coo.data[order]):
+                f.write('{} {} {}\n'.format(i + 1, j + 1, int(v)))
+            # trailing blank lines fill at least one chunk of their own
+            f.write('\n' * 7)
+        with opener(str(directory.join('genes.tsv' + ext)), 'wt') as f:
+            f.write(''.join('\t'.join(gene) + '\n' for gene in genes))
+        with opener(str(directory.join('barcodes.tsv' + ext)), 'wt') as f:
+            f.write(''.join(barcode + '\n' for barcode in barcodes))
+        # chunks of a few lines and a single chunk
+        for chunk_size in [7, 1000000]:
+            ddata = _read_mtx(str(directory.join('matrix.mtx' + ext)),
+                              chunk_size=chunk_size)
+            assert ddata['X'].format == 'csr'
+            assert np.all(ddata['X'].toarray() == X)
+            assert list(ddata['row_names']) == barcodes
+            assert list(ddata['col_names']) == [gene[1] for gene in genes]
+            assert list(ddata['col']['gene_ids']) == [gene[0] for gene in genes]
+    # the same matrix in the hdf5 format of 10x Genomics
+    filename = str(tmpdir.join('10x.h5'))
+    with h5py.File(filename, 'w') as f:
+        group = f.create_group('matrix')
+        for key, value in [('data', M.data), ('indices', M.indices),
+                           ('indptr', M.indptr),
+                           ('shape', np.array(M.shape)),
+                           ('barcodes', np.array(barcodes, dtype='S')),
+                           ('features/id',
+                            np.array([g[0] for g in genes], dtype='S')),
+                           ('features/name',
+                            np.array([g[1] for g in genes], dtype='S'))]:
+            group.create_dataset(key, data=value)
+    adata = read_10x_h5(filename)
+    assert np.all(adata.X.toarray() == X)
+    assert list(adata.smp_names) == barcodes
+    assert list(adata.var_names) == [gene[1] for gene in genes]
+
+def test_read_txt_as_floats(tmpdir):
+    global _txt_range_size
+    rng = np.random.RandomState(0)
+    X = rng.rand(500, 4)
+    filename = str(tmpdir.join('X.txt'))
+    with open(filename, 'w') as f:
+        f.write('# comment\n')
+        f.write('\t'.join(['gene' + str(i) for i in range(4)]) + '\n')
+        for i, row in enumerate(X):
+            f.write('\t'.join(['cell' + str(i)] + [repr(x) for x in row])
+                    + '\n')
+            if i == 100:
+                f.write('\n')
+    n_jobs, range_size = sett.n_jobs, _txt_range_size
+    try:
+        ddatas = []
+        # a single range parsed serially, many ranges parsed by a pool
+        for n_jobs_test, range_size_test in [(1, range_size), (3, 1000)]:
+            sett.n_jobs, _txt_range_size = n_jobs_test, range_size_test
+            ddatas.append(read_txt_as_floats(filename, delim='\t'))
+    finally:
+        sett.n_jobs, _txt_range_size = n_jobs, range_size
+    for ddata in ddatas:
+        assert np.allclose(ddata['X'], X)
+        assert list(ddata['row_names']) == ['cell' + str(i) for i in range(500)]
+        assert list(ddata['col_names']) == ['gene' + str(i) for i in range(4)]
@@ -10,6 +10,7 @@ Sets global variables like verbosity, manages log output and timing.
 # http://stackoverflow.com/questions/1557571/how-to-get-time-of-a-python-program-execution
 
 import atexit
+from multiprocessing import cpu_count
 from time import clock
 from functools import reduce
 from matplotlib import rcParams
@@ -80,6 +81,25 @@ basekey = ''
 """ Basename for file reading and writing.
 """
 
+n_jobs = cpu_count()
+""" Number of threads used for parallel computations.
+"""
+
+max_memory = 1
+""" Memory in GB that a single computation should use at most.
+
+Determines whether graph-based tools use dense matrices, sparse matrices or
+low-rank representations, and the size of blocks in blockwise computations.
+"""
+
+dtype = 'float64'
+""" Floating point type of data matrices, kernels and embeddings.
+
+Set to 'float32' to halve memory and bandwidth. Readers, preprocessing, PCA
+and DataGraph then keep their arrays in 'float32', sums over many samples are
+still accumulated in 'float64'.
+"""
+
 #--------------------------------------------------------------------------------
 # Command-line arguments for global variables in settings
 #--------------------------------------------------------------------------------
@@ -143,6 +163,10 @@ def add_args(p):
     aa('--writedir',
        type=str, default=writedir, metavar='dir',
        help='Change write directory (default: %(default)s).')
+    aa('--dtype',
+       type=str, default=dtype, choices=['float32', 'float64'],
+       help='Floating point type of data matrices and embeddings '
+            '(default: %(default)s).')
 
     return p
 
@@ -204,6 +228,10 @@ def process_args(args):
         writedir += '/'
     args.pop('writedir')
 
+    global dtype
+    dtype = args['dtype']
+    args.pop('dtype')
+
     # from these arguments, init further global variables
     global exkey
     global basekey
@@ -19,7 +19,8 @@ See also
 from ..tools import dpt
 from .. import settings as sett
 
-def diffmap(adata, n_comps=10, k=30, knn=True, n_pcs_pre=50, sigma=0):
+def diffmap(adata, n_comps=10, k=30, knn=True, n_pcs_pre=50, sigma=0,
+            nn_method='exact', nn_trees=10, eigen_solver='arpack'):
     """
     Compute diffusion map embedding as of Coifman et al. (2005).
 
@@ -34,7 +35,7 @@ def diffmap(adata, n_comps=10, k=30, knn=True, n_pcs_pre=50, sigma=0):
     ----------
     adata : AnnData
         Annotated data matrix.
-    n_comps : int, optional (default: 3)
+    n_comps : int, optional (default: 10)
         The number of dimensions of the representation.
     k : int, optional (default: 30)
         Specify the number of nearest neighbors in the knn graph. If knn ==
@@ -48,19 +49,96 @@ def diffmap(adata, n_comps=10, k=30, knn=True, n_pcs_pre=50, sigma=0):
     sigma : float, optional (default: 0)
         If greater 0, ignore parameter 'k', but directly set a global width
         of the Kernel Gaussian (method 'global').
+    nn_method : {'exact', 'rpforest'}, optional (default: 'exact')
+        Method for computing the nearest neighbors if knn == True. 'rpforest'
+        computes approximate nearest neighbors using random projection trees
+        and nearest neighbor descent, which is much faster for large numbers
+        of cells. The estimated recall is reported.
+    nn_trees : int, optional (default: 10)
+        Number of random projection trees if nn_method == 'rpforest'. Increase
+        to obtain a higher recall at the expense of speed.
+    eigen_solver : {'arpack', 'lobpcg', 'randomized'}, optional (default: 'arpack')
+        Eigensolver for the diffusion components, see DataGraph.embed. All
+        solvers are warm started from the eigenvectors of previous runs on the
+        same data, so that computing more components is cheap.
 
     Returns
     -------
     X_diffmap : np.ndarray
         Array of shape n_samples x n_comps. DiffMap representation of data, which is the right eigen
         basis of transition matrix with eigenvectors as columns.
+    diffmap_components : np.ndarray
+        If the graph is disconnected, sample annotation that stores the
+        connected component of each sample. The eigenvectors of each component
+        are computed separately, X_diffmap stores the eigenvectors of the
+        component of each sample.
     """
     params = locals(); del params['adata']
     dmap = dpt.DPT(adata, params)
     ddmap = dmap.diffmap()
     adata['X_diffmap'] = ddmap['Y'][:, :n_comps]
+    if dmap.n_components > 1:
+        adata.smp['diffmap_components'] = dmap.components.astype(str)
+    # allows to project new data points with diffmap_project
+    dmap.store_embedding(adata)
     return adata
 
+def diffmap_project(adata, adata_new):
+    """
+    Project new data points onto the diffusion map of adata.
+
+    Extends the eigenvectors of the kernel of adata to the new data points
+    using the Nystroem method, see DataGraph.project. Neither the graph nor the
+    eigendecomposition of adata are recomputed. Each new data point is only
+    connected to its nearest neighbors in adata, which costs O(n_new log n)
+    for n data points in adata.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Annotated data matrix on which diffmap or dpt has been run.
+    adata_new : AnnData
+        Annotated data matrix of the new data points with the same variables
+        as adata. If the graph of adata has been built from adata['X_pca'],
+        adata_new['X_pca'] needs to store the new data points in the
+        coordinates of the same principal components.
+
+    Returns
+    -------
+    Writes the following to adata_new.
+        X_diffmap : np.ndarray
+            Array of shape n_new x n_comps. DiffMap representation of the new
+            data points.
+        dpt_pseudotime : np.ndarray
+            If dpt has been run on adata, sample annotation that stores the
+            pseudotime of the new data points with respect to the root of
+            adata.
+    """
+    if 'diffmap_evecs' not in adata:
+        raise ValueError('Run diffmap or dpt on adata first.')
+    rep = str(adata['diffmap_rep'])
+    if rep == 'X_pca' and 'X_pca' not in adata_new:
+        raise ValueError('The graph of adata has been built from X_pca, '
+                         'provide adata_new[\'X_pca\'].')
+    params = {'k': int(adata['diffmap_k']),
+              'knn': bool(adata['diffmap_knn']),
+              'sigma': float(adata['diffmap_sigma']),
+              'n_pcs_pre': 0 if rep == 'X' else adata['X_pca'].shape[1]}
+    dmap = dpt.DPT(adata, params)
+    dmap.load_embedding(adata)
+    Y_new = dmap.project(adata_new.X if rep == 'X' else adata_new['X_pca'])
+    adata_new['X_diffmap'] = Y_new[:, 1:adata['X_diffmap'].shape[1]+1]
+    sett.m(0, 'projected', Y_new.shape[0], 'data points onto diffusion map')
+    if dmap.n_components > 1:
+        adata_new.smp['diffmap_components'] = dmap.components_new.astype(str)
+    if 'dpt_pseudotime' in adata.smp_keys():
+        # the root is looked up from adata['xroot'] when constructing dmap,
+        # adata['iroot'] is an index into the AnnData on which dpt was run
+        if not hasattr(dmap, 'iroot'):
+            dmap.iroot = int(adata['iroot'])
+        adata_new.smp['dpt_pseudotime'] = dmap.project_pseudotime(Y_new)
+    return adata_new
+
 def plot_diffmap(adata,
          smp=None,
          names=None,
@@ -128,3 +206,24 @@ def plot_diffmap(adata,
         from ..compat.matplotlib import pyplot as pl
         pl.show()
 
+def test_diffmap_project_subset():
+    import numpy as np
+    from ..classes.ann_data import AnnData
+    rng = np.random.RandomState(0)
+    adata = AnnData(rng.randn(60, 3))
+    diffmap(adata, n_comps=3, k=5, n_pcs_pre=0)
+    sub = adata[::2, :]
+    for key in ['diffmap_evecs', 'diffmap_components', 'diffmap_sigmas_sq',
+                'diffmap_q', 'diffmap_sqrtz']:
+        assert sub[key].shape[0] == 30
+    adata_new = AnnData(sub.X[:5] + 0.01)
+    diffmap_project(sub, adata_new)
+    assert adata_new['X_diffmap'].shape == (5, 3)
+    assert np.all(np.isfinite(adata_new['X_diffmap']))
+    # projecting a copy of points of the graph reproduces their coordinates
+    adata = AnnData(rng.randn(60, 3))
+    diffmap(adata, n_comps=3, k=5, knn=False, n_pcs_pre=0)
+    sub = adata[::2, :]
+    adata_new = AnnData(sub.X[:5].copy())
+    diffmap_project(adata, adata_new)
+    assert np.allclose(adata_new['X_diffmap'], sub['X_diffmap'][:5], atol=1e-6)
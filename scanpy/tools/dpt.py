@@ -25,7 +25,8 @@ from .. import utils
 from ..classes import data_graph
 
 def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
-        sigma=0, allow_branching_at_root=False):
+        sigma=0, allow_branching_at_root=False, nn_method='exact',
+        nn_trees=10, lowrank=None, eigen_solver='arpack', distance='dpt'):
     u"""
     Diffusion Pseudotime analysis.
 
@@ -46,7 +47,10 @@ def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
             PCA representation of the data matrix (result of preprocessing with
             PCA). If it exists in adata, dpt will use this instead of adata.X.
     n_branchings : int, optional (default: 1)
-        Number of branchings to detect.
+        Number of branchings to detect. The detected segments are stored in
+        adata, if dpt is called again on the same data with the same
+        parameters and a higher number of branchings, only the additional
+        branchings are detected.
     k : int, optional (default: 30)
         Number of nearest neighbors on the knn graph. If knn == False, set the
         Gaussian kernel width to the distance of the kth neighbor.
@@ -68,6 +72,27 @@ def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
         of the Kernel Gaussian - knn needs to be False in this case.
     allow_branching_at_root : bool, optional (default: False)
         Allow to have branching directly at root point.
+    nn_method : {'exact', 'rpforest'}, optional (default: 'exact')
+        Method for computing the nearest neighbors if knn == True. 'rpforest'
+        computes approximate nearest neighbors using random projection trees
+        and nearest neighbor descent, which is much faster for large numbers
+        of cells. The estimated recall is reported.
+    nn_trees : int, optional (default: 10)
+        Number of random projection trees if nn_method == 'rpforest'. Increase
+        to obtain a higher recall at the expense of speed.
+    lowrank : bool or None, optional (default: None)
+        Compute DPT distances in the eigenbasis of the transition matrix, which
+        requires O(n k) instead of O(n^2) memory for n cells and k
+        eigenvectors. Distances are computed on demand. If None, this is done
+        if the dense computation would require more than sett.max_memory.
+    eigen_solver : {'arpack', 'lobpcg', 'randomized'}, optional (default: 'arpack')
+        Eigensolver for the diffusion components, see DataGraph.embed.
+    distance : {'dpt', 'commute'}, optional (default: 'dpt')
+        Distance of cells that determines pseudotime and branchings. 'dpt' is
+        the DPT distance of Haghverdi et al. (2016). 'commute' is the commute
+        distance of the random walk on the graph, which is approximated by a
+        random projection sketch in O(n) memory, see
+        DataGraph.compute_C_sketch; lowrank is then ignored.
 
     Returns
     -------
@@ -86,8 +111,20 @@ def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
             basis of the transition matrix with eigenvectors as columns.
         dpt_evals : np.ndarray
             Array of size (number of eigen vectors). Eigenvalues of transition matrix.
+        dpt_branchings_* : np.ndarray
+            The segments and tip points of the branchings, see
+            DPT.detect_branchings.
+    If the graph is disconnected, pseudotime and branchings are computed within
+    each connected component, the root of each component is its cell closest
+    to the root cell. The components are written as sample annotation.
+        diffmap_components : np.ndarray
+            Array of dim (number of samples) that stores the connected
+            component of each cell.
     """
     params = locals(); del params['adata']
+    if distance not in {'dpt', 'commute'}:
+        raise ValueError('distance needs to be \'dpt\' or \'commute\', not '
+                         + repr(distance))
     if 'xroot' not in adata:
         msg = \
 '''DPT requires specifying the expression "xroot" of a root cell.
@@ -102,12 +139,32 @@ def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
     # diffusion map
     ddmap = dpt.diffmap()
     adata['X_diffmap'] = ddmap['Y']
+    if dpt.n_components > 1:
+        adata.smp['diffmap_components'] = dpt.components.astype(str)
+    # allows to project new data points with diffmap_project
+    dpt.store_embedding(adata)
     sett.m(0, 'perform Diffusion Pseudotime analysis')
-    # compute M matrix of cumulative transition probabilities,
-    # see Haghverdi et al. (2016)
-    dpt.compute_M_matrix()
-    # compute DPT distance matrix, which we refer to as 'Ddiff'
-    dpt.compute_Ddiff_matrix()
+    if distance == 'commute':
+        # commute distances are computed on demand from the sketch
+        dpt.compute_C_sketch()
+    else:
+        # compute M matrix of cumulative transition probabilities,
+        # see Haghverdi et al. (2016)
+        if lowrank is None:
+            # the dense computation additionally holds M, its PCA
+            # representation and the DPT distance matrix
+            dense_memory = dpt.estimate_dense_memory(4.25)
+            lowrank = dense_memory > sett.max_memory
+            sett.m(0, '... dense DPT distance matrix requires',
+                   '{:.2f} GB,'.format(dense_memory),
+                   'using low-rank mode' if lowrank else 'using dense mode')
+        if lowrank:
+            # DPT distances are computed on demand
+            dpt.compute_M_lowrank()
+        else:
+            dpt.compute_M_matrix()
+            # compute DPT distance matrix, which we refer to as 'Ddiff'
+            dpt.compute_Ddiff_matrix()
     # update iroot, might have changed when subsampling, for example
     adata['iroot'] = dpt.iroot
     # pseudotime are distances from root point
@@ -128,6 +185,57 @@ def dpt(adata, n_branchings=1, k=30, knn=True, n_pcs_pre=50, n_pcs_post=30,
     adata['dpt_segtips'] = dpt.segstips
     return adata
 
+def dpt_roots(adata, xroots):
+    """
+    DPT pseudotime with respect to many candidate root cells at once.
+
+    Uses the diffusion map stored by dpt, neither the graph nor the
+    eigendecomposition are recomputed. The root cells closest to the root
+    vectors are looked up at once and the pseudotimes for all root cells are
+    computed in a single pass over the low-rank representation of the DPT
+    distances, see DataGraph.compute_M_lowrank.
+
+    Parameters
+    ----------
+    adata : AnnData
+        Annotated data matrix on which dpt has been run.
+    xroots : np.ndarray
+        Array of shape n_roots x X.shape[1] that stores the root vectors as
+        rows. If dpt used adata['X_pca'], the root vectors can also be given
+        in the coordinates of the principal components.
+
+    Returns
+    -------
+    Writes the following arrays as unstructured annotation to adata.
+        dpt_roots_iroots : np.ndarray
+            Array of size n_roots. Indices of the root cells.
+        dpt_roots_pseudotimes : np.ndarray
+            Array of shape n_roots x (number of samples). Pseudotime of each
+            cell with respect to each root cell.
+    """
+    if 'diffmap_evecs' not in adata or 'dpt_pseudotime' not in adata.smp_keys():
+        raise ValueError('Run dpt on adata first.')
+    rep = str(adata['diffmap_rep'])
+    params = {'k': int(adata['diffmap_k']),
+              'knn': bool(adata['diffmap_knn']),
+              'sigma': float(adata['diffmap_sigma']),
+              'n_pcs_pre': 0 if rep == 'X' else adata['X_pca'].shape[1]}
+    dpt = DPT(adata, params)
+    dpt.load_embedding(adata)
+    xroots = np.atleast_2d(xroots)
+    if rep == 'X_pca' and xroots.shape[1] != adata['X_pca'].shape[1]:
+        # look up the root cells in the original representation
+        dpt.X = adata.X
+        iroots = dpt.find_roots(xroots)
+        dpt.X = adata['X_pca']
+    else:
+        iroots = dpt.find_roots(xroots)
+    dpt.compute_M_lowrank()
+    adata['dpt_roots_iroots'] = iroots
+    adata['dpt_roots_pseudotimes'] = dpt.compute_pseudotimes(iroots)
+    sett.mt(0, 'computed pseudotimes for', iroots.size, 'root cells')
+    return adata
+
 def plot_dpt(adata,
              basis='diffmap',
              smp=None,
@@ -278,8 +386,8 @@ class DPT(data_graph.DataGraph):
         Out of a list of line segments, choose segment that has the most
         distant second data point.
 
-        Assume the distance matrix Ddiff is sorted according to seg_idcs.
-        Compute all the distances.
+        Segments are scored in parallel, only the rows of the distance matrix
+        that correspond to tips are computed.
 
         Returns
         -------
@@ -288,47 +396,66 @@ class DPT(data_graph.DataGraph):
         tips3 : int
             Positions of tips within chosen segment.
         """
+        from concurrent.futures import ThreadPoolExecutor
         scores_tips = np.zeros((len(segs), 4))
-        allindices = np.arange(self.X.shape[0], dtype=int)
-        for iseg, seg in enumerate(segs):
-            # do not consider 'unproper segments'
-            if segstips[iseg][0] == -1:
-                continue
-            # restrict distance matrix to points in segment
-            Dseg = self.Dchosen[np.ix_(seg,seg)]
-            # obtain the two indices that maximize distance in the segment
-            # call them tips
-            if False:
-                # obtain the position within the segment by searching for
-                # the maximum
-                tips = list(np.unravel_index(np.argmax(Dseg),Dseg.shape))
-            if True:
-                # map the global position to the position within the segment
-                tips = [np.where(allindices[seg] == tip)[0][0]
-                        for tip in segstips[iseg]]
-            # find the third point on the segment that has maximal
-            # added distance from the two tip points
-            dseg = Dseg[tips[0]] + Dseg[tips[1]]
-            # add this point to tips, it's a third tip, we store it at the first
-            # position in an array called tips3
-            tips3 = np.insert(tips,0,np.argmax(dseg))
-            # compute the score as ratio of the added distance to the third tip,
-            # to what it would be if it were on the straight line between the
-            # two first tips, given by Dseg[tips[:2]]
-            # if we did not normalize with, there would be a danger of simply
-            # assigning the highest score to the longest segment
-            score = dseg[tips3[0]]/Dseg[tips3[1],tips3[2]]
-            # write result
-            scores_tips[iseg,0] = score
-            scores_tips[iseg,1:] = tips3
+        with ThreadPoolExecutor(max_workers=sett.n_jobs) as pool:
+            results = pool.map(self._score_segment, segs, segstips)
+            for iseg, result in enumerate(results):
+                if result is not None:
+                    scores_tips[iseg] = result
         iseg = np.argmax(scores_tips[:,0])
         tips3 = scores_tips[iseg,1:].astype(int)
         return iseg, tips3
 
+    def _score_segment(self, seg, segtips):
+        """
+        Score segment and determine its three tips, see select_segment.
+
+        Returns
+        -------
+        score_tips : np.ndarray or None
+            The score and the positions of the three tips within the segment.
+            None for 'unproper segments'.
+        """
+        allindices = np.arange(self.X.shape[0], dtype=int)
+        # do not consider 'unproper segments'
+        if segtips[0] == -1:
+            return None
+        # restrict distance matrix to points in segment
+        Dseg = self.Dchosen.restrict(seg)
+        # obtain the two indices that maximize distance in the segment
+        # call them tips
+        if False:
+            # obtain the position within the segment by searching for
+            # the maximum
+            tips = list(np.unravel_index(np.argmax(Dseg),Dseg.shape))
+        if True:
+            # map the global position to the position within the segment
+            tips = [np.where(allindices[seg] == tip)[0][0]
+                    for tip in segtips]
+        # find the third point on the segment that has maximal
+        # added distance from the two tip points
+        dseg = Dseg[tips[0]] + Dseg[tips[1]]
+        # add this point to tips, it's a third tip, we store it at the first
+        # position in an array called tips3
+        tips3 = np.insert(tips,0,np.argmax(dseg))
+        # compute the score as ratio of the added distance to the third tip,
+        # to what it would be if it were on the straight line between the
+        # two first tips, given by Dseg[tips[:2]]
+        # if we did not normalize with, there would be a danger of simply
+        # assigning the highest score to the longest segment
+        score = dseg[tips3[0]]/Dseg[tips3[1],tips3[2]]
+        return np.r_[score, tips3]
+
     def detect_branchings(self):
         """
         Detect all branchings up to params['n_branchings'].
 
+        If adata stores fewer branchings from a previous call for the same data
+        and parameters, continue from these. The resulting segments are written
+        to adata as dpt_branchings_segs, dpt_branchings_offsets,
+        dpt_branchings_segstips and dpt_branchings_tips.
+
         Writes Attributes
         -----------------
         segs : np.ndarray
@@ -363,24 +490,108 @@ class DPT(data_graph.DataGraph):
         # distance, with "line", we mean the shortest path between two points,
         # which can be highly non-linear in the original space
         #
-        # let us define the tips of the whole data set
-        tips_all = list(np.unravel_index(np.argmax(self.Dchosen),self.Dchosen.shape))
-        # we keep a list of the tips of each segment
-        segstips = [tips_all]
-        for ibranch in range(self.params['n_branchings']):
+        # continue from the branchings detected in a previous run on the same
+        # data, the first splits do not depend on n_branchings
+        state = self._load_branchings()
+        if state is not None:
+            segs, segstips, tips = state
+            sett.m(0, '... reusing', len(tips), 'branchings stored in adata')
+        elif self.n_components == 1:
+            # let us define the tips of the whole data set
+            tips_all = list(self.Dchosen.argmax())
+            # we keep a list of the tips of each segment
+            segstips = [tips_all]
+            tips = []
+        else:
+            # distances between connected components are not meaningful,
+            # start with one segment per component instead
+            segs = self._components_idcs()
+            segstips = [list(seg[list(self.Dchosen.restrict(seg).argmax())])
+                        for seg in segs]
+            tips = []
+        for ibranch in range(len(tips), self.params['n_branchings']):
             # out of the list of segments, determine the segment
             # that most strongly deviates from a straight line
             # and provide the three tip points that span the triangle
             # of maximally distant points
             iseg, tips3 = self.select_segment(segs,segstips)
             sett.m(0,'tip points',tips3,'= [third start end]')
+            tips.append(segs[iseg][tips3])
             # detect branching and update segs and segstips
             segs, segstips = self.detect_branching(segs,segstips,iseg,tips3)
+        self._store_branchings(segs, segstips, tips)
         # store as class members
         self.segs = segs
         self.segstips = segstips
         sett.mt(0,'finished branching detection')
 
+    def _branchings_key(self):
+        """
+        Fingerprint of the data and parameters that determine Dchosen.
+        """
+        return utils.fingerprint(self.X, *[self.params.get(key) for key in
+                                          ['k', 'knn', 'sigma', 'nn_method',
+                                           'nn_trees', 'n_pcs_post',
+                                           'eigen_solver', 'distance']],
+                                 type(self.Dchosen).__name__)
+
+    def _load_branchings(self):
+        """
+        Load the segments of a previous call of detect_branchings from adata.
+
+        Returns
+        -------
+        segs, segstips, tips : list, list, list or None
+            The segments, their tips and the three tip points of each
+            branching. None if adata stores no branchings for the current data
+            and parameters or more than params['n_branchings'] branchings.
+        """
+        adata = self.adata
+        if (adata is None
+            or str(adata.get('dpt_branchings_key')) != self._branchings_key()):
+            return None
+        tips = list(np.array(adata['dpt_branchings_tips'], dtype=int)
+                    .reshape(-1, 3))
+        if len(tips) > self.params['n_branchings']:
+            return None
+        offsets = adata['dpt_branchings_offsets']
+        segs = np.split(np.array(adata['dpt_branchings_segs'], dtype=int),
+                        offsets[1:-1])
+        segstips = list(np.array(adata['dpt_branchings_segstips'], dtype=int))
+        return segs, segstips, tips
+
+    def _store_branchings(self, segs, segstips, tips):
+        """
+        Store the segments detected by detect_branchings in adata.
+
+        The segments before check_segments are stored, as the latter depends on
+        the root cell. A state with more branchings is not overwritten.
+
+        Writes
+        ------
+        dpt_branchings_segs, dpt_branchings_offsets : np.ndarray
+            The concatenated index arrays of the segments and the offsets of
+            the segments within them.
+        dpt_branchings_segstips : np.ndarray
+            Array of dimension (number of segments) x 2.
+        dpt_branchings_tips : np.ndarray
+            Array of dimension (number of branchings) x 3. The three tip points
+            [third start end] of each branching, in the order of detection.
+        """
+        adata = self.adata
+        if adata is None:
+            return
+        key = self._branchings_key()
+        if (str(adata.get('dpt_branchings_key')) == key
+            and np.size(adata['dpt_branchings_tips']) > 3*len(tips)):
+            return
+        adata['dpt_branchings_key'] = key
+        adata['dpt_branchings_segs'] = np.concatenate(segs).astype(int)
+        adata['dpt_branchings_offsets'] = np.r_[0, np.cumsum([len(seg)
+                                                              for seg in segs])]
+        adata['dpt_branchings_segstips'] = np.array(segstips, dtype=int)
+        adata['dpt_branchings_tips'] = np.array(tips, dtype=int).reshape(-1, 3)
+
     def postprocess_segments(self):
         """
         Convert the format of the segment class members.
@@ -453,7 +664,7 @@ class DPT(data_graph.DataGraph):
         """
         Return a single array that stores integer segment labels.
         """
-        segslabels = np.zeros(self.Dchosen.shape[0],dtype=int)
+        segslabels = np.zeros(self.pseudotime.size,dtype=int)
         for iseg,seg in enumerate(self.segs):
             segslabels[seg] = iseg
         self.segslabels = segslabels
@@ -516,7 +727,7 @@ class DPT(data_graph.DataGraph):
         """
         seg = segs[iseg]
         # restrict distance matrix to points in chosen segment seg
-        Dseg = self.Dchosen[np.ix_(seg,seg)]
+        Dseg = self.Dchosen.restrict(seg)
         # given the three tip points and the distance matrix detect the
         # branching on the segment, return the list ssegs of segments that
         # are defined by splitting this segment
@@ -546,7 +757,7 @@ class DPT(data_graph.DataGraph):
 
         Parameters
         ----------
-        Dseg : np.ndarray
+        Dseg : DistanceOracle
             Dchosen distance matrix restricted to segment.
         tips : np.ndarray
             The three tip points. They form a 'triangle' that contains the data.
@@ -581,7 +792,7 @@ class DPT(data_graph.DataGraph):
                 tip = np.where(np.arange(Dseg.shape[0])[newseg]
                                == tips[inewseg])[0][0]
                 # new tip within restricted distance matrix
-                secondtip = np.argmax(Dseg[np.ix_(newseg,newseg)][tip])
+                secondtip = np.argmax(Dseg.restrict(newseg)[tip])
                 # map back to position within segment
                 secondtip = np.arange(Dseg.shape[0])[newseg][secondtip]
                 # add to list
@@ -674,7 +885,7 @@ class DPT(data_graph.DataGraph):
 
         Parameters
         ----------
-        Dseg : np.ndarray
+        Dseg : DistanceOracle
             Dchosen distance matrix restricted to segment.
         tips : np.ndarray
             The three tip points. They form a 'triangle' that contains the data.
@@ -753,12 +964,13 @@ class DPT(data_graph.DataGraph):
         corr_coeff = np.zeros(idx_range.size)
         pos_old = sp.stats.kendalltau(a[:min_length],b[:min_length])[0]
         neg_old = sp.stats.kendalltau(a[min_length:],b[min_length:])[0]
+        # compute differences in concordance when adding a[i] and b[i]
+        # to the first subsequence, and removing these elements from
+        # the second subsequence, for all i at once
+        diffs_pos, diffs_neg = self._kendall_tau_diffs(a,b)
         for ii,i in enumerate(idx_range):
             if True:
-                # compute differences in concordance when adding a[i] and b[i]
-                # to the first subsequence, and removing these elements from
-                # the second subsequence
-                diff_pos, diff_neg = self._kendall_tau_diff(a,b,i)
+                diff_pos, diff_neg = diffs_pos[i], diffs_neg[i]
                 pos = pos_old + self._kendall_tau_add(i,diff_pos,pos_old)
                 neg = neg_old + self._kendall_tau_subtract(n-i,diff_neg,neg_old)
                 pos_old = pos
@@ -855,3 +1067,118 @@ class DPT(data_graph.DataGraph):
         diff_neg = np.dot(a_neg,b_neg)
 
         return diff_pos, diff_neg
+
+    def _kendall_tau_diffs(self,a,b):
+        """
+        Compute _kendall_tau_diff for all split indices i.
+
+        For each i, diff_pos is the sum of
+            sign(a[j] - a[i]) * sign(b[j] - b[i])
+        over j < i and diff_neg the same sum over j > i.
+
+        Instead of O(n) operations for each i, this counts the pairs with
+        a[j] < a[i] and b[j] < b[i] for all i at once by decomposing the ranks
+        of a and b in bits: a[j] < a[i] iff there is a bit where a[i] has a
+        one, a[j] has a zero and above which both ranks agree. This requires
+        O(log(n)^2) vectorized passes over the sequences.
+
+        Parameters
+        ----------
+        a, b : np.ndarray
+
+        Returns
+        -------
+        diffs_pos, diffs_neg : np.ndarray, np.ndarray
+            Integer arrays of size n.
+        """
+        diffs_pos = self._kendall_tau_diffs_preceding(a,b)
+        diffs_neg = self._kendall_tau_diffs_preceding(a[::-1],b[::-1])[::-1]
+        return diffs_pos, diffs_neg
+
+    def _kendall_tau_diffs_preceding(self,a,b):
+        """
+        Compute diff_pos of _kendall_tau_diffs.
+        """
+        n = a.size
+        ra = np.unique(a, return_inverse=True)[1]
+        rb = np.unique(b, return_inverse=True)[1]
+        # number of pairs j < i with a[j] < a[i], a[j] == a[i], etc.
+        a_less, b_less = _count_preceding_less(ra), _count_preceding_less(rb)
+        a_equal = _count_preceding_in_groups(ra, np.ones(n, dtype=bool))
+        b_equal = _count_preceding_in_groups(rb, np.ones(n, dtype=bool))
+        both_less = np.zeros(n, dtype=int)
+        nbits_a, nbits_b = _nbits(ra.max()), _nbits(rb.max())
+        for kb in range(nbits_b):
+            bit_b = (rb >> kb) & 1
+            for ka in range(nbits_a):
+                bit_a = (ra >> ka) & 1
+                # group by the bits above kb and ka
+                keys = ((rb >> (kb+1)) * ((ra.max() >> (ka+1)) + 1)
+                        + (ra >> (ka+1)))
+                counts = _count_preceding_in_groups(keys,
+                                                    (bit_a == 0) & (bit_b == 0))
+                both_less += np.where((bit_a == 1) & (bit_b == 1), counts, 0)
+        # without ties
+        #   sum_j<i sign(a[j] - a[i]) * sign(b[j] - b[i])
+        #   = (#(+,+) + #(-,-)) - (#(+,-) + #(-,+))
+        #   = i - 2 a_less - 2 b_less + 4 both_less
+        # ties need corrections, they are rare for distances, hence they are
+        # computed for single points
+        diffs = (np.arange(n) - 2*a_less - a_equal - 2*b_less - b_equal
+                 + 4*both_less)
+        for i in np.flatnonzero((a_equal > 0) | (b_equal > 0)):
+            a_less_b_equal = np.sum((a[:i] < a[i]) & (b[:i] == b[i]))
+            a_equal_b_less = np.sum((a[:i] == a[i]) & (b[:i] < b[i]))
+            both_equal = np.sum((a[:i] == a[i]) & (b[:i] == b[i]))
+            diffs[i] += 2*a_less_b_equal + 2*a_equal_b_less + both_equal
+        return diffs
+
+def _nbits(m):
+    """
+    Number of bits needed to represent the non-negative integer m.
+    """
+    return max(int(m).bit_length(), 1)
+
+def _count_preceding_less(ranks):
+    """
+    For each i, count j < i with ranks[j] < ranks[i].
+    """
+    counts = np.zeros(ranks.size, dtype=int)
+    for k in range(_nbits(ranks.max())):
+        bit = (ranks >> k) & 1
+        counts += np.where(bit == 1,
+                           _count_preceding_in_groups(ranks >> (k+1), bit == 0), 0)
+    return counts
+
+def _count_preceding_in_groups(keys, mask):
+    """
+    For each i, count j < i with keys[j] == keys[i] and mask[j] == True.
+    """
+    # stable sort to preserve the order within groups
+    order = np.argsort(keys, kind='mergesort')
+    keys_sorted = keys[order]
+    mask_sorted = mask[order].astype(int)
+    cumsum = np.cumsum(mask_sorted) - mask_sorted
+    group_start = np.r_[True, keys_sorted[1:] != keys_sorted[:-1]]
+    offset = np.maximum.accumulate(np.where(group_start, cumsum, 0))
+    counts = np.zeros(keys.size, dtype=int)
+    counts[order] = cumsum - offset
+    return counts
+
+def test_kendall_tau_split():
+    import scipy as sp
+    import scipy.stats
+    from ..classes.ann_data import AnnData
+    rng = np.random.RandomState(0)
+    dpt = DPT(AnnData(rng.randn(10, 2)), {'n_pcs_pre': 0, 'sigma': 0})
+    # b increases with a up to 30, then decreases, without ties
+    a = np.arange(50, dtype=float)
+    b = np.r_[np.arange(30), 30 - np.arange(20) / 2.] + 0.1 * rng.randn(50)
+    diffs_pos, diffs_neg = dpt._kendall_tau_diffs(a, b)
+    for i in range(50):
+        assert (diffs_pos[i], diffs_neg[i]) == dpt._kendall_tau_diff(a, b, i)
+    idx_range = np.arange(5, 50 - 5 - 1)
+    corr_coeff = [sp.stats.kendalltau(a[:i+1], b[:i+1])[0]
+                  - sp.stats.kendalltau(a[i+1:], b[i+1:])[0]
+                  for i in idx_range]
+    assert dpt.kendall_tau_split(a, b) == 5 + np.argmax(corr_coeff)
@@ -27,8 +27,8 @@ def pca(adata_or_X, n_comps=10, zero_center=True,
         Number of principal components to compute.
     zero_center : bool, optional (default: True)
         If True, compute standard PCA from Covariance matrix. If False, omit
-        zero-centering variables, which allows to handle sparse input efficiently.
-        For sparse intput, automatically defaults to False.
+        zero-centering variables. For sparse input, the centering is applied
+        implicitly, see preprocess.pca.
     svd_solver : str, optional (default: 'randomized')
         SVD solver to use. Either 'arpack' for the ARPACK wrapper in SciPy
         (scipy.sparse.linalg.svds), or 'randomized' for the randomized algorithm
@@ -39,7 +39,8 @@ def pca(adata_or_X, n_comps=10, zero_center=True,
     Returns
     -------
     X_pca : np.ndarray
-         PCA representation of the data with shape n_variables x n_comps.
+         PCA representation of the data with shape n_variables x n_comps and
+         dtype sett.dtype.
          Depending on whether an AnnData or a data matrix has been
          provided, the array is written to AnnData or returned directly.
     """
@@ -14,13 +14,16 @@ References
 """
 
 import numpy as np
+import scipy as sp
+import scipy.sparse
 from .. import settings as sett
 from .. import plotting as plott
 from .. import utils
 
 step_size = 10
 
-def spring(adata, k=4, n_comps=2, n_steps=12, rep=None):
+def spring(adata, k=4, n_comps=2, n_steps=12, rep=None, nn_method='exact',
+           nn_trees=10):
     u"""
     Visualize data using the force-directed Fruchterman-Reingold algorithm.
 
@@ -41,6 +44,14 @@ def spring(adata, k=4, n_comps=2, n_steps=12, rep=None):
         Repulsion = strength of springs. If None the distance is set to
         1/sqrt(n) where n is the number of cells. Increase this value to move
         nodes farther apart.
+    nn_method : {'exact', 'rpforest'}, optional (default: 'exact')
+        Method for computing the nearest neighbors. 'rpforest' computes
+        approximate nearest neighbors using random projection trees and
+        nearest neighbor descent, which is much faster for large numbers of
+        cells.
+    nn_trees : int, optional (default: 10)
+        Number of random projection trees if nn_method == 'rpforest'. Increase
+        to obtain a higher recall at the expense of speed.
 
     Returns
     -------
@@ -55,24 +66,23 @@ def spring(adata, k=4, n_comps=2, n_steps=12, rep=None):
     else:
         X = adata.X
         sett.m(0, '--> using X for building graph')
-    D = utils.comp_distance(X, metric='euclidean')
-    # deterimine the distance of the k nearest neighbors
-    indices = np.zeros((D.shape[0],k),dtype=np.int_)
-    for irow, row in enumerate(D):
-        # the last item is already in its sorted position as
-        # argpartition puts the (k-1)th element - starting to count from
-        # zero - in its sorted position
-        idcs = np.argpartition(row,k-1)[:k]
-        indices[irow] = idcs
+    # determine the k nearest neighbors, the point itself is not counted
+    # here, but self-loops do not exert any force anyway
+    indices, _ = utils.comp_neighbors_cached(adata, X, k-1, metric='euclidean',
+                                             method=nn_method, n_trees=nn_trees)
+    if nn_method != 'exact':
+        sett.m(0, '... estimated recall of approximate nearest neighbors',
+               '{:.3f}'.format(utils.estimate_neighbors_recall(X, indices)))
     # compute adjacency matrix
     # make this float, as we might put a weight matrix here
-    Adj = np.zeros(D.shape, dtype=float)
-    for irow, row in enumerate(indices):
-        Adj[irow, row] = 1
-        # symmetrize as in DPT
-        # for j in row:
-        #    if irow not in indices[j]:
-        #        Adj[j,irow] = 1
+    n = X.shape[0]
+    Adj = sp.sparse.csr_matrix((np.ones(indices.size), indices.flatten(),
+                                np.arange(0, indices.size+1, k-1)),
+                               shape=(n, n))
+    # symmetrize as in DPT
+    # Adj = Adj.maximum(Adj.T)
+    if n < 500:
+        Adj = Adj.toarray()
     # just sample initial positions, the rest is done by the plotting tool
     np.random.seed(1)
     Y = np.asarray(np.random.random((Adj.shape[0], 2)), dtype=Adj.dtype)
@@ -246,7 +256,7 @@ def fruchterman_reingold_layout(W,
         nnodes, _ = W.shape
         rep = 1.0 / np.sqrt(nnodes)
     sett.m(0, 'using repulsion rep =', rep)
-    if len(W) >= 500:
+    if W.shape[0] >= 500:
         Y = _fruchterman_reingold_sparse(W, rep, Yinit, fixed, iterations, dim)
     else:
         Y = _fruchterman_reingold_dense(W, rep, Yinit, fixed, iterations, dim)
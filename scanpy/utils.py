@@ -362,11 +362,395 @@ def comp_distance(X, metric='euclidean'):
         Distance matrix.
     """
     from scipy.spatial import distance
+    # pdist computes in float64, only the square matrix has sett.dtype
     D = distance.pdist(X, metric=metric)
-    D = distance.squareform(D)
+    D = distance.squareform(D.astype(sett.dtype, copy=False))
     sett.mt(0, 'computed distance matrix with metric =', metric)
     return D
 
+#--------------------------------------------------------------------------------
+# Nearest neighbors
+#--------------------------------------------------------------------------------
+
+def comp_neighbors(X, k, metric='sqeuclidean', method='exact',
+                   n_trees=10, n_iters=1, random_state=0, n_jobs=None,
+                   max_memory=None):
+    """
+    Compute the k nearest neighbors of each data point.
+
+    The data point itself is not counted as a neighbor.
+
+    Parameters
+    ----------
+    X : np.ndarray, np.memmap or h5py.Dataset
+        Data array (rows store samples, columns store variables). For method
+        'exact', X can reside on disk, it is then read in blocks of rows.
+    k : int
+        Number of nearest neighbors.
+    metric : {'sqeuclidean', 'euclidean'}, optional (default: 'sqeuclidean')
+        Metric in which distances are returned.
+    method : {'exact', 'kdtree', 'rpforest'}, optional (default: 'exact')
+        'exact' processes tiles of pairs of blocks of data points in parallel
+        and keeps only the nearest neighbors of each point, it has bounded
+        memory and can read X from disk. 'kdtree' uses the exact tree-based
+        search of sklearn, which is faster for data of low intrinsic
+        dimension. 'rpforest' is an approximate search based on a random
+        projection forest refined by nearest-neighbor descent, which scales
+        near-linearly in the number of data points.
+    n_trees : int, optional (default: 10)
+        Number of random projection trees for method 'rpforest'. Increasing
+        this increases recall and computation time.
+    n_iters : int, optional (default: 1)
+        Number of nearest-neighbor descent iterations for method 'rpforest'.
+    random_state : int, optional (default: 0)
+        Seed for method 'rpforest'.
+    n_jobs : int or None, optional (default: None)
+        Number of threads for method 'exact', defaults to sett.n_jobs.
+    max_memory : float or None, optional (default: None)
+        Memory in GB available for distance tiles in method 'exact', defaults
+        to sett.max_memory.
+
+    Returns
+    -------
+    indices : np.ndarray
+        Array of shape n_samples x k storing the indices of the neighbors.
+    distances : np.ndarray
+        Array of shape n_samples x k storing the distances to the neighbors,
+        sorted in increasing order.
+    """
+    if metric not in {'sqeuclidean', 'euclidean'}:
+        raise ValueError('metric needs to be "sqeuclidean" or "euclidean"')
+    if method == 'exact':
+        n_jobs = sett.n_jobs if n_jobs is None else n_jobs
+        max_memory = sett.max_memory if max_memory is None else max_memory
+        indices, distances = _comp_neighbors_tiled(X, k, n_jobs, max_memory)
+        if metric == 'euclidean':
+            distances = np.sqrt(distances)
+    elif method == 'kdtree':
+        from sklearn.neighbors import NearestNeighbors
+        # don't use metric = sqeuclidian, because this requires choosing algorithm 'brute'
+        sklearn_neighbors = NearestNeighbors(n_neighbors=k)
+        sklearn_neighbors.fit(X)
+        distances, indices = sklearn_neighbors.kneighbors()
+        if metric == 'sqeuclidean':
+            distances **= 2
+    elif method == 'rpforest':
+        indices, distances = _comp_neighbors_rpforest(X, k, n_trees, n_iters,
+                                                      random_state)
+        if metric == 'euclidean':
+            distances = np.sqrt(distances)
+    else:
+        raise ValueError('method needs to be "exact", "kdtree" or "rpforest"')
+    sett.mt(0, 'computed', k, 'nearest neighbors with method =', method)
+    return indices, distances
+
+def estimate_neighbors_recall(X, indices, n_samples=100, random_state=0):
+    """
+    Estimate recall of approximate nearest neighbors.
+
+    Compares with exact neighbors of a random sample of data points.
+
+    Parameters
+    ----------
+    X : np.ndarray
+        Data array.
+    indices : np.ndarray
+        Array of shape n_samples x k storing the indices of the neighbors.
+    n_samples : int, optional (default: 100)
+        Number of data points for which exact neighbors are computed.
+
+    Returns
+    -------
+    recall : float
+        Fraction of exact nearest neighbors that have been found.
+    """
+    n, k = indices.shape
+    rng = np.random.RandomState(random_state)
+    sample = rng.choice(n, size=min(n_samples, n), replace=False)
+    Dsq = _sqdist(X[sample], X)
+    Dsq[np.arange(sample.size), sample] = np.inf
+    exact = np.argpartition(Dsq, k-1, axis=1)[:, :k]
+    found = sum(np.intersect1d(exact[i], indices[s]).size
+                for i, s in enumerate(sample))
+    return found / float(sample.size * k)
+
+def comp_neighbors_cached(adata, X, k, metric='sqeuclidean', method='exact',
+                          n_trees=10):
+    """
+    Compute nearest neighbors or reuse the ones cached in adata.
+
+    The cache is keyed by a fingerprint of the representation X and the
+    parameters of the neighbor search. It is stored as unstructured annotation
+    in adata and is hence written to and read from result files. Neighbors
+    cached for a larger k are reused for a smaller k.
+
+    Parameters
+    ----------
+    adata : AnnData or None
+        Annotated data matrix used as cache. If None, do not cache.
+    X : np.ndarray
+        Data array, typically a representation of adata.X.
+    k, metric, method, n_trees
+        See comp_neighbors.
+
+    Returns
+    -------
+    indices, distances : np.ndarray
+        See comp_neighbors.
+    """
+    if adata is None:
+        return comp_neighbors(X, k, metric=metric, method=method,
+                              n_trees=n_trees)
+    # exact methods yield the same neighbors
+    exact = method in {'exact', 'kdtree'}
+    key = fingerprint(X, 'exact' if exact else method,
+                      None if exact else n_trees)
+    if ('neighbors_key' in adata
+        and str(adata['neighbors_key']) == key
+        and adata['neighbors_indices'].shape[1] >= k):
+        sett.m(0, '... reusing', k, 'nearest neighbors cached in adata')
+        indices = adata['neighbors_indices'][:, :k]
+        distances = adata['neighbors_distances'][:, :k]
+    else:
+        indices, distances = comp_neighbors(X, k, metric='sqeuclidean',
+                                            method=method, n_trees=n_trees)
+        adata['neighbors_key'] = key
+        adata['neighbors_indices'] = indices
+        adata['neighbors_distances'] = distances
+    if metric == 'euclidean':
+        distances = np.sqrt(distances)
+    return indices, distances
+
+def fingerprint(X, *params):
+    """
+    Compute a fingerprint of a data array and parameters.
+
+    Serves as key for caching results computed from X.
+
+    Parameters
+    ----------
+    X : np.ndarray or sp.sparse.spmatrix
+        Data array.
+    *params
+        Parameters that have been used to compute the result, their string
+        representation enters the fingerprint.
+
+    Returns
+    -------
+    key : str
+    """
+    import hashlib
+    from scipy.sparse import issparse
+    h = hashlib.sha1()
+    arrays = [X.data, X.indices, X.indptr] if issparse(X) else [X]
+    for array in arrays:
+        h.update(np.ascontiguousarray(array).view(np.uint8))
+    h.update(repr((X.shape, str(X.dtype)) + params).encode())
+    return h.hexdigest()
+
+def _sqdist(X, Y):
+    """
+    Squared Euclidian distances between the rows of X and Y.
+    """
+    D = np.dot(X, Y.T)
+    D *= -2
+    D += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+    D += np.einsum('ij,ij->i', Y, Y)[np.newaxis, :]
+    np.maximum(D, 0, out=D)
+    return D
+
+def _comp_neighbors_tiled(X, k, n_jobs=1, max_memory=1):
+    """
+    Exact nearest neighbors in squared Euclidian distance.
+
+    Queries are processed in chunks of n_jobs blocks, one thread per block. For
+    each chunk, the reference data is read block by block so that at most
+    n_jobs tiles of distances need to fit into max_memory (in GB).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    n = X.shape[0]
+    if n <= k:
+        raise ValueError('need more than k = {} data points'.format(k))
+    # the distance tile and the merged candidates take ~ 2 * 8 byte per pair
+    block_size = int(np.sqrt(max_memory * 1e9 / (16 * n_jobs)))
+    block_size = max(min(block_size, n), k + 1)
+    # center to reduce rounding errors in the distances
+    mean = sum(np.asarray(X[start:start+block_size]).sum(axis=0)
+               for start in range(0, n, block_size)) / n
+
+    def load(start):
+        B = np.asarray(X[start:start+block_size], dtype=np.float_) - mean
+        return start, B, np.einsum('ij,ij->i', B, B)
+
+    indices = np.zeros((n, k), dtype=np.int_)
+    distances = np.full((n, k), np.inf)
+
+    def update(query, reference):
+        qstart, Q, Qsqnorms = query
+        rstart, R, Rsqnorms = reference
+        D = Q.dot(R.T)
+        D *= -2
+        D += Qsqnorms[:, np.newaxis]
+        D += Rsqnorms[np.newaxis, :]
+        # exclude the points themselves
+        rows = np.arange(Q.shape[0])
+        cols = rows + qstart - rstart
+        self_in_block = (cols >= 0) & (cols < R.shape[0])
+        D[rows[self_in_block], cols[self_in_block]] = np.inf
+        qrows = slice(qstart, qstart + Q.shape[0])
+        # only distances below the current kth nearest neighbor matter, after
+        # the first blocks, these are few
+        candidates = D < distances[qrows].max(axis=1)[:, np.newaxis]
+        counts = candidates.sum(axis=1)
+        if counts.max() > 4 * k:
+            cand_dist = D
+            cand_idcs = np.broadcast_to(np.arange(rstart, rstart + R.shape[0]),
+                                        D.shape)
+        else:
+            crows, ccols = np.nonzero(candidates)
+            pos = np.arange(crows.size) - (np.cumsum(counts) - counts)[crows]
+            cand_dist = np.full((Q.shape[0], max(counts.max(), 1)), np.inf)
+            cand_idcs = np.zeros(cand_dist.shape, dtype=np.int_)
+            cand_dist[crows, pos] = D[crows, ccols]
+            cand_idcs[crows, pos] = rstart + ccols
+        dist = np.concatenate([distances[qrows], cand_dist], axis=1)
+        idcs = np.concatenate([indices[qrows], cand_idcs], axis=1)
+        nearest = np.argpartition(dist, k-1, axis=1)[:, :k]
+        rows = rows[:, np.newaxis]
+        indices[qrows] = idcs[rows, nearest]
+        distances[qrows] = dist[rows, nearest]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        for chunk_start in range(0, n, n_jobs * block_size):
+            chunk_stop = min(chunk_start + n_jobs * block_size, n)
+            queries = [load(start)
+                       for start in range(chunk_start, chunk_stop, block_size)]
+            for rstart in range(0, n, block_size):
+                reference = load(rstart)
+                list(pool.map(lambda query: update(query, reference), queries))
+    rows = np.arange(n)[:, np.newaxis]
+    order = np.argsort(distances, axis=1)
+    indices, distances = indices[rows, order], distances[rows, order]
+    np.maximum(distances, 0, out=distances)
+    return indices, distances
+
+def _comp_neighbors_rpforest(X, k, n_trees=10, n_iters=1, random_state=0,
+                             batch_size=1000):
+    """
+    Approximate nearest neighbors using a random projection forest.
+
+    Each tree recursively splits the data into halves of equal size by its
+    projection on a random hyperplane. Points that share a leaf are neighbor candidates. The
+    resulting graph is refined by checking neighbors of neighbors
+    (nearest-neighbor descent, Dong et al., 2011).
+
+    Returns squared Euclidian distances.
+    """
+    X = np.asarray(X, dtype=np.float_)
+    n = X.shape[0]
+    if n <= k:
+        raise ValueError('need more than k = {} data points'.format(k))
+    rng = np.random.RandomState(random_state)
+    sqnorms = np.einsum('ij,ij->i', X, X)
+    # splitting into halves ensures that leaves contain at least k+1 points
+    leaf_size = max(2*(k+1), 16)
+    indices = np.zeros((n, 0), dtype=np.int_)
+    distances = np.zeros((n, 0), dtype=np.float_)
+    for itree in range(n_trees):
+        leaves = _rptree_leaves(X, leaf_size, rng)
+        # all other points in the leaf of a point are candidates
+        candidates = np.zeros((n, leaf_size), dtype=np.int_)
+        candidates_dist = np.zeros((n, leaf_size), dtype=np.float_)
+        for start in range(0, leaves.shape[0], batch_size):
+            batch = leaves[start:start+batch_size]
+            Xleaf = X[batch]
+            Dleaf = np.matmul(Xleaf, Xleaf.transpose(0, 2, 1))
+            Dleaf *= -2
+            Dleaf += sqnorms[batch][:, :, np.newaxis]
+            Dleaf += sqnorms[batch][:, np.newaxis, :]
+            Dleaf[np.broadcast_to(batch[:, np.newaxis, :] < 0, Dleaf.shape)] = np.inf
+            for pos in range(leaf_size):
+                points = batch[:, pos]
+                valid = points >= 0
+                candidates[points[valid]] = batch[valid]
+                candidates_dist[points[valid]] = Dleaf[valid, pos]
+        indices, distances = _merge_neighbors(indices, distances, candidates,
+                                              candidates_dist, k)
+    for iiter in range(n_iters):
+        # neighbors of neighbors are candidates
+        m = min(k, 10)
+        candidates = indices[indices[:, :m], :m].reshape(n, m*m)
+        candidates_dist = np.zeros(candidates.shape, dtype=np.float_)
+        for start in range(0, n, batch_size):
+            rows = slice(start, start+batch_size)
+            candidates_dist[rows] = (
+                sqnorms[rows, np.newaxis] + sqnorms[candidates[rows]]
+                - 2*np.einsum('ij,ikj->ik', X[rows], X[candidates[rows]]))
+        indices, distances = _merge_neighbors(indices, distances, candidates,
+                                              candidates_dist, k)
+    np.maximum(distances, 0, out=distances)
+    return indices, distances
+
+def _rptree_leaves(X, leaf_size, rng):
+    """
+    Leaves of a random projection tree.
+
+    Nodes are split into halves at the median of the projection, ties are
+    broken arbitrarily, so that leaves contain at least leaf_size // 2 points,
+    even if many projections are equal.
+
+    Returns
+    -------
+    leaves : np.ndarray
+        Array of shape n_leaves x leaf_size storing the indices of the points
+        in each leaf, padded with -1.
+    """
+    leaves = []
+    stack = [np.arange(X.shape[0])]
+    while stack:
+        idcs = stack.pop()
+        if idcs.size <= leaf_size:
+            leaves.append(idcs)
+            continue
+        # shuffle, so that ties, for example in nodes of equal points, are
+        # split randomly
+        idcs = idcs[rng.permutation(idcs.size)]
+        proj = X[idcs].dot(X[idcs[0]] - X[idcs[1]])
+        half = idcs.size // 2
+        order = np.argpartition(proj, half)
+        stack.append(idcs[order[:half]])
+        stack.append(idcs[order[half:]])
+    padded = -np.ones((len(leaves), leaf_size), dtype=np.int_)
+    for ileaf, idcs in enumerate(leaves):
+        padded[ileaf, :idcs.size] = idcs
+    return padded
+
+def _merge_neighbors(indices, distances, candidates, candidates_dist, k):
+    """
+    Merge candidate neighbors into the current neighbors.
+
+    Candidates may contain duplicates and the points themselves. Invalid
+    candidates need to have infinite distance.
+
+    Neighbors that could not be determined due to a lack of candidates are
+    marked with index -1 and infinite distance.
+    """
+    rows = np.arange(indices.shape[0])[:, np.newaxis]
+    # mark invalid candidates and the points themselves with index -1
+    invalid = (candidates == rows) | np.isinf(candidates_dist)
+    candidates = np.where(invalid, -1, candidates)
+    candidates_dist = np.where(invalid, np.inf, candidates_dist)
+    idcs = np.concatenate([indices, candidates], axis=1)
+    dist = np.concatenate([distances, candidates_dist], axis=1)
+    # discard duplicates, they have equal distances up to rounding
+    order = np.argsort(idcs, axis=1)
+    idcs, dist = idcs[rows, order], dist[rows, order]
+    dist[:, 1:][idcs[:, 1:] == idcs[:, :-1]] = np.inf
+    nearest = np.argpartition(dist, k-1, axis=1)[:, :k]
+    idcs, dist = idcs[rows, nearest], dist[rows, nearest]
+    order = np.argsort(dist, axis=1)
+    return idcs[rows, order], dist[rows, order]
+
 def hierarch_cluster(M):
     """ 
     Cluster matrix using hierarchical clustering.
@@ -478,3 +862,33 @@ def odict_merge(*ds):
         for k, v in d.items():
             merged[k] = v
     return merged
+
+def test_comp_neighbors_rpforest():
+    rng = np.random.RandomState(0)
+    k = 5
+    # many equal points lead to ties in the projections
+    for X in [rng.randn(500, 4), rng.randint(0, 3, (500, 2)).astype(float)]:
+        indices, distances = comp_neighbors(X, k, method='rpforest')
+        assert np.all(indices >= 0) and np.all(np.isfinite(distances))
+        assert np.all(indices != np.arange(X.shape[0])[:, np.newaxis])
+        Dsq = _sqdist(X, X)
+        np.fill_diagonal(Dsq, np.inf)
+        exact = np.sort(Dsq, axis=1)[:, :k]
+        assert np.all(distances >= exact - 1e-10)
+        assert np.mean(np.isclose(distances, exact)) > 0.9
+
+def test_comp_neighbors_tiled():
+    rng = np.random.RandomState(0)
+    X = rng.randn(300, 4)
+    k = 7
+    Dsq = _sqdist(X, X)
+    np.fill_diagonal(Dsq, np.inf)
+    exact = np.sort(Dsq, axis=1)[:, :k]
+    # tiles of 25 x 25 pairs, processed in two threads
+    for n_jobs, max_memory in [(1, 1), (2, 16 * 2 * 25**2 / 1e9)]:
+        indices, distances = _comp_neighbors_tiled(X, k, n_jobs, max_memory)
+        assert np.allclose(distances, exact)
+        assert np.allclose(Dsq[np.arange(300)[:, np.newaxis], indices], exact)
+    from pytest import raises
+    with raises(ValueError):
+        _comp_neighbors_tiled(X[:k], k)